@@ -0,0 +1,118 @@
+"""
+Measure how long Corotwine's modules take to import, each in a new
+interpreter, and check that they add little to the Twisted modules they
+can't do without.
+
+Run with C{python benchmarks/importtime.py [runs] [moduleBudget]
+[millisecondBudget]}.  It exits with status 1 if a module imports more than
+C{moduleBudget} modules (default 20) beyond those its Twisted baseline
+does, or, if C{millisecondBudget} is given, takes that much longer to
+import.  Import times vary by several milliseconds between runs on a busy
+machine, so the number of modules is the budget checked by default.
+Modules which need an optional dependency that isn't installed, such as
+pyOpenSSL for corotwine.tls, are reported and skipped; any other failure to
+import a module fails the run, after the other modules are measured.
+"""
+
+import os, subprocess, sys
+
+
+# Each module, with the Twisted module it needs anyway, whose cost doesn't
+# count against the budget.
+MODULES = [
+    ("corotwine", None),
+    ("corotwine.defer", "twisted.internet.defer"),
+    ("corotwine.queue", None),
+    ("corotwine.select", "twisted.internet.defer"),
+    ("corotwine.clock", None),
+    ("corotwine.protocol", "twisted.internet.protocol"),
+    ("corotwine.examples", "twisted.internet.protocol"),
+    ("corotwine.resolver", "twisted.internet.defer"),
+    ("corotwine.tls", "twisted.protocols.tls"),
+    ]
+
+
+def measure(module, runs):
+    """
+    Import C{module} in C{runs} new interpreters.
+
+    @return: A tuple of the shortest CPU time, in seconds, that the import
+        took, and the number of modules it loaded.
+
+    @raise ImportError: If C{module} can't be imported, because a module
+        outside Corotwine and Twisted is missing.
+    @raise subprocess.CalledProcessError: If C{module} can't be imported for
+        any other reason.
+    """
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [path] + [p for p in [env.get("PYTHONPATH")] if p])
+    # CPU time varies less than wall clock time from run to run.
+    program = ("import sys, time\n"
+               "clock = time.process_time\n"
+               "def count():\n"
+               "    return len([m for m in sys.modules.values()\n"
+               "                if m is not None])\n"
+               "before = count()\n"
+               "start = clock()\n"
+               "try:\n"
+               "    import %s\n"
+               "except ImportError as e:\n"
+               "    if (e.name or '').split('.')[0] in ('corotwine',\n"
+               "                                        'twisted'):\n"
+               "        raise\n"
+               "    print('missing %%s' %% (e.name,))\n"
+               "else:\n"
+               "    print('%%r %%d' %% (clock() - start, count() - before))\n"
+               % (module,))
+    times = []
+    for i in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-W", "ignore", "-c", program], env=env)
+        first, second = output.decode("ascii").split()
+        if first == "missing":
+            raise ImportError("%s needs %s" % (module, second))
+        seconds, modules = first, second
+        times.append(float(seconds))
+    return min(times), int(modules)
+
+
+def main(runs, moduleBudget, millisecondBudget):
+    overBudget = []
+    failed = []
+    baselines = {None: (0.0, 0)}
+    for module, baseline in MODULES:
+        try:
+            seconds, modules = measure(module, runs)
+        except ImportError as e:
+            print("%-20s skipped: %s" % (module, e))
+            continue
+        except subprocess.CalledProcessError:
+            print("%-20s failed to import" % (module,))
+            failed.append(module)
+            continue
+        if baseline not in baselines:
+            baselines[baseline] = measure(baseline, runs)
+        extraSeconds = seconds - baselines[baseline][0]
+        extraModules = modules - baselines[baseline][1]
+        print("%-20s %6.1fms %4d modules  (%+.1fms %+d over %s)" % (
+            module, seconds * 1e3, modules, extraSeconds * 1e3, extraModules,
+            baseline or "nothing"))
+        if extraModules > moduleBudget or (
+                millisecondBudget is not None
+                and extraSeconds * 1e3 > millisecondBudget):
+            overBudget.append(module)
+    if failed:
+        print("Failed: %s" % (", ".join(failed),))
+    if overBudget:
+        print("Over budget: %s" % (", ".join(overBudget),))
+    if failed or overBudget:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+                  float(sys.argv[3]) if len(sys.argv) > 3 else None))
@@ -0,0 +1,67 @@
+"""
+Compare round-trip latency of loopback TCP and UNIX sockets through
+L{corotwine.protocol.gListen} and L{corotwine.protocol.gConnect}.
+
+Run with C{python benchmarks/latency.py [roundTrips]}.
+"""
+
+import os, sys, tempfile, time
+
+from twisted.internet import reactor
+
+from corotwine.protocol import gListen, gConnect
+from corotwine.defer import blockOn, deferredGreenlet
+
+
+def echo(transport):
+    try:
+        while True:
+            transport.write(transport.read())
+    except Exception:
+        return
+
+
+def measure(serverDescription, clientDescription, roundTrips):
+    """
+    Listen on C{serverDescription}, connect to C{clientDescription} and time
+    C{roundTrips} one-byte round trips.
+
+    @return: A sorted list of round trip times, in seconds.
+    """
+    server = blockOn(gListen(serverDescription, echo))
+    if clientDescription is None:
+        clientDescription = "tcp:host=127.0.0.1:port=%d" % (
+            server.port.getHost().port,)
+    transport = gConnect(clientDescription)
+    timings = []
+    for i in range(roundTrips):
+        start = time.time()
+        transport.write(b"x")
+        transport.read()
+        timings.append(time.time() - start)
+    transport.close()
+    blockOn(server.stopAccepting())
+    timings.sort()
+    return timings
+
+
+def report(name, timings):
+    print("%-6s median %7.1fus  p99 %7.1fus" % (
+        name,
+        timings[len(timings) // 2] * 1e6,
+        timings[int(len(timings) * 0.99)] * 1e6))
+
+
+@deferredGreenlet
+def main(roundTrips):
+    path = os.path.join(tempfile.mkdtemp(), "latency.sock")
+    report("tcp", measure("tcp:0:interface=127.0.0.1", None, roundTrips))
+    report("unix", measure("unix:" + path, "unix:path=" + path, roundTrips))
+
+
+if __name__ == '__main__':
+    roundTrips = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    d = main(roundTrips)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda ignored: reactor.stop())
+    reactor.run()
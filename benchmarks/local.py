@@ -0,0 +1,42 @@
+"""
+Compare the cost of reading and writing an attribute of a
+L{corotwine.local.GreenletLocal}, a C{threading.local}, and a C{dict} keyed
+by the current greenlet.
+
+Run with C{python benchmarks/local.py [iterations]}.
+"""
+
+import sys, threading, timeit
+
+from corotwine import greenlet
+from corotwine.local import GreenletLocal
+
+
+def report(name, statement, setup, iterations):
+    seconds = min(timeit.repeat(statement, setup, number=iterations,
+                                repeat=3))
+    print("%-30s %6.1fns" % (name, seconds / iterations * 1e9))
+
+
+def main(iterations):
+    namespace = {"greenletLocal": GreenletLocal(),
+                 "threadLocal": threading.local(),
+                 "byGreenlet": {},
+                 "getcurrent": greenlet.getcurrent}
+    setup = ("from __main__ import namespace\n"
+             "globals().update(namespace)\n"
+             "greenletLocal.value = threadLocal.value = 1\n"
+             "byGreenlet[getcurrent()] = {'value': 1}\n")
+    globals()["namespace"] = namespace
+    report("GreenletLocal get", "greenletLocal.value", setup, iterations)
+    report("threading.local get", "threadLocal.value", setup, iterations)
+    report("dict[getcurrent()] get",
+           "byGreenlet[getcurrent()]['value']", setup, iterations)
+    report("GreenletLocal set", "greenletLocal.value = 2", setup, iterations)
+    report("threading.local set", "threadLocal.value = 2", setup, iterations)
+    report("dict[getcurrent()] set",
+           "byGreenlet[getcurrent()]['value'] = 2", setup, iterations)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,88 @@
+"""
+Measure what collecting L{corotwine.metrics.runtime} costs: the time to
+deliver a chunk of data to a handler which echoes it, and to wait in
+L{corotwine.defer.blockOn}, with collection disabled and enabled.
+
+Run with C{python benchmarks/metrics.py [iterations]}.
+"""
+
+import sys, time
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from corotwine.protocol import _GreenletFactory
+from corotwine.defer import blockOn
+from corotwine.metrics import runtime
+from corotwine import greenlet
+
+
+class NullTransport(object):
+    """
+    A transport which throws away what is written to it.
+    """
+    def write(self, data):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+
+def echo(transport):
+    while True:
+        transport.write(transport.read())
+
+
+
+def measureEcho(iterations):
+    """
+    @return: The seconds taken to deliver each chunk to an echoing handler.
+    """
+    protocol = _GreenletFactory(echo, clock=Clock()).buildProtocol(None)
+    protocol.makeConnection(NullTransport())
+    data = b"x" * 100
+    start = time.time()
+    for i in range(iterations):
+        protocol.dataReceived(data)
+    return (time.time() - start) / iterations
+
+
+
+def measureBlockOn(iterations):
+    """
+    @return: The seconds taken by each L{blockOn} of a L{Deferred} which
+        fires later.
+    """
+    deferreds = [Deferred() for i in range(iterations)]
+    def waiter():
+        for d in deferreds:
+            blockOn(d)
+    g = greenlet(waiter)
+    g.switch()
+    start = time.time()
+    for d in deferreds:
+        d.callback(None)
+    return (time.time() - start) / iterations
+
+
+
+def main(iterations):
+    for name, measure in [("echo", measureEcho), ("blockOn", measureBlockOn)]:
+        runtime.disable()
+        disabled = min(measure(iterations) for i in range(3))
+        runtime.enable(Clock(), None)
+        enabled = min(measure(iterations) for i in range(3))
+        runtime.disable()
+        print("%-8s disabled %6.0fns  enabled %6.0fns  (%+.0fns)" % (
+            name, disabled * 1e9, enabled * 1e9, (enabled - disabled) * 1e9))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
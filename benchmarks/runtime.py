@@ -0,0 +1,196 @@
+"""
+Measure the costs which depend most on the interpreter and greenlet
+release: switching between greenlets, waiting in
+L{corotwine.defer.blockOn}, and moving data through a
+L{corotwine.protocol.GreenletTransport}, in small and large chunks, with no
+sockets involved.
+
+Run it under each runtime to compare, such as two Python 3 releases, or
+two greenlet releases installed in separate virtualenvs, saving the
+results of one and comparing the other with them::
+
+    PYTHONPATH=. old-venv/bin/python benchmarks/runtime.py --save old.json
+    PYTHONPATH=. new-venv/bin/python benchmarks/runtime.py --compare old.json
+
+Both must be Python 3.7 or later, which this tree needs.
+
+Run with C{python benchmarks/runtime.py [--save FILE] [--compare FILE]
+[iterations]}.
+"""
+
+import json, platform, sys, time
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+import greenlet as _greenletModule
+
+from corotwine.protocol import _GreenletFactory, LineBuffer
+from corotwine.defer import blockOn
+from corotwine import greenlet
+
+
+class NullTransport(object):
+    """
+    A transport which throws away what is written to it.
+    """
+    def write(self, data):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+
+def connect(function):
+    """
+    Connect C{function} to a L{NullTransport}.
+
+    @return: The protocol, to deliver data to.
+    """
+    protocol = _GreenletFactory(function, clock=Clock()).buildProtocol(None)
+    protocol.makeConnection(NullTransport())
+    return protocol
+
+
+
+def measureSwitch(iterations):
+    """
+    @return: The seconds taken by each switch between two greenlets.
+    """
+    def pong():
+        while True:
+            main.switch()
+    main = greenlet.getcurrent()
+    other = greenlet(pong)
+    switch = other.switch
+    start = time.time()
+    for i in range(iterations):
+        switch()
+    # Each iteration switches there and back again.
+    return (time.time() - start) / (iterations * 2)
+
+
+
+def measureBlockOn(iterations):
+    """
+    @return: The seconds taken by each L{blockOn} of a L{Deferred} which
+        fires later.
+    """
+    deferreds = [Deferred() for i in range(iterations)]
+    def waiter():
+        for d in deferreds:
+            blockOn(d)
+    greenlet(waiter).switch()
+    start = time.time()
+    for d in deferreds:
+        d.callback(None)
+    return (time.time() - start) / iterations
+
+
+
+def measureEcho(size):
+    """
+    Make a function measuring the bytes per second echoed by a handler
+    which is delivered chunks of C{size} bytes.
+    """
+    def measure(iterations):
+        def echo(transport):
+            while True:
+                transport.write(transport.read())
+        protocol = connect(echo)
+        data = b"x" * size
+        start = time.time()
+        for i in range(iterations):
+            protocol.dataReceived(data)
+        return iterations * size / (time.time() - start)
+    return measure
+
+
+
+def measureLines(iterations):
+    """
+    @return: The lines per second read through a L{LineBuffer}, delivered
+        a hundred at a time.
+    """
+    def reader(transport):
+        for line in LineBuffer(transport):
+            pass
+    protocol = connect(reader)
+    data = b"GET /index.html HTTP/1.1\r\n" * 100
+    start = time.time()
+    for i in range(iterations // 100):
+        protocol.dataReceived(data)
+    return (iterations // 100) * 100 / (time.time() - start)
+
+
+
+# Each measurement's name, function, unit, and whether more is better.
+MEASUREMENTS = [
+    ("switch", measureSwitch, "ns", False),
+    ("blockOn", measureBlockOn, "ns", False),
+    ("echo 64B", measureEcho(64), "MB/s", True),
+    ("echo 16KB", measureEcho(16384), "MB/s", True),
+    ("readLine", measureLines, "klines/s", True),
+    ]
+
+SCALES = {"ns": 1e9, "MB/s": 1e-6, "klines/s": 1e-3}
+
+
+def runtime():
+    """
+    Describe the interpreter and greenlet release in use.
+    """
+    return "%s %s, greenlet %s" % (
+        platform.python_implementation(), platform.python_version(),
+        _greenletModule.__version__)
+
+
+
+def main(iterations, save=None, compare=None):
+    results = {}
+    baseline = None
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+    print(runtime())
+    if baseline is not None:
+        print("compared with %s" % (baseline["runtime"],))
+    for name, measure, unit, higherIsBetter in MEASUREMENTS:
+        values = [measure(iterations) for i in range(3)]
+        if higherIsBetter:
+            value = max(values)
+        else:
+            value = min(values)
+        results[name] = value
+        scale = SCALES[unit]
+        if baseline is None or name not in baseline["results"]:
+            print("%-10s %10.1f %-8s" % (name, value * scale, unit))
+            continue
+        old = baseline["results"][name]
+        if higherIsBetter:
+            speedup = value / old
+        else:
+            speedup = old / value
+        print("%-10s %10.1f %-8s %10.1f %-8s %5.2fx" % (
+            name, value * scale, unit, old * scale, unit, speedup))
+    if save is not None:
+        with open(save, "w") as f:
+            json.dump({"runtime": runtime(), "results": results}, f)
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {}
+    for option in ["--save", "--compare"]:
+        if option in arguments:
+            index = arguments.index(option)
+            options[option[2:]] = arguments[index + 1]
+            del arguments[index:index + 2]
+    main(int(arguments[0]) if arguments else 100000, **options)
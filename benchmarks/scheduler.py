@@ -0,0 +1,93 @@
+"""
+Compare switching to woken greenlets directly with queueing them on a
+L{corotwine.scheduler.Scheduler}: the number of greenlet switches and the
+throughput of echoing handlers which are each sent several packets per
+reactor iteration.
+
+Run with C{python benchmarks/scheduler.py [connections] [packetsPerIteration]
+[iterations]}.
+"""
+
+import sys, time
+
+from twisted.internet.task import Clock
+
+from corotwine.protocol import _GreenletFactory
+from corotwine.scheduler import Scheduler
+from corotwine import greenlet
+
+
+class NullTransport(object):
+    """
+    A transport which throws away what is written to it.
+    """
+    def write(self, data):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+
+def echo(transport):
+    while True:
+        transport.write(transport.read())
+
+
+
+def measure(scheduled, connections, packets, iterations):
+    """
+    Deliver C{packets} packets to each of C{connections} echoing handlers in
+    each of C{iterations} simulated reactor iterations.
+
+    @return: The number of greenlet switches and the seconds taken.
+    """
+    clock = Clock()
+    scheduler = Scheduler(clock)
+    if scheduled:
+        scheduler.install()
+    factory = _GreenletFactory(echo, clock=clock)
+    protocols = []
+    for i in range(connections):
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(NullTransport())
+        protocols.append(protocol)
+    switches = [0]
+    def trace(event, args):
+        if event in ("switch", "throw"):
+            switches[0] += 1
+    data = b"x" * 512
+    previous = greenlet.settrace(trace)
+    start = time.time()
+    try:
+        for i in range(iterations):
+            for protocol in protocols:
+                for j in range(packets):
+                    protocol.dataReceived(data)
+            clock.advance(0)
+    finally:
+        elapsed = time.time() - start
+        greenlet.settrace(previous)
+        scheduler.uninstall()
+    return switches[0], elapsed
+
+
+
+def main(connections, packets, iterations):
+    total = connections * packets * iterations * 512
+    for name, scheduled in [("direct", False), ("scheduled", True)]:
+        switches, elapsed = measure(scheduled, connections, packets,
+                                    iterations)
+        print("%-10s %9d switches  %8.1fMB/s" % (
+            name, switches, total / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    arguments = [int(argument) for argument in sys.argv[1:]]
+    main(*(arguments + [100, 4, 1000][len(arguments):]))
@@ -1,9 +1,15 @@
 """
 Corotwine, a coroutine-based API for Twisted.
+
+Importing the package and most of its modules is cheap: modules which need
+large parts of Twisted, such as L{twisted.names} for resolving host names or
+L{twisted.protocols.tls}, import them when they are first used.
 """
 
-# Expose an alias for the greenlet package in use
-try:
-    from py.magic import greenlet
-except ImportError:
-    from greenlet import greenlet
+# Expose an alias for the greenlet type, so that modules don't need to know
+# where it comes from.
+from greenlet import greenlet
+
+
+# The reactor's greenlet.
+MAIN = greenlet.getcurrent()
@@ -0,0 +1,278 @@
+"""
+Admission control for listeners, driven by how far the reactor is behind.
+
+When handlers use more CPU than the process has, the reactor falls behind:
+timers fire late, reads are noticed late, and every connection slows down
+together, while the listener goes on accepting more of them.  A
+L{LagMonitor} measures how late the reactor runs a timer scheduled every few
+milliseconds, and an L{AdmissionPolicy} given to C{gListenTCP} turns new
+connections away while that lag stays high::
+
+    gListenTCP(8080, handler, admissionPolicy=AdmissionPolicy(
+        target=0.005, interval=0.1, action="reject",
+        response=b"HTTP/1.1 503 Service Unavailable\\r\\n"
+                 b"Content-Length: 0\\r\\n\\r\\n"))
+
+The policy is modelled on CoDel: short bursts of lag are tolerated, and the
+listener only counts as overloaded once the lag has stayed above C{target}
+for a whole C{interval}, that is, once even the smallest lag seen over an
+interval is too much.  It stops being overloaded as soon as the lag falls
+below C{target} again.  While it is overloaded, depending on C{action}, the
+listener either:
+
+ - C{"pause"}: stops accepting connections, so that they wait in the
+   kernel's backlog;
+
+ - C{"reject"}: closes new connections as soon as they are accepted, after
+   writing C{response} to them, without calling the handler function; or
+
+ - C{"shed"}: queues new connections instead of starting their handlers,
+   and closes, as for C{"reject"}, those which have been queued for longer
+   than C{interval}, oldest first.  Those left are started when the listener
+   is no longer overloaded.
+
+L{corotwine.protocol.GreenletServer} reports whether its listener is
+overloaded, and how many connections it has rejected and shed.
+"""
+
+from corotwine.metrics import runtime as _metrics
+
+
+__all__ = ["LagMonitor", "AdmissionPolicy"]
+
+
+class LagMonitor(object):
+    """
+    Measures how late the reactor runs timers, by scheduling one every
+    L{interval} seconds while anything is observing it.
+
+    @ivar interval: The number of seconds between runs of the timer.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        schedule the timer with.
+    @ivar lag: The number of seconds late the timer last ran.
+    @ivar _observers: The callables to call with each measurement.
+    @ivar _call: The delayed call of the timer, or C{None} if there are no
+        observers.
+    @ivar _due: When the timer is due to run.
+    """
+
+    def __init__(self, interval=0.01, clock=None):
+        """
+        @param interval: See L{interval}.
+        @param clock: See L{clock}.  Defaults to the reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.interval = interval
+        self.clock = clock
+        self.lag = 0.0
+        self._observers = []
+        self._call = None
+        self._due = None
+
+
+    def addObserver(self, observer):
+        """
+        Call C{observer} with the lag, in seconds, each time it is measured,
+        starting the timer if it is not already running.
+        """
+        self._observers.append(observer)
+        if self._call is None:
+            self._schedule()
+
+
+    def removeObserver(self, observer):
+        """
+        Stop calling C{observer}, and stop the timer if nothing else is
+        observing.
+        """
+        self._observers.remove(observer)
+        if not self._observers and self._call is not None:
+            self._call.cancel()
+            self._call = None
+            self.lag = 0.0
+
+
+    def _schedule(self):
+        self._due = self.clock.seconds() + self.interval
+        self._call = self.clock.callLater(self.interval, self._measure)
+
+
+    def _measure(self):
+        self._call = None
+        self.lag = max(0.0, self.clock.seconds() - self._due)
+        self._schedule()
+        for observer in self._observers[:]:
+            observer(self.lag)
+
+
+
+class AdmissionPolicy(object):
+    """
+    How a listener turns connections away while the reactor is behind.
+
+    The same policy may be given to several listeners; each of them decides
+    separately when it is overloaded.
+
+    @ivar target: The most lag, in seconds, which is acceptable.
+    @ivar interval: The number of seconds the lag must stay above L{target}
+        for the listener to be overloaded, and the longest a connection is
+        queued for while it is, with the C{"shed"} action.
+    @ivar action: C{"pause"}, C{"reject"} or C{"shed"}; see
+        L{corotwine.admission}.
+    @ivar response: The bytes to write to connections before closing them
+        unhandled, or C{None} to close them without writing anything.
+    @ivar monitor: The L{LagMonitor} to measure the lag with, or C{None} to
+        give each listener one of its own.
+    """
+
+    ACTIONS = ("pause", "reject", "shed")
+
+    def __init__(self, target=0.005, interval=0.1, action="reject",
+                 response=None, monitor=None):
+        if action not in self.ACTIONS:
+            raise ValueError("Unknown admission action %r" % (action,))
+        self.target = target
+        self.interval = interval
+        self.action = action
+        self.response = response
+        self.monitor = monitor
+
+
+
+class _AdmissionGuard(object):
+    """
+    Applies an L{AdmissionPolicy} to one listener.
+
+    The lag is observed while the listener has connections, and for as long
+    as it is overloaded.
+
+    @ivar policy: The L{AdmissionPolicy}.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider
+        the listener uses.
+    @ivar monitor: The L{LagMonitor} observed.
+    @ivar port: The listening port, which the C{"pause"} action pauses, or
+        C{None} if it is not known, in which case new connections are
+        rejected instead.
+    @ivar overloaded: Whether the listener is overloaded.
+    @ivar rejected: The number of new connections closed unhandled while the
+        listener was overloaded.
+    @ivar shed: The number of queued connections closed unhandled while the
+        listener was overloaded.
+    @ivar pauses: The number of times accepting was paused.
+    @ivar _listener: The L{corotwine.protocol._GreenletFactory}.
+    @ivar _aboveSince: When the lag was first seen above the policy's
+        target, if it has been ever since, or C{None}.
+    @ivar _observing: Whether L{monitor} is being observed.
+    @ivar _paused: Whether L{port} is paused.
+    """
+
+    def __init__(self, policy, listener, clock):
+        self.policy = policy
+        self.clock = clock
+        self.monitor = policy.monitor
+        if self.monitor is None:
+            self.monitor = LagMonitor(clock=clock)
+        self.port = None
+        self.overloaded = False
+        self.rejected = 0
+        self.shed = 0
+        self.pauses = 0
+        self._listener = listener
+        self._aboveSince = None
+        self._observing = False
+        self._paused = False
+
+
+    def admit(self, protocol):
+        """
+        Decide whether a new connection may be kept, closing it if not, and
+        start observing the lag if it is not already being observed.
+
+        @type protocol: L{corotwine.protocol._GreenletProtocol}
+        """
+        if not self._observing:
+            self._observing = True
+            self.monitor.addObserver(self._observe)
+        if not self.overloaded or self.policy.action == "shed" or self._paused:
+            return True
+        self.rejected += 1
+        self._turnAway(protocol)
+        return False
+
+
+    def mayStart(self):
+        """
+        Decide whether handlers may be started, rather than queued.
+        """
+        return not (self.overloaded and self.policy.action == "shed")
+
+
+    def _turnAway(self, protocol):
+        """
+        Close a connection without handling it, writing the policy's response
+        first.
+        """
+        if self.policy.response:
+            protocol.transport.write(self.policy.response)
+        protocol._loseConnection()
+        if _metrics.enabled:
+            _metrics.connectionsShed.inc()
+
+
+    def _observe(self, lag):
+        """
+        Decide whether the listener is overloaded, given the latest lag.
+        """
+        policy = self.policy
+        now = self.clock.seconds()
+        if lag < policy.target:
+            self._aboveSince = None
+            if self.overloaded:
+                self._recover()
+        elif self._aboveSince is None:
+            self._aboveSince = now
+        elif not self.overloaded and now - self._aboveSince >= policy.interval:
+            self._overload()
+        if self.overloaded and policy.action == "shed":
+            self._shedQueued(now - policy.interval)
+        listener = self._listener
+        if not (self.overloaded or listener._active or listener._queued):
+            self._observing = False
+            self.monitor.removeObserver(self._observe)
+
+
+    def _overload(self):
+        self.overloaded = True
+        if (self.policy.action == "pause"
+            and getattr(self.port, "pauseProducing", None) is not None):
+            self._paused = True
+            self.pauses += 1
+            self.port.pauseProducing()
+
+
+    def _recover(self):
+        self.overloaded = False
+        if self._paused:
+            self._paused = False
+            self.port.resumeProducing()
+        if self._listener._queued:
+            self._listener._startQueued()
+
+
+    def _shedQueued(self, before):
+        """
+        Close the queued connections which were queued before C{before}.
+        """
+        listener = self._listener
+        shed = False
+        while listener._queued:
+            protocol, queuedAt = next(iter(listener._queued.items()))
+            if queuedAt > before:
+                break
+            del listener._queued[protocol]
+            self.shed += 1
+            shed = True
+            self._turnAway(protocol)
+        if shed:
+            listener._checkIdle()
@@ -0,0 +1,115 @@
+"""
+Greenlet integration with asyncio.
+
+L{blockOnAwaitable} is L{corotwine.defer.blockOn} for asyncio coroutines and
+futures, so greenlet handlers can use asyncio libraries directly::
+
+    def handler(transport):
+        row = blockOnAwaitable(pool.fetchrow("SELECT ..."))
+        transport.write(row["name"])
+
+L{futureGreenlet} is L{corotwine.defer.deferredGreenlet} for asyncio code
+which wants to call greenlet functions: the decorated function returns an
+asyncio future, which coroutines can await.
+
+Both need the asyncio event loop and the Twisted reactor to be running in
+the same thread, which they are under Twisted's asyncio reactor.  Install it
+before anything imports C{twisted.internet.reactor}::
+
+    from twisted.internet import asyncioreactor
+    asyncioreactor.install()
+
+    from twisted.internet import reactor
+    gListenTCP(8080, handler)
+    reactor.run()
+
+Everything else in Corotwine, such as L{corotwine.protocol.gListenTCP},
+works under that reactor as under any other.
+
+This module needs Python 3 and a version of Twisted with
+C{twisted.internet.asyncioreactor}.
+"""
+
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.python.failure import Failure
+from twisted.python.util import mergeFunctionMetadata
+
+from corotwine.defer import blockOn, deferredGreenlet
+
+
+__all__ = ["blockOnAwaitable", "futureGreenlet"]
+
+
+def _deferredFromFuture(future):
+    """
+    Return a L{Deferred} which fires with the result of an asyncio future.
+    If the future is cancelled, the L{Deferred} fails with
+    L{CancelledError}.
+    """
+    d = Deferred()
+    def done(future):
+        if future.cancelled():
+            d.errback(Failure(CancelledError()))
+        elif future.exception() is not None:
+            exception = future.exception()
+            d.errback(Failure(exception, type(exception),
+                              getattr(exception, "__traceback__", None)))
+        else:
+            d.callback(future.result())
+    future.add_done_callback(done)
+    return d
+
+
+
+def _futureFromDeferred(d, loop):
+    """
+    Return an asyncio future, attached to C{loop}, which gets the result of
+    a L{Deferred}.  The L{Deferred}'s result is dropped if the future has
+    been cancelled.
+    """
+    future = loop.create_future()
+    def callback(result):
+        if not future.cancelled():
+            future.set_result(result)
+    def errback(failure):
+        if not future.cancelled():
+            future.set_exception(failure.value)
+    d.addCallbacks(callback, errback)
+    return future
+
+
+
+def blockOnAwaitable(awaitable, loop=None):
+    """
+    Wait for an asyncio coroutine, future or other awaitable to finish, and
+    return its result directly.
+
+    This function must be called from a non-reactor greenlet.
+
+    @param loop: The event loop to run a coroutine on.  Defaults to the
+        current one.
+
+    @return: The result of the awaitable.
+    @raise: The exception that the awaitable raised, or
+        L{twisted.internet.defer.CancelledError} if it was cancelled.
+    """
+    import asyncio
+    return blockOn(_deferredFromFuture(
+        asyncio.ensure_future(awaitable, loop=loop)))
+
+
+
+def futureGreenlet(gfunction):
+    """
+    Decorate a function which will use greenlets to do context switching so
+    that it returns an asyncio future, attached to the current event loop,
+    as L{corotwine.defer.deferredGreenlet} makes it return a L{Deferred}.
+
+    Cancelling the future does not stop the greenlet.
+    """
+    import asyncio
+    gfunction = deferredGreenlet(gfunction)
+    def inner(*args, **kwargs):
+        return _futureFromDeferred(gfunction(*args, **kwargs),
+                                   asyncio.get_event_loop())
+    return mergeFunctionMetadata(gfunction, inner)
@@ -0,0 +1,40 @@
+"""
+An AMP example, to show off deferredGreenlet.  It is kept apart from
+L{corotwine.examples} because L{twisted.protocols.amp} and
+L{twisted.web.client} take longer to import than the rest of Corotwine.
+"""
+
+from twisted.protocols.amp import AMP, Command, String
+from twisted.web.client import Agent, readBody
+
+from corotwine.defer import blockOn, deferredGreenlet
+
+
+class FetchGoogle(Command):
+    arguments = []
+    response = [("google", String())]
+
+class GoogleGetter(AMP):
+    @FetchGoogle.responder
+    @deferredGreenlet
+    def fetchGoogle(self):
+        from twisted.internet import reactor
+        response = blockOn(
+            Agent(reactor).request(b"GET", b"http://google.com/"))
+        return {"google": blockOn(readBody(response))}
+
+
+
+## Client
+
+def googleAMPClient():
+    from twisted.internet import reactor
+    from twisted.internet.protocol import ClientCreator
+    cc = ClientCreator(reactor, AMP)
+    ampConnection = blockOn(cc.connectTCP("localhost", 1030))
+    result = blockOn(ampConnection.callRemote(FetchGoogle))
+    if b"I'm Feeling Lucky" in result["google"]:
+        print("Google AMP Client test succeeded")
+    else:
+        print("Google AMP client test failed :-(")
+    ampConnection.transport.loseConnection()
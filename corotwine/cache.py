@@ -0,0 +1,274 @@
+"""
+A single-flight cache for greenlet functions.
+
+When many greenlets ask for the same thing at once, L{cached} makes only the
+first of them call the function; the others wait for its result, and then
+it is remembered for a while::
+
+    @cached(ttl=30, maxsize=1000)
+    def getUser(userID):
+        return blockOn(database.runQuery("SELECT ...", (userID,)))
+
+Functions decorated with L{corotwine.defer.deferredGreenlet}, or any other
+function returning a L{Deferred}, can be cached too, in which case the
+cached function returns a L{Deferred} as well::
+
+    @cached(ttl=30)
+    @deferredGreenlet
+    def getUser(userID):
+        ...
+
+Exceptions are passed to every caller waiting for the call which raised
+them, but are only remembered if C{negativeTTL} is given.  The exceptions
+which are thrown into a greenlet to interrupt it, such as the
+L{CancelledError} of a L{corotwine.hedge.Hedger}, C{GreenletExit}, and the
+L{ConnectionDone} of a handler whose connection is closed, are different:
+they belong to the caller whose greenlet was interrupted, not to the call,
+so they are raised only to that caller and never remembered, and one of
+the callers waiting makes the call again.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.internet.error import ConnectionClosed
+from twisted.python.failure import Failure
+from twisted.python.util import mergeFunctionMetadata
+
+from corotwine import greenlet, MAIN
+from corotwine.defer import blockOn
+
+
+__all__ = ["cached", "Cache"]
+
+
+# Fired into the waiters of a call which was interrupted, to make them call
+# again.
+_RETRY = object()
+
+
+class Cache(object):
+    """
+    The results of a function, by its arguments.
+
+    @ivar function: The function whose results are cached.
+    @ivar ttl: The number of seconds a result is remembered for, or C{None}
+        to remember it until it is evicted.
+    @ivar maxsize: The most results to remember, or C{None} for no limit.
+        The least recently used is evicted to make room for a new one.
+    @ivar negativeTTL: The number of seconds an exception is remembered for,
+        or C{None} not to remember exceptions.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider
+        which results expire by.
+    @ivar hits: The number of calls answered from the cache.
+    @ivar misses: The number of calls which called the function.
+    @ivar shared: The number of calls which waited for another caller's call
+        of the function.
+    @ivar interruptions: The exceptions which, raised by a blocking call of
+        the function, are taken to have been thrown into the calling
+        greenlet rather than raised by the function; see L{corotwine.cache}.
+    @ivar _key: A function taking the arguments of a call and returning the
+        key to cache its result under.
+    @ivar _entries: An L{OrderedDict} mapping keys to C{(expires, result)},
+        where C{result} is a L{Failure} for an exception, least recently used
+        first.
+    @ivar _pending: A C{dict} mapping the keys of calls in progress to lists
+        of the L{Deferred}s waiting for them.
+    @ivar _returnsDeferred: Whether L{function} returns L{Deferred}s, or
+        C{None} until it is first known.
+    """
+
+    interruptions = (CancelledError, greenlet.GreenletExit, ConnectionClosed)
+
+    def __init__(self, function, ttl=None, maxsize=128, negativeTTL=None,
+                 clock=None, key=None):
+        """
+        @param key: See L{_key}.  Defaults to using the positional arguments
+            and the sorted keyword arguments, which must be hashable.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if key is None:
+            key = _defaultKey
+        self.function = function
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.negativeTTL = negativeTTL
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._key = key
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._returnsDeferred = None
+
+
+    def __call__(self, *args, **kwargs):
+        """
+        Return the result of calling L{function} with these arguments, from
+        the cache if it is there.  If L{function} returns L{Deferred}s, a new
+        L{Deferred} is returned.
+        """
+        key = self._key(args, kwargs)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            expires, result = entry
+            if expires is None or expires > self.clock.seconds():
+                self._entries[key] = entry
+                self.hits += 1
+                return self._answer(result)
+        if key in self._pending:
+            self.shared += 1
+            d = Deferred()
+            self._pending[key].append(d)
+            if self._returnsDeferred:
+                return d.addCallback(self._retry, args, kwargs)
+            # A function which returns Deferreds returns before anyone
+            # else can call it, so a call in progress whose kind isn't
+            # known yet is a blocking one.
+            return self._retry(blockOn(d), args, kwargs)
+        self.misses += 1
+        self._pending[key] = []
+        try:
+            result = self.function(*args, **kwargs)
+        except self.interruptions:
+            self._returnsDeferred = False
+            self._wake(self._pending.pop(key), _RETRY)
+            raise
+        except:
+            self._returnsDeferred = False
+            self._finished(key, Failure())
+            raise
+        if isinstance(result, Deferred):
+            self._returnsDeferred = True
+            d = Deferred()
+            self._pending[key].append(d)
+            result.addBoth(lambda result: self._finished(key, result))
+            return d
+        self._returnsDeferred = False
+        self._finished(key, result)
+        return result
+
+
+    def _retry(self, result, args, kwargs):
+        """
+        Call again if the call waited for was interrupted, and otherwise
+        return its result.
+        """
+        if result is _RETRY:
+            return self(*args, **kwargs)
+        return result
+
+
+    def _answer(self, result):
+        """
+        Return a cached result in the way L{function} would.
+        """
+        if self._returnsDeferred:
+            d = Deferred()
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+            return d
+        if isinstance(result, Failure):
+            result.raiseException()
+        return result
+
+
+    def _finished(self, key, result):
+        """
+        Remember the result of a call, and pass it to the callers waiting
+        for it.  They are woken from the reactor's greenlet, so that a
+        greenlet which finished the call isn't left suspended when they
+        block.
+        """
+        waiters = self._pending.pop(key)
+        if isinstance(result, Failure):
+            ttl = self.negativeTTL
+            if ttl is not None:
+                self._remember(key, ttl, result)
+        else:
+            self._remember(key, self.ttl, result)
+        self._wake(waiters, result)
+
+
+    def _wake(self, waiters, result):
+        """
+        Fire the L{Deferred}s of the callers waiting for a call.
+        """
+        if waiters:
+            if greenlet.getcurrent() is MAIN:
+                _fire(waiters, result)
+            else:
+                self.clock.callLater(0, _fire, waiters, result)
+
+
+    def _remember(self, key, ttl, result):
+        if self.maxsize is not None:
+            if self.maxsize <= 0:
+                return
+            if key not in self._entries and (
+                    len(self._entries) >= self.maxsize):
+                self._entries.popitem(last=False)
+        expires = None
+        if ttl is not None:
+            expires = self.clock.seconds() + ttl
+        self._entries[key] = (expires, result)
+
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Forget the result of calling L{function} with these arguments.
+        """
+        self._entries.pop(self._key(args, kwargs), None)
+
+
+    def clear(self):
+        """
+        Forget all results.
+        """
+        self._entries.clear()
+
+
+
+def _defaultKey(args, kwargs):
+    if kwargs:
+        return args, tuple(sorted(kwargs.items()))
+    return args
+
+
+
+def _fire(waiters, result):
+    for d in waiters:
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+
+def cached(ttl=None, maxsize=128, negativeTTL=None, clock=None, key=None):
+    """
+    Decorate a greenlet function, or a function returning L{Deferred}s, so
+    that concurrent calls with the same arguments share one call of it, and
+    results are remembered.
+
+    The decorated function has a C{cache} attribute, the L{Cache}, with
+    which results can be invalidated and hit rates found.
+
+    @param ttl: See L{Cache.ttl}.
+    @param maxsize: See L{Cache.maxsize}.
+    @param negativeTTL: See L{Cache.negativeTTL}.
+    @param clock: See L{Cache.clock}.  Defaults to the reactor.
+    @param key: See L{Cache._key}.
+    """
+    def decorator(function):
+        cache = Cache(function, ttl, maxsize, negativeTTL, clock, key)
+        def inner(*args, **kwargs):
+            return cache(*args, **kwargs)
+        inner = mergeFunctionMetadata(function, inner)
+        inner.cache = cache
+        return inner
+    return decorator
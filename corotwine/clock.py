@@ -2,8 +2,8 @@
 Time manipulation for greenlets.
 """
 
-from corotwine import greenlet
-from corotwine.protocol import MAIN
+from corotwine import greenlet, MAIN
+from corotwine.metrics import runtime as _metrics
 
 def wait(seconds, clock=None):
     """
@@ -18,4 +18,9 @@ def wait(seconds, clock=None):
         from twisted.internet import reactor as clock
     thisGreenlet = greenlet.getcurrent()
     clock.callLater(seconds, thisGreenlet.switch)
-    return MAIN.switch()
+    if not _metrics.enabled:
+        return MAIN.switch()
+    due = clock.seconds() + seconds
+    result = MAIN.switch()
+    _metrics.lagSeconds.observe(max(0.0, clock.seconds() - due))
+    return result
@@ -0,0 +1,307 @@
+"""
+Streaming compression for greenlet transports.
+
+A L{CompressedTransport} wraps a L{corotwine.protocol.GreenletTransport}, or
+anything else with C{read} and C{write} methods, and compresses what is
+written to it and decompresses what is read from it::
+
+    def handler(transport):
+        transport = CompressedTransport(transport, "gzip")
+        request = transport.read()
+        transport.write(bigResponse)
+        transport.close()
+
+Compressing a large payload in one go would stop the reactor for as long as
+it takes, so data is compressed in chunks of C{chunkSize} bytes, and the
+greenlet lets the reactor run between chunks.  Each chunk's output is
+written before the next is compressed, so a writer whose peer is slow is
+blocked by the transport's write backpressure instead of buffering the
+whole compressed payload.  Payloads of C{threadThreshold} bytes or more can
+instead be compressed in the reactor's thread pool, while the greenlet
+waits.
+
+Decompression is bounded by its output rather than its input, since a few
+kilobytes of compressed data can expand to gigabytes: each C{read} returns
+at most C{chunkSize} bytes, and the compressed data left over waits in the
+decompressor until the next, which lets the reactor run before carrying on
+with it.
+
+The formats are C{"zlib"}, C{"gzip"} and C{"deflate"} (raw deflate, without
+a header), C{"bz2"} where the C{bz2} module is available, and C{"lzma"}
+where the C{lzma} module is.
+"""
+
+import zlib
+
+from twisted.internet.error import ConnectionDone
+
+from corotwine.clock import wait
+from corotwine.defer import blockOn
+
+
+__all__ = ["CompressedTransport", "FORMATS"]
+
+
+def _zlibFormat(wbits):
+    def compressor(level):
+        return zlib.compressobj(level, zlib.DEFLATED, wbits)
+    def decompressor():
+        return zlib.decompressobj(wbits)
+    return compressor, decompressor, True
+
+
+FORMATS = {
+    "zlib": _zlibFormat(15),
+    "gzip": _zlibFormat(31),
+    "deflate": _zlibFormat(-15),
+}
+"""
+A C{dict} mapping the names of the available formats to C{(compressor,
+decompressor, flushable)}: a function taking a compression level and
+returning a compression object, a function returning a decompression object,
+and whether the compression object supports L{zlib.Z_SYNC_FLUSH}.
+"""
+
+try:
+    import bz2
+except ImportError:
+    pass
+else:
+    FORMATS["bz2"] = (
+        lambda level: bz2.BZ2Compressor(min(max(level, 1), 9)),
+        bz2.BZ2Decompressor, False)
+
+try:
+    import lzma
+except ImportError:
+    pass
+else:
+    FORMATS["lzma"] = (
+        lambda level: lzma.LZMACompressor(preset=min(max(level, 0), 9)),
+        lzma.LZMADecompressor, False)
+
+
+
+class CompressedTransport(object):
+    """
+    A transport which compresses what is written to it, and decompresses
+    what is read from it.
+
+    @ivar transport: The wrapped transport.
+    @ivar format: The name of the format, a key of L{FORMATS}.
+    @ivar chunkSize: The most bytes compressed between letting the reactor
+        run, and the most decompressed bytes returned by each L{read}.
+    @ivar threadThreshold: The size, in bytes, from which a payload is
+        compressed in the reactor's thread pool instead, or C{None} never to
+        use it.
+    @ivar autoFlush: Whether to flush after every write.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider
+        with which to let the reactor run between chunks.
+    @ivar reactor: The reactor whose thread pool is used.
+    @ivar yields: The number of times the reactor was let run between
+        chunks.
+    @ivar _finished: Whether the end of the compressed stream has been
+        written.
+    @ivar _pending: The exception to raise from the next L{read}, once the
+        decompressor's remaining output has been returned, or C{None}.
+    @ivar _input: The compressed data read from the wrapped transport which
+        has not yet been given to the decompressor.
+    @ivar _tail: The compressed data which a zlib decompressor left
+        unconsumed because its output reached C{chunkSize}.
+    """
+
+    def __init__(self, transport, format="zlib", level=6, chunkSize=65536,
+                 threadThreshold=None, autoFlush=False, clock=None,
+                 reactor=None):
+        """
+        @param transport: See L{transport}.
+        @param format: See L{format}.
+        @param level: The compression level, from C{1} (fastest) to C{9}
+            (smallest).
+        @param chunkSize: See L{chunkSize}.
+        @param threadThreshold: See L{threadThreshold}.
+        @param autoFlush: See L{autoFlush}.
+        @param clock: See L{clock}.  Defaults to the reactor.
+        @param reactor: See L{reactor}.  Defaults to the global reactor.
+
+        @raise ValueError: If C{format} is not available.
+        """
+        if format not in FORMATS:
+            raise ValueError("Unknown compression format %r" % (format,))
+        if reactor is None:
+            from twisted.internet import reactor
+        if clock is None:
+            clock = reactor
+        compressor, decompressor, self._flushable = FORMATS[format]
+        if autoFlush and not self._flushable:
+            raise ValueError("%s streams can't be flushed" % (format,))
+        self.transport = transport
+        self.format = format
+        self.chunkSize = chunkSize
+        self.threadThreshold = threadThreshold
+        self.autoFlush = autoFlush
+        self.clock = clock
+        self.reactor = reactor
+        self.yields = 0
+        self._compressor = compressor(level)
+        self._decompressor = decompressor()
+        self._finished = False
+        self._pending = None
+        self._input = b""
+        self._tail = b""
+
+
+    def _yield(self):
+        """
+        Let the reactor run before carrying on.
+        """
+        self.yields += 1
+        wait(0, self.clock)
+
+
+    def _inThread(self, function, data):
+        """
+        Call C{function} with C{data} in the reactor's thread pool, and
+        return its result when it is done.
+        """
+        from twisted.internet.threads import deferToThreadPool
+        return blockOn(deferToThreadPool(
+            self.reactor, self.reactor.getThreadPool(), function, data))
+
+
+    def _chunks(self, function, data):
+        """
+        Call C{function} with each chunk of C{data} in turn, letting the
+        reactor run in between, or with all of it in the thread pool if it
+        is big enough, and generate the non-empty results.
+        """
+        if (self.threadThreshold is not None
+            and len(data) >= self.threadThreshold):
+            result = self._inThread(function, data)
+            if result:
+                yield result
+            return
+        size = self.chunkSize
+        view = memoryview(data)
+        for offset in range(0, len(data), size):
+            if offset:
+                self._yield()
+            result = function(view[offset:offset + size].tobytes())
+            if result:
+                yield result
+
+
+    def write(self, data):
+        """
+        Compress C{data} and write it to the wrapped transport.
+
+        This may block while the reactor runs between chunks, while the
+        wrapped transport's writes are paused, or while a thread compresses
+        the data.
+        """
+        if self._finished:
+            raise ValueError("Write after the end of the compressed stream")
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+        for compressed in self._chunks(self._compressor.compress, data):
+            self.transport.write(compressed)
+        if self.autoFlush:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Write everything compressed so far, so that the peer can decompress
+        all the data written, without ending the stream.
+
+        @raise ValueError: If the format has no way to do that.
+        """
+        if not self._flushable:
+            raise ValueError("%s streams can't be flushed" % (self.format,))
+        if self._finished:
+            return
+        compressed = self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed:
+            self.transport.write(compressed)
+
+
+    def finish(self):
+        """
+        Write the end of the compressed stream.  Nothing more can be written
+        afterwards.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        compressed = self._compressor.flush()
+        if compressed:
+            self.transport.write(compressed)
+
+
+    def read(self):
+        """
+        Block until some decompressed data is available, and return at most
+        L{chunkSize} bytes of it.
+
+        @raise ConnectionDone: Or whatever else the wrapped transport's
+            C{read} raises, once the data before it has been returned.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            raise pending
+        while True:
+            if self._decompressing():
+                self._yield()
+            else:
+                try:
+                    self._input = memoryview(self.transport.read())
+                except ConnectionDone as e:
+                    rest = b""
+                    if hasattr(self._decompressor, "flush"):
+                        rest = self._decompressor.flush()
+                    if not rest:
+                        raise
+                    self._pending = e
+                    return rest
+            data = self._decompress()
+            if data:
+                return data
+
+
+    def _decompressing(self):
+        """
+        Return whether the decompressor has compressed data left over from
+        the last read, which can produce more output without reading again.
+        """
+        decompressor = self._decompressor
+        if self._input or self._tail:
+            return True
+        needsInput = getattr(decompressor, "needs_input", True)
+        return not (needsInput or decompressor.eof)
+
+
+    def _decompress(self):
+        """
+        Decompress at most L{chunkSize} bytes of output, giving the
+        decompressor at most L{chunkSize} bytes of new input.
+        """
+        decompressor = self._decompressor
+        size = self.chunkSize
+        if self._tail:
+            data = self._tail
+        elif getattr(decompressor, "needs_input", True):
+            data, self._input = self._input[:size], self._input[size:]
+        else:
+            data = b""
+        output = decompressor.decompress(data, size)
+        self._tail = getattr(decompressor, "unconsumed_tail", b"")
+        return output
+
+
+    def close(self):
+        """
+        Write the end of the compressed stream, and close the wrapped
+        transport.
+        """
+        self.finish()
+        self.transport.close()
@@ -7,8 +7,10 @@ If an API expects a Deferred from a function you want to implement, see the
 decorator L{deferredGreenlet}.
 """
 
-from corotwine.protocol import MAIN
-from corotwine import greenlet
+from corotwine import greenlet, MAIN
+from corotwine.local import _inheritable, _install, _clear
+from corotwine.metrics import runtime as _metrics
+from corotwine import scheduler as _scheduler
 
 from twisted.python.failure import Failure
 from twisted.python.util import mergeFunctionMetadata
@@ -21,27 +23,51 @@ def blockOn(d):
 
     This function must be called from a non-reactor greenlet.
 
+    If a L{corotwine.scheduler.Scheduler} is installed, the greenlet is
+    queued when the Deferred fires, instead of being switched to directly.
+    If the greenlet is resumed some other way first, for example by an
+    exception thrown into it, the Deferred's result is dropped.
+
     @return: The result of the Deferred.
     @raise: The exception that the Deferred was fired with.
     """
     current = greenlet.getcurrent()
     synchronous = []
-    def cb(result):
+    # Not empty while the greenlet is blocked in this call, so that a result
+    # which arrives after something else has resumed it is dropped, instead
+    # of being switched into whatever it is waiting for next.
+    blocked = []
+    def resume(result):
+        if not blocked:
+            return None
+        del blocked[:]
+        if isinstance(result, Failure):
+            return result.throwExceptionIntoGenerator(current)
+        return current.switch(result)
+    def fired(result):
         if greenlet.getcurrent() is current:
             synchronous.append(result)
+        elif _scheduler._current is not None:
+            _scheduler._current.call(lambda: resume(result),
+                                     _scheduler.getPriority(current))
         else:
-            current.switch(result)
-    def eb(failure):
-        if greenlet.getcurrent() is current:
-            synchronous.append(failure)
-        else:
-            failure.throwExceptionIntoGenerator(current)
-    d.addCallbacks(cb, eb)
+            return resume(result)
+    d.addBoth(fired)
     if synchronous:
         if isinstance(synchronous[0], Failure):
             synchronous[0].raiseException()
         return synchronous[0]
-    return MAIN.switch()
+    blocked.append(True)
+    if _metrics.enabled:
+        start = _metrics.seconds()
+    else:
+        start = None
+    try:
+        return MAIN.switch()
+    finally:
+        del blocked[:]
+        if start is not None:
+            _metrics.blockOnSeconds.observe(_metrics.seconds() - start)
 
 from twisted.internet.defer import succeed
 
@@ -52,6 +78,9 @@ def deferredGreenlet(gfunction):
 
     This is a helper for writing functions to be used with frameworks which
     expect Deferreds to be returned.
+
+    The new greenlet inherits the caller's inheriting
+    L{corotwine.local.GreenletLocal} attributes.
     """
     # We need to know when gfunction is complete, i.e., when it actually
     # returns from its python frame.  There's no way to get a callback when
@@ -61,11 +90,17 @@ def deferredGreenlet(gfunction):
     # function.  It calls gfunction and fires the deferred with the result.
     def inner(*args, **kwargs):
         d = Deferred()
+        inherited = _inheritable()
         def intermediateGreenletFunction():
+            _install(inherited)
             try:
-                d.callback(gfunction(*args, **kwargs))
+                result = gfunction(*args, **kwargs)
             except:
+                _clear()
                 d.errback()
+            else:
+                _clear()
+                d.callback(result)
         greenlet(intermediateGreenletFunction).switch()
         return d
     return mergeFunctionMetadata(gfunction, inner)
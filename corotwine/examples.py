@@ -5,11 +5,9 @@ code, not the API docs.
 import string, random
 
 from twisted.internet.error import ConnectionClosed
-from twisted.protocols.amp import AMP, Command, String
-from twisted.web.client import getPage
 
 from corotwine.protocol import gListenTCP, gConnectTCP, LineBuffer
-from corotwine.defer import blockOn, deferredGreenlet
+from corotwine.defer import blockOn
 from corotwine import greenlet
 
 
@@ -30,16 +28,18 @@ def discard(transport):
 
 
 def qotd(transport):
-    transport.write("An apple a day keeps the doctor away.\r\n")
+    transport.write(b"An apple a day keeps the doctor away.\r\n")
 
 
+_LETTERS = string.ascii_letters.encode("ascii")
+
 def chargen(transport):
     # Sample of efficient streaming.  transport.write switches back to the
     # reactor greenlet when buffers are full.
     while 1:
         try:
-            transport.write(''.join(random.choice(string.letters)
-                                    for i in range(1024)))
+            transport.write(bytes(random.choice(_LETTERS)
+                                  for i in range(1024)))
         except ConnectionClosed:
             return
 
@@ -64,22 +64,17 @@ class Chat(object):
 
 
 def fetchGoogle(transport):
-    result = blockOn(getPage("http://google.com/"))
-    transport.write(result)
-
-
+    # twisted.web is only imported when it is used, so that importing this
+    # module stays cheap.
+    from twisted.internet import reactor
+    from twisted.web.client import Agent, readBody
+    response = blockOn(Agent(reactor).request(b"GET", b"http://google.com/"))
+    transport.write(blockOn(readBody(response)))
 
-## And an amp example, to show off deferredGreenlet
 
-class FetchGoogle(Command):
-    arguments = []
-    response = [("google", String())]
 
-class GoogleGetter(AMP):
-    @FetchGoogle.responder
-    @deferredGreenlet
-    def fetchGoogle(self):
-        return {"google": blockOn(getPage("http://google.com/"))}
+## And an amp example, to show off deferredGreenlet, is in
+## corotwine.ampexample.
 
 
 
@@ -87,23 +82,11 @@ class GoogleGetter(AMP):
 
 def echoclient():
     transport = gConnectTCP("localhost", 1027)
-    transport.write("Heyo!")
-    if transport.read() == "Heyo!":
-        print "Echo server test succeeded!"
-    else:
-        print "Echo server test failed :-("
-
-
-def googleAMPClient():
-    from twisted.internet.protocol import ClientCreator
-    cc = ClientCreator(reactor, AMP)
-    ampConnection = blockOn(cc.connectTCP("localhost", 1030))
-    result = blockOn(ampConnection.callRemote(FetchGoogle))
-    if "I'm Feeling Lucky" in result["google"]:
-        print "Google AMP Client test succeeded"
+    transport.write(b"Heyo!")
+    if transport.read() == b"Heyo!":
+        print("Echo server test succeeded!")
     else:
-        print "Google AMP client test failed :-("
-    ampConnection.transport.loseConnection()
+        print("Echo server test failed :-(")
 
 
 # Deployment code
@@ -116,6 +99,7 @@ def startServers():
     gListenTCP(1029, fetchGoogle)
 
     from twisted.internet.protocol import Factory
+    from corotwine.ampexample import GoogleGetter
     ampf = Factory()
     ampf.protocol = GoogleGetter
     reactor.listenTCP(1030, ampf)
@@ -134,6 +118,7 @@ if __name__ == '__main__':
     greenlet(echoclient).switch()
 
     # Uncomment to test google thingy.
+    #from corotwine.ampexample import googleAMPClient
     #greenlet(googleAMPClient).switch()
 
     reactor.run()
@@ -0,0 +1,415 @@
+"""
+Hedged and retried requests to replicated backends.
+
+One slow replica can set the tail latency of everything which calls it.  A
+L{Hedger} sends a request to one replica, and if it hasn't answered by the
+time most requests have (the 95th percentile of recent latencies, by
+default), sends it to the next replica as well.  Whichever answers first
+wins, and the other is cancelled.  Requests which fail are retried on the
+next replica after an exponential backoff.  Hedges and retries both spend a
+L{RetryBudget}, so that when every replica is slow or failing, the extra
+load they add stays a small fraction of the total::
+
+    backends = Hedger()
+
+    def fetch(address):
+        transport = gConnectTCP(*address)
+        try:
+            transport.write(b"GET key\\r\\n")
+            return LineBuffer(transport).readLine()
+        finally:
+            transport.close()
+
+    def handler(transport):
+        value = backends.call(fetch, [("db1", 7000), ("db2", 7000)])
+        ...
+
+A request function is called in a greenlet of its own.  When it loses, a
+L{CancelledError} is thrown into it wherever it is blocked, so it should
+clean up in C{finally} blocks, as above.  If it returns a result after
+losing anyway, the result is closed if it has a C{close} method.
+
+The C{hedgeRate} and C{hedgeWinRate} of a L{Hedger} show how often requests
+are hedged, and how often the hedge answered first; if hedges rarely win,
+the percentile is too low.
+"""
+
+from bisect import insort
+from collections import deque
+from itertools import cycle
+
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.python.failure import Failure
+from twisted.python import log
+
+from corotwine import greenlet, MAIN
+from corotwine.defer import blockOn
+from corotwine.clock import wait
+
+
+__all__ = ["Hedger", "RetryBudget"]
+
+
+class RetryBudget(object):
+    """
+    A limit on the extra requests made by hedges and retries, as a fraction
+    of the requests made.
+
+    @ivar ratio: How many hedges or retries each request adds to the budget.
+    @ivar capacity: The most the budget can hold, which is also what it
+        starts with, so that a few retries are allowed before there is
+        traffic to pay for them.
+    @ivar balance: What the budget holds now.
+    """
+
+    def __init__(self, ratio=0.1, capacity=10):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.balance = float(capacity)
+
+
+    def deposit(self):
+        """
+        Record a request, adding L{ratio} to the budget.
+        """
+        self.balance = min(self.capacity, self.balance + self.ratio)
+
+
+    def withdraw(self):
+        """
+        Spend one hedge or retry from the budget.
+
+        @return: Whether the budget had it to spend.
+        """
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+
+class Hedger(object):
+    """
+    Hedging and retrying for requests to one set of replicas.
+
+    @ivar percentile: The percentile of recent latencies after which a
+        request is hedged.
+    @ivar window: The number of recent latencies the percentile is taken
+        over.
+    @ivar minDelay: The fewest seconds to wait before hedging.
+    @ivar maxDelay: The most seconds to wait before hedging, which is also
+        the delay until C{window / 10} latencies are known.
+    @ivar retries: The most times a failed request is retried.
+    @ivar backoff: The seconds to wait before the first retry.  Each
+        further retry waits twice as long as the last.
+    @ivar maxBackoff: The most seconds to wait before a retry.
+    @ivar retryOn: The exception types which are retried.
+    @ivar budget: The L{RetryBudget} which hedges and retries spend.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        measure and wait for time with.
+    @ivar calls: The number of calls of L{call}.
+    @ivar hedges: The number of hedge requests sent.
+    @ivar hedgeWins: The number of hedge requests which answered first.
+    @ivar retried: The number of retries.
+    @ivar budgetExhausted: The number of hedges and retries not made because
+        the budget was spent.
+    @ivar _latencies: The recent latencies, oldest first.
+    @ivar _sorted: The same latencies, sorted.
+    """
+
+    def __init__(self, percentile=95, window=1000, minDelay=0.001,
+                 maxDelay=1.0, retries=2, backoff=0.01, maxBackoff=1.0,
+                 retryOn=(Exception,), budget=None, clock=None):
+        """
+        @param budget: See L{budget}.  Defaults to a new L{RetryBudget}.
+        @param clock: See L{clock}.  Defaults to the reactor.
+        """
+        if budget is None:
+            budget = RetryBudget()
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.percentile = percentile
+        self.window = window
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.retryOn = retryOn
+        self.budget = budget
+        self.clock = clock
+        self.calls = 0
+        self.hedges = 0
+        self.hedgeWins = 0
+        self.retried = 0
+        self.budgetExhausted = 0
+        self._latencies = deque()
+        self._sorted = []
+
+
+    @property
+    def hedgeRate(self):
+        """
+        The fraction of calls which were hedged.
+        """
+        if not self.calls:
+            return 0.0
+        return float(self.hedges) / self.calls
+
+
+    @property
+    def hedgeWinRate(self):
+        """
+        The fraction of hedge requests which answered first.
+        """
+        if not self.hedges:
+            return 0.0
+        return float(self.hedgeWins) / self.hedges
+
+
+    def delay(self):
+        """
+        Return the seconds after which a request is hedged now.
+        """
+        latencies = self._sorted
+        if len(latencies) < max(1, self.window // 10):
+            return self.maxDelay
+        index = min(len(latencies) - 1,
+                    int(len(latencies) * self.percentile / 100.0))
+        return min(self.maxDelay, max(self.minDelay, latencies[index]))
+
+
+    def _observe(self, latency):
+        """
+        Add a latency to the window.
+        """
+        if len(self._latencies) >= self.window:
+            oldest = self._latencies.popleft()
+            self._sorted.remove(oldest)
+        self._latencies.append(latency)
+        insort(self._sorted, latency)
+
+
+    def _spend(self):
+        if self.budget.withdraw():
+            return True
+        self.budgetExhausted += 1
+        return False
+
+
+    def call(self, request, replicas):
+        """
+        Call C{request} with the first of C{replicas}, hedging and retrying
+        it with the next ones as described in L{corotwine.hedge}, and return
+        the first result.
+
+        This function must be called from a non-reactor greenlet.
+
+        @param request: A greenlet function taking a replica, such as an
+            address to connect to.
+        @param replicas: A list of the replicas to send the request to, in
+            order.  Hedges and retries go round them.
+
+        @raise: The exception of the last attempt, if none succeeded.  An
+            exception thrown into the calling greenlet, such as the
+            L{ConnectionDone} thrown into a handler whose server is shutting
+            down, cancels the attempts in progress and is raised without a
+            retry.
+        """
+        assert greenlet.getcurrent() is not MAIN, \
+            "Don't call Hedger.call from the reactor greenlet."
+        self.calls += 1
+        self.budget.deposit()
+        hedge = len(replicas) > 1
+        replicas = cycle(replicas)
+        attempt = 0
+        while True:
+            race = _Race(self, request, replicas, hedge)
+            try:
+                return blockOn(race.start())
+            except self.retryOn:
+                if not race.lost:
+                    race.cancel()
+                    raise
+                if attempt >= self.retries or not self._spend():
+                    raise
+            except:
+                race.cancel()
+                raise
+            attempt += 1
+            self.retried += 1
+            wait(min(self.maxBackoff, self.backoff * 2 ** (attempt - 1)),
+                 self.clock)
+
+
+
+class _Race(object):
+    """
+    One attempt at a request, and its hedge.
+
+    Attempts are started, cancelled and reported from the reactor's
+    greenlet, never from each other's, so that none of them is left
+    suspended by another switching away.
+
+    @ivar _attempts: A C{dict} mapping the greenlets of the attempts in
+        progress to whether they are the hedge.
+    @ivar _timer: The delayed call which will start the hedge, or C{None}.
+    @ivar _failure: The L{Failure} of the last attempt which failed.
+    @ivar _result: The L{Deferred} returned by L{start}, or C{None} once
+        the race is decided.
+    @ivar _delivery: The delayed call which will fire the L{Deferred}
+        returned by L{start} once the race is decided, or C{None}.
+    @ivar lost: Whether the L{Deferred} returned by L{start} has failed with
+        the failure of the last attempt.
+    """
+
+    def __init__(self, hedger, request, replicas, hedge):
+        """
+        @param replicas: An iterator of the replicas to send attempts to.
+        @param hedge: Whether to hedge the first attempt.
+        """
+        self._hedger = hedger
+        self._request = request
+        self._replicas = replicas
+        self._hedge = hedge
+        self._attempts = {}
+        self._timer = None
+        self._failure = None
+        self._result = Deferred()
+        self._delivery = None
+        self.lost = False
+
+
+    def start(self):
+        clock = self._hedger.clock
+        result = self._result
+        clock.callLater(0, self._attempt, False)
+        if self._hedge:
+            self._timer = clock.callLater(
+                self._hedger.delay(), self._hedgeDue)
+        return result
+
+
+    def _hedgeDue(self):
+        """
+        Start the hedge, if the budget allows.  If the first attempt has
+        already failed and it doesn't, the race is lost.
+        """
+        self._timer = None
+        if self._result is None:
+            return
+        if self._hedger._spend():
+            self._hedger.hedges += 1
+            self._attempt(True)
+        elif not self._attempts:
+            self._decide(self._failure)
+
+
+    def _attempt(self, isHedge):
+        """
+        Start an attempt on the next replica.
+        """
+        replica = next(self._replicas)
+        g = greenlet(self._run, MAIN)
+        self._attempts[g] = isHedge
+        g.switch(replica, self._hedger.clock.seconds())
+
+
+    def _run(self, replica, started):
+        """
+        Run an attempt, in its own greenlet.
+        """
+        g = greenlet.getcurrent()
+        try:
+            result = self._request(replica)
+        except:
+            self._finished(g, Failure())
+        else:
+            if self._result is None:
+                if hasattr(result, "close"):
+                    result.close()
+                return
+            self._hedger._observe(self._hedger.clock.seconds() - started)
+            self._finished(g, result)
+
+
+    def _finished(self, g, result):
+        """
+        Decide the race with an attempt's result, unless it failed while
+        another attempt may still succeed.
+        """
+        isHedge = self._attempts.pop(g)
+        if self._result is None:
+            return
+        if isinstance(result, Failure):
+            self._failure = result
+            if self._attempts:
+                return
+            if self._timer is not None:
+                # Don't wait for the hedge's delay to try another replica.
+                self._timer.cancel()
+                self._timer = self._hedger.clock.callLater(0, self._hedgeDue)
+                return
+        elif isHedge:
+            self._hedger.hedgeWins += 1
+        self._decide(result)
+
+
+    def _decide(self, result):
+        """
+        Cancel the other attempts, and fire the L{Deferred} returned by
+        L{start} with C{result}.
+        """
+        d, self._result = self._result, None
+        clock = self._hedger.clock
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for loser in list(self._attempts):
+            clock.callLater(0, _cancel, loser)
+        self._delivery = clock.callLater(0, self._deliver, d, result)
+
+
+    def _deliver(self, d, result):
+        self._delivery = None
+        if isinstance(result, Failure):
+            self.lost = True
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+    def cancel(self):
+        """
+        Give up on the race without firing the L{Deferred} returned by
+        L{start}, because the greenlet waiting for it has been interrupted.
+        The attempts in progress are cancelled, and a result which has not
+        been delivered yet is closed if it has a C{close} method.
+        """
+        clock = self._hedger.clock
+        if self._result is not None:
+            self._result = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            for attempt in list(self._attempts):
+                clock.callLater(0, _cancel, attempt)
+        elif self._delivery is not None:
+            delivery, self._delivery = self._delivery, None
+            delivery.cancel()
+            result = delivery.args[1]
+            if not isinstance(result, Failure) and hasattr(result, "close"):
+                result.close()
+
+
+
+def _cancel(g):
+    """
+    Throw L{CancelledError} into the greenlet of an attempt which lost.
+    """
+    if g.dead:
+        return
+    try:
+        g.throw(CancelledError())
+    except:
+        log.err(None, "Cancelled hedged request raised:")
@@ -0,0 +1,143 @@
+"""
+Greenlet-local storage.
+
+A L{GreenletLocal} is like a C{threading.local}, but each greenlet sees its
+own attributes::
+
+    request = GreenletLocal()
+
+    def handler(transport):
+        request.id = newRequestID()
+        ...
+        log.msg("done", requestID=request.id)
+
+The attributes are kept in a C{contextvars} variable, which greenlet gives
+each greenlet its own value of (see C{greenlet.gr_context}), rather than in
+a dictionary keyed by greenlets, so they are freed with the greenlet, and
+reading one costs a single variable lookup and two dictionary lookups.  The
+handlers started by L{corotwine.protocol.gListenTCP} and the greenlets
+started by L{corotwine.defer.deferredGreenlet} drop them as soon as they
+finish.
+
+A local created with C{inherit=True} is copied into the greenlets which
+those start, so that, for example, a tracing ID set before calling a
+C{deferredGreenlet} function is seen inside it.  Connection handlers inherit
+from the greenlet which started listening.  To pass them on to greenlets of
+your own, wrap their functions with L{inheritLocals}.
+"""
+
+from contextvars import ContextVar
+
+
+__all__ = ["GreenletLocal", "inheritLocals"]
+
+
+# Maps each GreenletLocal to a dict of its attributes, in each greenlet.
+_locals = ContextVar("corotwine.local")
+_get = _locals.get
+
+
+class GreenletLocal(object):
+    """
+    An object whose attributes have a different value in each greenlet.
+
+    A greenlet which has not set an attribute gets C{AttributeError} for it,
+    as with any other object.
+
+    @ivar _inherit: Whether new greenlets get a copy of their parent's
+        attributes; see L{corotwine.local}.
+    """
+
+    __slots__ = ["_inherit"]
+
+    def __init__(self, inherit=False):
+        object.__setattr__(self, "_inherit", inherit)
+
+
+    def __getattribute__(self, name):
+        # Look in the greenlet first, since that's what this is for, and
+        # going through __getattr__ would mean failing the normal lookup of
+        # every attribute first.  Both an unset variable and a missing key
+        # raise LookupError.
+        try:
+            return _get()[self][name]
+        except LookupError:
+            return object.__getattribute__(self, name)
+
+
+    def __setattr__(self, name, value):
+        try:
+            locals = _get()
+        except LookupError:
+            locals = {}
+            _locals.set(locals)
+        try:
+            locals[self][name] = value
+        except KeyError:
+            locals[self] = {name: value}
+
+
+    def __delattr__(self, name):
+        try:
+            del _get()[self][name]
+        except LookupError:
+            raise AttributeError(name)
+
+
+
+def _inheritable():
+    """
+    Return a copy of the current greenlet's attributes of inheriting
+    L{GreenletLocal}s, as a C{dict} mapping each local to a C{dict} of its
+    attributes, or C{None} if there are none.
+    """
+    locals = _get(None)
+    if not locals:
+        return None
+    inherited = {}
+    for local, attributes in locals.items():
+        if local._inherit:
+            inherited[local] = dict(attributes)
+    return inherited or None
+
+
+
+def _install(inherited):
+    """
+    Give the current greenlet a copy of C{inherited}, as returned by
+    L{_inheritable}.
+    """
+    if inherited:
+        _locals.set(dict(
+            (local, dict(attributes))
+            for (local, attributes) in inherited.items()))
+
+
+
+def _clear():
+    """
+    Drop the current greenlet's local attributes.
+    """
+    if _get(None):
+        _locals.set({})
+
+
+
+def inheritLocals(function):
+    """
+    Wrap C{function} so that it runs with a copy of the inheriting
+    L{GreenletLocal} attributes of the greenlet which called
+    C{inheritLocals}, and drops its local attributes when it returns.
+
+    Use it when starting greenlets of your own::
+
+        greenlet(inheritLocals(work)).switch()
+    """
+    inherited = _inheritable()
+    def run(*args, **kwargs):
+        _install(inherited)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _clear()
+    return run
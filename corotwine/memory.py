@@ -0,0 +1,237 @@
+"""
+Memory used by the greenlets which handle connections.
+
+A greenlet which is not running keeps the part of the C stack it was using
+in a copy on the heap, so a handler which blocks deep in a recursive
+function costs much more memory than one which blocks in a shallow one, for
+every connection it handles.  L{handlerMemory} reports, for each handler
+function of the listeners in the process, how many greenlets are running it
+and roughly how many bytes they use::
+
+    for name, usage in sorted(handlerMemory().items()):
+        log.msg("%s: %d greenlets, %d bytes" % (
+            name, usage.greenlets, usage.bytes))
+
+L{corotwine.protocol.GreenletServer.memoryUsage} reports the same for a
+single listener.
+
+A L{MemoryBudget} given to C{gListenTCP} limits the memory of a listener's
+handlers: while they use more than it allows, new connections are closed
+without being handled, and, if asked to, the connections whose greenlets use
+the most memory are closed until they fit::
+
+    gListenTCP(8080, handler,
+               memoryBudget=MemoryBudget(64 * 1024 * 1024, closeLargest=True))
+
+The sizes of saved stacks come from greenlet's own accounting, which
+greenlet 0.4 and later keep.  With older greenlets, only the size of the
+greenlet objects themselves is counted.
+"""
+
+import gc, sys
+from weakref import WeakSet
+
+from twisted.internet.error import ConnectionDone
+
+from corotwine import greenlet
+
+
+__all__ = ["MemoryUsage", "MemoryBudget", "greenletMemory", "handlerMemory",
+           "liveGreenlets"]
+
+
+# The _GreenletFactory of every listener, so that handlerMemory can find
+# them.
+_listeners = WeakSet()
+
+
+def greenletMemory(g):
+    """
+    Return the approximate number of bytes used by a greenlet: the greenlet
+    object and the copy of its stack saved on the heap.  Objects which the
+    greenlet's frames refer to are not counted.
+
+    @type g: L{greenlet}
+    """
+    return sys.getsizeof(g) + getattr(g, "_stack_saved", 0)
+
+
+
+def _handlerName(function):
+    """
+    Return a name for a handler function, for reporting.
+    """
+    name = getattr(function, "__qualname__", None)
+    if name is None:
+        name = getattr(function, "__name__", None)
+    if name is None:
+        return repr(function)
+    module = getattr(function, "__module__", None)
+    if module is not None:
+        name = "%s.%s" % (module, name)
+    return name
+
+
+
+class MemoryUsage(object):
+    """
+    The memory used by a group of greenlets.
+
+    @ivar greenlets: The number of greenlets.
+    @ivar bytes: Their approximate size in bytes; see L{greenletMemory}.
+    """
+
+    def __init__(self, greenlets=0, bytes=0):
+        self.greenlets = greenlets
+        self.bytes = bytes
+
+
+    def add(self, g):
+        """
+        Count the greenlet C{g}.
+        """
+        self.greenlets += 1
+        self.bytes += greenletMemory(g)
+
+
+    def __eq__(self, other):
+        if not isinstance(other, MemoryUsage):
+            return NotImplemented
+        return (self.greenlets, self.bytes) == (other.greenlets, other.bytes)
+
+
+    def __repr__(self):
+        return "<MemoryUsage greenlets=%d bytes=%d>" % (
+            self.greenlets, self.bytes)
+
+
+
+def handlerMemory():
+    """
+    Measure the memory used by the greenlets running the handler function of
+    every listener in the process.
+
+    @return: A C{dict} mapping the name of each handler function to a
+        L{MemoryUsage}.  Listeners with the same handler function are added
+        together.
+    """
+    usage = {}
+    for listener in list(_listeners):
+        name = _handlerName(listener.function)
+        total = usage.setdefault(name, MemoryUsage())
+        for protocol in listener._active:
+            total.add(protocol.greenlet)
+    return usage
+
+
+
+def liveGreenlets():
+    """
+    Measure the memory used by every greenlet in the process which has not
+    finished, including those not started by Corotwine.  This looks through
+    every object the garbage collector knows about, so it is slow.
+
+    @rtype: L{MemoryUsage}
+    """
+    usage = MemoryUsage()
+    for obj in gc.get_objects():
+        if isinstance(obj, greenlet) and not obj.dead:
+            usage.add(obj)
+    return usage
+
+
+
+class MemoryBudget(object):
+    """
+    A limit on the memory used by the greenlets of a listener's handlers.
+
+    The listener measures its handlers every L{interval} seconds while it has
+    connections.  Until the next measurement finds them within the budget,
+    new connections are closed before their handler function is called.
+
+    The same budget may be given to several listeners; each of them keeps
+    within it separately.
+
+    @ivar maxBytes: The most bytes the handlers may use, as measured by
+        L{greenletMemory}.
+    @ivar closeLargest: Whether to close the connections whose greenlets use
+        the most memory, until the rest fit, when the handlers are found to
+        be over budget.  L{ConnectionDone} is thrown into their handlers.
+    @ivar interval: The number of seconds between measurements.
+    """
+
+    def __init__(self, maxBytes, closeLargest=False, interval=1.0):
+        self.maxBytes = maxBytes
+        self.closeLargest = closeLargest
+        self.interval = interval
+
+
+
+class _MemoryGuard(object):
+    """
+    Keeps one listener's handlers within a L{MemoryBudget}.
+
+    @ivar budget: The L{MemoryBudget}.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        schedule measurements with.
+    @ivar usage: The L{MemoryUsage} found by the last measurement.
+    @ivar rejected: The number of connections closed because the handlers
+        were over budget when they arrived.
+    @ivar closed: The number of running connections closed by
+        L{MemoryBudget.closeLargest}.
+    @ivar _listener: The L{corotwine.protocol._GreenletFactory} to measure.
+    @ivar _call: The delayed call of the next measurement, or C{None} if
+        the listener has no connections.
+    """
+
+    def __init__(self, budget, listener, clock):
+        self.budget = budget
+        self.clock = clock
+        self.usage = MemoryUsage()
+        self.rejected = 0
+        self.closed = 0
+        self._listener = listener
+        self._call = None
+
+
+    def admit(self):
+        """
+        Decide whether a new connection may be handled, and start measuring
+        the handlers if they are not already being measured.
+        """
+        if self.usage.bytes > self.budget.maxBytes:
+            self.rejected += 1
+            return False
+        if self._call is None:
+            self._call = self.clock.callLater(
+                self.budget.interval, self._measure)
+        return True
+
+
+    def _measure(self):
+        """
+        Measure the handlers, and close the largest if they are over budget
+        and the budget says to.
+        """
+        self._call = None
+        listener = self._listener
+        usage = listener._memoryUsage()
+        if usage.bytes > self.budget.maxBytes and self.budget.closeLargest:
+            protocols = sorted(
+                listener._active,
+                key=lambda protocol: greenletMemory(protocol.greenlet),
+                reverse=True)
+            for protocol in protocols:
+                if usage.bytes <= self.budget.maxBytes:
+                    break
+                usage.greenlets -= 1
+                usage.bytes -= greenletMemory(protocol.greenlet)
+                self.closed += 1
+                protocol._abort(ConnectionDone(
+                    "The server's handlers are using too much memory."))
+        self.usage = usage
+        if listener._active or listener._queued:
+            self._call = self.clock.callLater(
+                self.budget.interval, self._measure)
+        else:
+            self.usage = MemoryUsage()
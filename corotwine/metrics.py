@@ -0,0 +1,429 @@
+"""
+Runtime metrics, in the Prometheus text format.
+
+L{runtime} counts connections, bytes read and written, writes paused by
+full buffers, the time greenlets spend in L{corotwine.defer.blockOn}, and
+how late the reactor runs timers.  It does nothing until it is enabled::
+
+    runtime.enable()
+    serveMetrics(9100)
+
+after which C{http://localhost:9100/metrics} can be scraped.  Applications
+can add metrics of their own to the same L{Registry}::
+
+    requests = Counter("myapp_requests_total", "Requests handled.")
+
+    def handler(transport):
+        for line in LineBuffer(transport):
+            requests.inc()
+            ...
+
+The metrics are plain numbers, updated without locks: everything that
+updates them runs in the reactor's thread.  Histograms count observations
+in fixed buckets, so observing a value takes constant time and memory.
+"""
+
+import time
+from bisect import bisect_left
+
+
+__all__ = ["Counter", "Gauge", "Histogram", "Registry", "REGISTRY",
+           "RuntimeMetrics", "runtime", "serveMetrics"]
+
+
+def _formatValue(value):
+    """
+    Format a sample value as Prometheus expects.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+
+class Registry(object):
+    """
+    A collection of metrics to be scraped together.
+
+    @ivar _metrics: The registered metrics, in order of registration.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+
+    def register(self, metric):
+        """
+        Add a metric.
+
+        @raise ValueError: If a metric with the same name is registered.
+        """
+        for existing in self._metrics:
+            if existing.name == metric.name:
+                raise ValueError("Duplicate metric %r" % (metric.name,))
+        self._metrics.append(metric)
+
+
+    def render(self):
+        """
+        Return the current values of all the metrics in the Prometheus text
+        format.
+
+        @rtype: C{str}
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (
+                metric.name,
+                metric.help.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for suffix, labels, value in metric._samples():
+                labelText = ""
+                if labels:
+                    labelText = "{%s}" % (",".join(
+                        '%s="%s"' % (label, labelValue)
+                        for (label, labelValue) in labels),)
+                lines.append("%s%s%s %s" % (
+                    metric.name, suffix, labelText, _formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+
+
+REGISTRY = Registry()
+
+
+
+class _Metric(object):
+    """
+    A metric with a name and a description.
+
+    @ivar name: The metric's name.
+    @ivar help: A description of what it measures.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        """
+        @param registry: The L{Registry} to add the metric to, or C{None}.
+        """
+        self.name = name
+        self.help = help
+        if registry is not None:
+            registry.register(self)
+
+
+    def _samples(self):
+        """
+        @return: A list of C{(suffix, labels, value)} for each sample of the
+            metric, where C{labels} is a list of C{(name, value)}.
+        """
+        raise NotImplementedError()
+
+
+
+class Counter(_Metric):
+    """
+    A count of things which have happened.
+
+    @ivar value: The count.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        _Metric.__init__(self, name, help, registry)
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        """
+        Add C{amount}, which must not be negative, to the count.
+        """
+        self.value += amount
+
+
+    def _samples(self):
+        return [("", [], self.value)]
+
+
+
+class Gauge(_Metric):
+    """
+    A value which can go up and down.
+
+    @ivar value: The value, unless it is measured by L{function}.
+    @ivar function: A function of no arguments which returns the value when
+        the metric is scraped, or C{None}.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, registry=REGISTRY, function=None):
+        _Metric.__init__(self, name, help, registry)
+        self.value = 0
+        self.function = function
+
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+    def set(self, value):
+        self.value = value
+
+
+    def _samples(self):
+        if self.function is not None:
+            return [("", [], self.function())]
+        return [("", [], self.value)]
+
+
+
+class Histogram(_Metric):
+    """
+    A distribution of values, counted in fixed buckets.
+
+    @ivar buckets: The sorted upper bounds of the buckets.  A last bucket,
+        for values larger than any of them, is implied.
+    @ivar sum: The sum of the values observed.
+    @ivar _counts: The number of values observed in each bucket, including
+        the implied last one.  They are made cumulative when scraped.
+    """
+
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0)
+
+    def __init__(self, name, help, registry=REGISTRY,
+                 buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, registry)
+        self.buckets = sorted(float(bound) for bound in buckets)
+        self.sum = 0.0
+        self._counts = [0] * (len(self.buckets) + 1)
+
+
+    def observe(self, value):
+        """
+        Count a value.
+        """
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+    @property
+    def count(self):
+        """
+        The number of values observed.
+        """
+        return sum(self._counts)
+
+
+    def _samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self._counts):
+            total += count
+            samples.append(("_bucket", [("le", _formatValue(bound))], total))
+        samples.append(("_sum", [], self.sum))
+        samples.append(("_count", [], total))
+        return samples
+
+
+
+def _handlerGreenlets():
+    """
+    Count the greenlets running the handlers of all listeners.
+    """
+    from corotwine.memory import _listeners
+    return sum([len(listener._active) for listener in list(_listeners)])
+
+
+
+def _handlerBytes():
+    """
+    Measure the memory used by the greenlets running the handlers of all
+    listeners.
+    """
+    from corotwine.memory import handlerMemory
+    return sum([usage.bytes for usage in handlerMemory().values()])
+
+
+
+class RuntimeMetrics(object):
+    """
+    Metrics of Corotwine itself, updated by hooks in
+    L{corotwine.protocol}, L{corotwine.defer.blockOn} and
+    L{corotwine.clock.wait} while L{enabled}.
+
+    Each hook only checks L{enabled} while it is false, so collection costs
+    next to nothing until it is turned on.
+
+    @ivar enabled: Whether the hooks update the metrics.
+    @ivar seconds: The function returning the current time in seconds, with
+        which time spent in C{blockOn} is measured.
+    @ivar connections: The number of open connections.
+    @ivar connectionsTotal: The number of connections made.
+    @ivar handlerGreenlets: The number of greenlets running listeners'
+        handler functions.
+    @ivar handlerBytes: The memory those greenlets use; see
+        L{corotwine.memory}.
+    @ivar bytesReceived: The number of bytes received by connections.
+    @ivar bytesSent: The number of bytes written to connections.
+    @ivar writePauses: The number of times a transport's buffer filled up
+        and paused writes to it.
+    @ivar connectionsShed: The number of connections closed unhandled by
+        listeners' L{corotwine.admission.AdmissionPolicy}s.
+    @ivar blockOnSeconds: The time greenlets spent waiting in C{blockOn}
+        for L{Deferred}s which had not fired.
+    @ivar lagSeconds: How late the reactor ran timers, as seen by
+        C{corotwine.clock.wait} and by a timer which L{enable} schedules
+        every C{lagInterval} seconds.
+    @ivar _clock: The clock the lag timer is scheduled with.
+    @ivar _lagInterval: The number of seconds between runs of the lag timer.
+    @ivar _lagCall: The delayed call of the lag timer, or C{None}.
+    @ivar _lagDue: When the lag timer is due to run.
+    """
+
+    enabled = False
+
+    def __init__(self, registry=REGISTRY):
+        self.seconds = time.time
+        self.connections = Gauge(
+            "corotwine_connections", "Open connections.", registry)
+        self.connectionsTotal = Counter(
+            "corotwine_connections_total", "Connections made.", registry)
+        self.handlerGreenlets = Gauge(
+            "corotwine_handler_greenlets",
+            "Greenlets running handler functions.", registry,
+            _handlerGreenlets)
+        self.handlerBytes = Gauge(
+            "corotwine_handler_greenlet_bytes",
+            "Memory used by greenlets running handler functions, including "
+            "their saved stacks.", registry, _handlerBytes)
+        self.bytesReceived = Counter(
+            "corotwine_received_bytes_total", "Bytes received.", registry)
+        self.bytesSent = Counter(
+            "corotwine_sent_bytes_total", "Bytes written.", registry)
+        self.writePauses = Counter(
+            "corotwine_write_pauses_total",
+            "Times a full transport buffer paused writes.", registry)
+        self.connectionsShed = Counter(
+            "corotwine_connections_shed_total",
+            "Connections closed unhandled because the reactor was behind.",
+            registry)
+        self.blockOnSeconds = Histogram(
+            "corotwine_blockon_seconds",
+            "Time greenlets spent waiting for Deferreds in blockOn.",
+            registry)
+        self.lagSeconds = Histogram(
+            "corotwine_reactor_lag_seconds",
+            "How late the reactor ran timers.", registry,
+            (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+        self._clock = None
+        self._lagInterval = None
+        self._lagCall = None
+        self._lagDue = None
+
+
+    def enable(self, clock=None, lagInterval=1.0):
+        """
+        Start collecting metrics.
+
+        @param clock: The L{twisted.internet.interfaces.IReactorTime}
+            provider to measure the reactor's lag with.  Defaults to the
+            reactor.
+        @param lagInterval: The number of seconds between runs of the lag
+            timer, or C{None} to only measure lag in
+            C{corotwine.clock.wait}.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.disable()
+        self.enabled = True
+        self._clock = clock
+        self._lagInterval = lagInterval
+        if lagInterval is not None:
+            self._scheduleLag()
+
+
+    def disable(self):
+        """
+        Stop collecting metrics.  Their values are kept.
+        """
+        self.enabled = False
+        if self._lagCall is not None:
+            self._lagCall.cancel()
+            self._lagCall = None
+
+
+    def _scheduleLag(self):
+        self._lagDue = self._clock.seconds() + self._lagInterval
+        self._lagCall = self._clock.callLater(self._lagInterval, self._lag)
+
+
+    def _lag(self):
+        self._lagCall = None
+        self.lagSeconds.observe(max(0.0, self._clock.seconds() - self._lagDue))
+        self._scheduleLag()
+
+
+
+runtime = RuntimeMetrics()
+
+
+
+def _metricsHandler(registry):
+    """
+    Make a greenlet function which answers an HTTP request for C{/metrics}
+    with the metrics in C{registry}.
+    """
+    from corotwine.protocol import LineBuffer
+    def handler(transport):
+        lines = LineBuffer(transport)
+        request = lines.readLine().split()
+        while lines.readLine():
+            pass
+        if len(request) >= 2 and request[0] in (b"GET", b"HEAD") and (
+                request[1].split(b"?")[0] == b"/metrics"):
+            status = b"200 OK"
+            body = registry.render().encode("utf-8")
+        else:
+            status = b"404 Not Found"
+            body = b"Not found.\n"
+        transport.write(
+            b"HTTP/1.0 %s\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"\r\n" % (status, len(body)))
+        if request[:1] != [b"HEAD"]:
+            transport.write(body)
+    return handler
+
+
+
+def serveMetrics(port, registry=REGISTRY, reactor=None, interface=""):
+    """
+    Serve the metrics in C{registry} over HTTP, at C{/metrics}, for
+    Prometheus to scrape.
+
+    @param port: The TCP port number to listen on.
+    @param interface: The address to listen on.  Defaults to all of them.
+
+    @return: A handle on the server.
+    @rtype: L{corotwine.protocol.GreenletServer}
+    """
+    from corotwine.protocol import _GreenletFactory, GreenletServer
+    if reactor is None:
+        from twisted.internet import reactor
+    factory = _GreenletFactory(_metricsHandler(registry), idleTimeout=30,
+                               clock=reactor)
+    return GreenletServer(
+        reactor.listenTCP(port, factory, interface=interface), factory)
@@ -0,0 +1,321 @@
+"""
+Staged streaming pipelines between greenlets.
+
+A handler which decodes, parses and processes in one greenlet stops reading
+while it processes, and can't overlap the work of one request with the
+reading of the next.  A L{Pipeline} runs each stage in a greenlet of its own
+instead, linked by bounded L{corotwine.queue.Queue}s::
+
+    def parse(lines):
+        for line in lines:
+            yield json.loads(line)
+
+    def process(requests):
+        for request in requests:
+            yield handle(request)
+
+    def handler(transport):
+        pipeline = Pipeline(transport)
+        pipeline.stage(lines)
+        pipeline.stage(parse)
+        pipeline.stage(process)
+        pipeline.run(transport)
+
+A stage is a function which takes an iterator of the items from the stage
+before it and returns an iterator of its own, usually a generator.  The
+source is a L{corotwine.protocol.GreenletTransport}, whose reads are the
+items, or any other iterable.  The sink is a function called with each item
+from the last stage, or an object with a C{write} method, such as a
+transport.
+
+Each buffer holds at most C{bufferSize} items.  When a stage falls behind,
+the buffer before it fills, the stage before that blocks, and so on back to
+the source: when the first buffer is full, the transport is paused with
+L{corotwine.protocol.GreenletTransport.pauseReading}, so that what the peer
+sends backs up in the kernel, and then at the peer.  A sink which blocks,
+such as a transport whose peer isn't reading, holds up the stages the same
+way.
+
+Reading and writing a transport must be done in the greenlet handling its
+connection, so L{Pipeline.run} reads a transport source and calls the sink
+in the greenlet which calls it, waiting for whichever has something to do
+with L{corotwine.select.select}.  Wrappers which read a transport, such as
+L{corotwine.protocol.LineBuffer}, can't be sources for that reason; split
+lines with the L{lines} stage instead.  Other iterable sources are iterated
+in a greenlet of their own.
+"""
+
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.python import log
+
+from corotwine import greenlet, MAIN
+from corotwine.queue import Queue
+from corotwine.select import select, _notify
+
+
+__all__ = ["Pipeline", "lines"]
+
+
+# What is put in a buffer after the last item.
+_END = object()
+
+
+def lines(chunks, delimiter=b"\r\n"):
+    """
+    A stage which splits chunks of bytes into lines, without their
+    delimiters.  Anything after the last delimiter is discarded.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer.extend(chunk)
+        start = 0
+        while True:
+            end = buffer.find(delimiter, start)
+            if end == -1:
+                break
+            yield bytes(buffer[start:end])
+            start = end + len(delimiter)
+        del buffer[:start]
+
+
+
+class _Condition(object):
+    """
+    A source for L{corotwine.select.select} which is ready whenever a
+    predicate is true.  Whatever may have made it true must call
+    L{changed}.
+    """
+
+    __slots__ = ["_predicate", "_selectors"]
+
+    def __init__(self, predicate):
+        self._predicate = predicate
+        self._selectors = None
+
+
+    def _selectReady(self):
+        return self._predicate()
+
+
+    def changed(self):
+        if self._selectors:
+            _notify(self)
+
+
+
+class Pipeline(object):
+    """
+    A source, a series of stages each running in its own greenlet, and the
+    bounded buffers between them.
+
+    @ivar source: The L{corotwine.protocol.GreenletTransport} or iterable
+        which the first stage's items come from.
+    @ivar bufferSize: The most items each buffer holds.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider
+        the buffers wake greenlets with, and with which stages are started
+        and stopped.
+    @ivar _stages: The stage functions, in order.
+    @ivar _greenlets: The greenlets running the stages, and the source if it
+        is iterated in a greenlet of its own, while L{run} is running.
+    @ivar _failure: The L{Failure} of the first stage which failed, or
+        C{None}.
+    @ivar _failed: A L{_Condition} which is ready once L{_failure} is set,
+        while L{run} is running.
+    """
+
+    def __init__(self, source, bufferSize=16, clock=None):
+        """
+        @param source: See L{source}.
+        @param bufferSize: See L{bufferSize}.
+        @param clock: See L{clock}.  Defaults to the reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.source = source
+        self.bufferSize = bufferSize
+        self.clock = clock
+        self._stages = []
+        self._greenlets = []
+        self._failure = None
+        self._failed = None
+
+
+    def stage(self, function):
+        """
+        Add a stage to the end of the pipeline.
+
+        @param function: A callable taking an iterator of the items from the
+            stage before, and returning an iterable of items for the one
+            after.
+        @return: This pipeline.
+        """
+        self._stages.append(function)
+        return self
+
+
+    def run(self, sink):
+        """
+        Run the pipeline until the source ends, which for a transport is
+        when it raises L{ConnectionDone}, and every item has passed through
+        to C{sink}.
+
+        If the source or a stage raises an exception, the other stages are
+        stopped, and it is raised here.
+
+        This must be called from the greenlet handling the source's
+        connection, if the source is a transport, and otherwise from any
+        non-reactor greenlet.
+
+        @param sink: A callable taking each item from the last stage, or an
+            object with a C{write} method.
+        """
+        assert greenlet.getcurrent() is not MAIN, \
+            "Don't run a Pipeline from the reactor greenlet."
+        write = getattr(sink, "write", sink)
+        self._failure = None
+        buffers = [Queue(self.bufferSize, self.clock)
+                   for i in range(len(self._stages) + 1)]
+        room = _Condition(lambda: not buffers[0].full())
+        self._failed = _Condition(lambda: self._failure is not None)
+        fromTransport = (hasattr(self.source, "read")
+                         and hasattr(self.source, "_selectReady"))
+        if not fromTransport:
+            self._start(self._feed, buffers[0])
+        for i, function in enumerate(self._stages):
+            if i == 0 and fromTransport:
+                items = self._input(buffers[i], room)
+            else:
+                items = self._input(buffers[i], None)
+            self._start(self._runStage, function, items, buffers[i + 1])
+        try:
+            self._drive(write, buffers[0], buffers[-1], room,
+                        fromTransport)
+        finally:
+            self._stop()
+
+
+    def _drive(self, write, first, last, room, fromTransport):
+        """
+        Read a transport source into the first buffer when it has room, and
+        write the items in the last buffer to the sink, until the last
+        buffer ends.
+        """
+        transport = self.source
+        reading = fromTransport
+        paused = False
+        try:
+            while True:
+                while len(last):
+                    item = last.get()
+                    if item is _END:
+                        return
+                    write(item)
+                if self._failure is not None:
+                    self._failure.raiseException()
+                waitFor = [last, self._failed]
+                if reading:
+                    if first.full():
+                        if not paused:
+                            paused = True
+                            transport.pauseReading()
+                        waitFor.append(room)
+                    else:
+                        if paused:
+                            paused = False
+                            transport.resumeReading()
+                        waitFor.append(transport)
+                ready = select(waitFor, clock=self.clock)
+                if reading and transport in ready and not first.full():
+                    try:
+                        data = transport.read()
+                    except ConnectionDone:
+                        data = _END
+                        reading = False
+                    first.put(data)
+        finally:
+            if paused:
+                transport.resumeReading()
+
+
+    def _input(self, buffer, room):
+        """
+        Yield the items from C{buffer} until it ends, noticing L{room} after
+        each if it is given.
+        """
+        while True:
+            item = buffer.get()
+            if room is not None:
+                room.changed()
+            if item is _END:
+                return
+            yield item
+
+
+    def _start(self, function, *args):
+        """
+        Start running C{function} in a new greenlet, from the reactor's.
+        """
+        g = greenlet(function, MAIN)
+        self._greenlets.append(g)
+        self.clock.callLater(0, g.switch, *args)
+
+
+    def _feed(self, buffer):
+        """
+        Put the items of an iterable source into C{buffer}.
+        """
+        try:
+            for item in self.source:
+                buffer.put(item)
+            buffer.put(_END)
+        except greenlet.GreenletExit:
+            raise
+        except:
+            self._fail(Failure())
+
+
+    def _runStage(self, function, items, output):
+        """
+        Put the items returned by a stage into C{output}.
+        """
+        try:
+            for item in function(items):
+                output.put(item)
+            output.put(_END)
+        except greenlet.GreenletExit:
+            raise
+        except:
+            self._fail(Failure())
+
+
+    def _fail(self, failure):
+        """
+        Record the first stage to fail, and wake L{run}.
+        """
+        if self._failure is None:
+            self._failure = failure
+            self._failed.changed()
+
+
+    def _stop(self):
+        """
+        Stop any stages still running, from the reactor's greenlet.
+        """
+        greenlets, self._greenlets = self._greenlets, []
+        for g in greenlets:
+            if not g.dead:
+                self.clock.callLater(0, _stop, g)
+
+
+
+def _stop(g):
+    """
+    Throw C{GreenletExit} into a stage's greenlet.
+    """
+    if g.dead:
+        return
+    try:
+        g.throw(greenlet.GreenletExit())
+    except:
+        log.err(None, "Stopped pipeline stage raised:")
@@ -0,0 +1,258 @@
+"""
+A sampling profiler which attributes CPU time to connection handlers.
+
+Deterministic profilers such as C{cProfile} follow the Python call stack,
+which greenlet switches tear apart, so their numbers for code which blocks
+are meaningless.  A L{Profiler} instead looks at the stack of whichever
+greenlet is running every few milliseconds, and counts it.  Each sample is
+attributed to the listener and handler function which own the greenlet
+running it, by looking at the bottom of its stack::
+
+    profiler = Profiler()
+    profiler.start(duration=30)
+    ...
+    for handler, samples in sorted(profiler.handlers().items()):
+        log.msg("%s: %d samples" % (handler, samples))
+    profiler.writeCollapsed(open("handlers.folded", "w"))
+
+The collapsed stack output has one line per distinct stack, of semicolon
+separated frames and a count, beginning with the listener's address and the
+handler function, so a flame graph of it (made with Brendan Gregg's
+C{flamegraph.pl}, or U{https://www.speedscope.app}) groups the samples of
+each listener and handler together.  Samples in the reactor's greenlet
+begin with C{reactor}, those in greenlets started by
+L{corotwine.defer.deferredGreenlet} with C{deferredGreenlet} and the
+function, and others with C{greenlet}.
+
+In C{"signal"} mode, the default, samples are taken by a C{SIGPROF} timer,
+which counts CPU time used by the process, so a process which is idle isn't
+sampled.  This needs a Unix, and must be started from the main thread.  In
+C{"thread"} mode, a helper thread looks at the main thread's stack instead,
+every C{interval} seconds of wall-clock time, so time spent waiting in the
+reactor is sampled too.
+"""
+
+import os, sys, threading, time
+from collections import defaultdict
+
+from corotwine import greenlet, MAIN
+from corotwine.memory import _handlerName
+
+
+__all__ = ["Profiler"]
+
+
+def _frameName(code):
+    """
+    Return a name for a frame in collapsed stack output.
+    """
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+
+def _address(address):
+    host = getattr(address, "host", None)
+    if host is None:
+        return str(address)
+    return "%s:%s" % (host, getattr(address, "port", ""))
+
+
+
+class Profiler(object):
+    """
+    A sampling profiler for greenlets.
+
+    @ivar interval: The seconds between samples.
+    @ivar mode: C{"signal"} or C{"thread"}; see L{corotwine.profiler}.
+    @ivar samples: The number of samples taken.
+    @ivar profiling: Whether samples are being taken.
+    @ivar _stacks: A C{dict} mapping C{(root, codes)} to the number of
+        samples of that stack, where C{root} is a tuple of the names the
+        stack is attributed to, and C{codes} is a tuple of the stack's code
+        objects, outermost first.
+    @ivar _mainBottom: The frame at the bottom of the reactor greenlet's
+        stack, by which thread mode recognises it.
+    @ivar _previousHandler: The C{SIGPROF} handler installed before
+        L{start}, in signal mode.
+    @ivar _thread: The sampling thread, in thread mode.
+    @ivar _call: The delayed call which will stop profiling, or C{None}.
+    """
+
+    def __init__(self, interval=0.005, mode="signal"):
+        if mode not in ("signal", "thread"):
+            raise ValueError("Unknown profiler mode %r" % (mode,))
+        self.interval = interval
+        self.mode = mode
+        self.samples = 0
+        self.profiling = False
+        self._stacks = defaultdict(int)
+        self._mainBottom = None
+        self._previousHandler = None
+        self._thread = None
+        self._call = None
+
+
+    def start(self, duration=None, clock=None):
+        """
+        Start taking samples.
+
+        This must be called from the main thread.
+
+        @param duration: The number of seconds after which to stop, or
+            C{None} to sample until L{stop} is called.
+        @param clock: The L{twisted.internet.interfaces.IReactorTime}
+            provider to schedule the stop with.  Defaults to the reactor.
+        """
+        if self.profiling:
+            return
+        self.profiling = True
+        frame = MAIN.gr_frame
+        if greenlet.getcurrent() is MAIN:
+            frame = sys._getframe()
+        while frame is not None and frame.f_back is not None:
+            frame = frame.f_back
+        self._mainBottom = frame
+        if self.mode == "signal":
+            import signal
+            self._previousHandler = signal.signal(
+                signal.SIGPROF, self._signalled)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._thread = threading.Thread(
+                target=self._sampleThread,
+                args=(threading.current_thread().ident,))
+            self._thread.daemon = True
+            self._thread.start()
+        if duration is not None:
+            if clock is None:
+                from twisted.internet import reactor as clock
+            self._call = clock.callLater(duration, self.stop)
+
+
+    def stop(self):
+        """
+        Stop taking samples.  Those taken are kept.
+        """
+        if not self.profiling:
+            return
+        self.profiling = False
+        if self.mode == "signal":
+            import signal
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previousHandler)
+            self._previousHandler = None
+        else:
+            self._thread.join()
+            self._thread = None
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+
+    def clear(self):
+        """
+        Forget the samples taken.
+        """
+        self._stacks.clear()
+        self.samples = 0
+
+
+    def _signalled(self, signum, frame):
+        self.sample(frame)
+
+
+    def _sampleThread(self, ident):
+        """
+        Sample the stack of the thread C{ident} every L{interval} seconds
+        until profiling stops.
+        """
+        while self.profiling:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(ident)
+            if frame is not None:
+                self.sample(frame)
+
+
+    def sample(self, frame):
+        """
+        Count the stack of which C{frame} is the innermost frame.
+        """
+        codes = []
+        bottom = None
+        while frame is not None:
+            codes.append(frame.f_code)
+            bottom, frame = frame, frame.f_back
+        codes.reverse()
+        self.samples += 1
+        self._stacks[self._root(bottom), tuple(codes)] += 1
+
+
+    def _root(self, bottom):
+        """
+        Return the names a stack is attributed to, given the frame at the
+        bottom of it.
+        """
+        if bottom is None:
+            return ("greenlet",)
+        if bottom is self._mainBottom:
+            return ("reactor",)
+        name = bottom.f_code.co_name
+        local = bottom.f_locals
+        if name == "_runAndDisconnect" and "self" in local:
+            protocol = local["self"]
+            try:
+                listener = _address(protocol.transport.getHost())
+            except Exception:
+                listener = "listener"
+            return (listener, _handlerName(protocol.function))
+        if name == "intermediateGreenletFunction" and "gfunction" in local:
+            return ("deferredGreenlet", _handlerName(local["gfunction"]))
+        return ("greenlet",)
+
+
+    def handlers(self):
+        """
+        Return a C{dict} mapping the names of handler functions, and of the
+        other roots described in L{corotwine.profiler}, to the number of
+        samples taken in them.
+        """
+        result = defaultdict(int)
+        for (root, codes), count in self._stacks.items():
+            result[root[-1]] += count
+        return dict(result)
+
+
+    def listeners(self):
+        """
+        Return a C{dict} mapping the addresses of listeners to the number of
+        samples taken in their handlers.
+        """
+        result = defaultdict(int)
+        for (root, codes), count in self._stacks.items():
+            if len(root) == 2 and root[0] != "deferredGreenlet":
+                result[root[0]] += count
+        return dict(result)
+
+
+    def collapsed(self):
+        """
+        Return the samples in collapsed stack format, as a list of lines
+        without newlines, most frequent first.
+        """
+        lines = defaultdict(int)
+        for (root, codes), count in self._stacks.items():
+            frames = list(root) + [_frameName(code) for code in codes]
+            lines[";".join([frame.replace(";", ",") for frame in frames])
+                  ] += count
+        return ["%s %d" % (stack, count) for stack, count in
+                sorted(lines.items(), key=lambda item: (-item[1], item[0]))]
+
+
+    def writeCollapsed(self, output):
+        """
+        Write the samples in collapsed stack format to a file.
+        """
+        for line in self.collapsed():
+            output.write(line + "\n")
@@ -7,20 +7,33 @@ By the way, I have a niggling suspicion that it's a really bad idea to use
 C{transport} from multiple greenlets.
 """
 
-from twisted.internet.defer import Deferred
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred, maybeDeferred, gatherResults
 from twisted.internet.protocol import Protocol, Factory, ClientFactory
 from twisted.internet.error import ConnectionLost, ConnectionDone
-from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
+from twisted.python import log
 
-from corotwine import greenlet
+from corotwine import greenlet, MAIN
+from corotwine.local import _inheritable, _install, _clear
+from corotwine.memory import MemoryUsage, _MemoryGuard, _listeners
+from corotwine.admission import _AdmissionGuard
+from corotwine.metrics import runtime as _metrics
+from corotwine import scheduler as _scheduler
+from corotwine.sockopt import (
+    setNoDelay, setCork, setKeepAlive, setBufferSizes)
 
 
-MAIN = greenlet.getcurrent()
+READING, WRITING, QUEUED = range(3)
 
-READING, WRITING = range(2)
+# What a greenlet blocked in read() is switched to with when it has been
+# queued by a scheduler, to say that its data is in the protocol's buffer.
+_WOKEN = object()
 
 
-__all__ = ["MAIN", "LineBuffer", "gListenTCP", "gConnectTCP"]
+__all__ = ["MAIN", "LineBuffer", "GreenletServer", "gListenTCP",
+           "gConnectTCP", "gListen", "gConnect"]
 
 
 class LineBuffer(object):
@@ -28,21 +41,27 @@ class LineBuffer(object):
     A line-buffering wrapper for L{GreenletTransport}s (or any other object
     with C{read} and C{write} methods). Call L{readLine} to get the next line,
     call L{writeLine} to write a line.
+
+    @ivar _buffer: A C{bytearray} of the data read but not yet returned.
+        Lines are copied out of it once, and it is only compacted when more
+        data must be read, so many lines in one read cost no more than one.
+    @ivar _start: The offset in L{_buffer} of the next line.
+    @ivar _searched: The offset in L{_buffer} up to which no delimiter
+        starts.
     """
-    def __init__(self, transport, delimiter="\r\n"):
+    def __init__(self, transport, delimiter=b"\r\n"):
         """
         @param transport: The transport from which to read bytes and to which
             to write them!
         @type transport: L{GreenletTransport}
         @param delimiter: The line delimiter to split lines on.
-        @type delimiter: C{str}
+        @type delimiter: C{bytes}
         """
         self.delimiter = delimiter
         self.transport = transport
-        self.receiver = LineReceiver()
-        self.receiver.delimiter = delimiter
-        self.lines = []
-        self.receiver.lineReceived = self.lines.append
+        self._buffer = bytearray()
+        self._start = 0
+        self._searched = 0
 
     def writeLine(self, data):
         """
@@ -54,9 +73,18 @@ class LineBuffer(object):
         """
         Return a line of data from the transport.
         """
-        while not self.lines:
-            self.receiver.dataReceived(self.transport.read())
-        return self.lines.pop(0)
+        buffer = self._buffer
+        while True:
+            end = buffer.find(self.delimiter, self._searched)
+            if end != -1:
+                break
+            del buffer[:self._start]
+            self._start = 0
+            self._searched = max(0, len(buffer) - len(self.delimiter) + 1)
+            buffer.extend(self.transport.read())
+        line = bytes(buffer[self._start:end])
+        self._start = self._searched = end + len(self.delimiter)
+        return line
 
     def __iter__(self):
         """
@@ -67,6 +95,38 @@ class LineBuffer(object):
 
 
 
+def _socketTransport(transport):
+    """
+    Find the L{twisted.internet.abstract.FileDescriptor} which buffers the
+    data written to C{transport}, looking through wrappers such as TLS.
+
+    @return: The C{FileDescriptor}, or C{None} if there isn't one.
+    """
+    while transport is not None:
+        if hasattr(transport, "dataBuffer"):
+            return transport
+        transport = getattr(transport, "transport", None)
+    return None
+
+
+
+def _bufferedAmount(transport):
+    """
+    Return the number of bytes written to C{transport} which have not yet
+    been sent, including any held by wrappers such as TLS.
+    """
+    amount = 0
+    while transport is not None:
+        if hasattr(transport, "dataBuffer"):
+            return (amount + len(transport.dataBuffer) - transport.offset
+                    + transport._tempDataLen)
+        for data in getattr(transport, "_appSendBuffer", ()):
+            amount += len(data)
+        transport = getattr(transport, "transport", None)
+    return amount
+
+
+
 class GreenletTransport(object):
     """
     An object which represents a connection that greenlets can use.
@@ -76,10 +136,29 @@ class GreenletTransport(object):
     @ivar _disconnected: None or a L{twisted.python.failure.Failure}. If set,
         I/O operations will raise the encapsulated error.
     @ivar _state: Indicates whether the greenlet hooked up to this transport
-        is currently reading or writing. Can be C{READING} or C{WRITING}.
-    @type _state: One of C{READING, WRITING}.
+        is currently reading or writing, or has been woken from either and
+        is queued by a L{corotwine.scheduler.Scheduler}.
+    @type _state: One of C{READING, WRITING, QUEUED}, or C{None}.
+    @ivar _readLimit: A L{corotwine.ratelimit.TokenBucket} which each byte
+        read must spend a token from, or C{None}.
+    @ivar _writeLimit: A L{corotwine.ratelimit.TokenBucket} which each byte
+        written must spend a token from, or C{None}.
+    @ivar _selectors: A set of the greenlets waiting for this transport in
+        L{corotwine.select.select}, or C{None}.
+    @ivar _highWatermark: See L{setWriteWatermarks}.
+    @ivar _lowWatermark: See L{setWriteWatermarks}.
+    @ivar _corks: The number of L{cork} calls not yet matched by L{uncork}.
+    @ivar _readPauses: The number of L{pauseReading} calls not yet matched
+        by L{resumeReading}.
+    @ivar _receiveBuffer: The C{bytearray} which L{readView} copies data
+        into, or C{None} until it is first called.
     """
 
+    __slots__ = ["_transport", "_disconnected", "_state", "_paused",
+                 "_protocol", "_readLimit", "_writeLimit", "_selectors",
+                 "_highWatermark", "_lowWatermark", "_corks", "_readPauses",
+                 "_receiveBuffer"]
+
     def __init__(self, transport, protocol):
         """
         @param transport: The real, underlying Twisted transport.
@@ -92,47 +171,360 @@ class GreenletTransport(object):
         self._state = None
         self._paused = False
         self._protocol = protocol
+        self._readLimit = None
+        self._writeLimit = None
+        self._selectors = None
+        self._highWatermark = None
+        self._lowWatermark = 0
+        self._corks = 0
+        self._readPauses = 0
+        self._receiveBuffer = None
 
 
     def read(self):
         """
         Block until there is data available, then return it.
+
+        If reads are rate limited, this also blocks until the data's tokens
+        are available.
+        """
+        chunks = self._receive()
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
+
+
+    def readView(self):
+        """
+        Like L{read}, but copy the data into a buffer which belongs to this
+        connection and return a C{memoryview} of it.  The buffer is reused,
+        so the view is only valid until the next call to L{readView}, but
+        once it is big enough no memory is allocated for the data.
+
+        Copy anything which must outlive the next call, e.g. with
+        C{view.tobytes()}.
+
+        @rtype: C{memoryview}
+        """
+        chunks = self._receive()
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+        buffer = self._receiveBuffer
+        if buffer is None or len(buffer) < size:
+            # Views of the old buffer may still exist, so it can't be
+            # resized; make a new one instead.
+            if buffer is None:
+                buffer = bytearray(max(size, 4096))
+            else:
+                buffer = bytearray(max(size, len(buffer) * 2))
+            self._receiveBuffer = buffer
+        view = memoryview(buffer)
+        offset = 0
+        for chunk in chunks:
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return view[:size]
+
+
+    def _receive(self):
+        """
+        Block until there is data available, then return it as a list of the
+        chunks received.
         """
         if self._disconnected is not None:
             self._disconnected.raiseException()
-        if self._protocol._buffer != "":
-            buffer, self._protocol._buffer = self._protocol._buffer, ""
-            return buffer
-        self._state = READING
-        x = MAIN.switch()
-        self._state = None
-        return x
+        chunks = self._protocol._buffer
+        if chunks:
+            self._protocol._buffer = []
+        else:
+            self._state = READING
+            try:
+                data = MAIN.switch()
+            finally:
+                # Also when an exception is thrown into us, so that the
+                # protocol doesn't try to wake us again.
+                self._state = None
+            if data is _WOKEN:
+                chunks = self._protocol._buffer
+                self._protocol._buffer = []
+            else:
+                chunks = [data]
+        if self._readLimit is not None:
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+            self._limitRead(size)
+        return chunks
+
+
+    def _selectReady(self):
+        """
+        Return whether L{read} would return or raise without blocking.
+        """
+        return bool(self._protocol._buffer) or self._disconnected is not None
+
+
+    def _limitRead(self, amount):
+        """
+        Spend C{amount} tokens from the read limit.  While waiting for them,
+        stop the underlying transport from reading, so that the peer's
+        writes back up instead of our buffer.
+        """
+        if self._readLimit.tryConsume(amount):
+            return
+        self.pauseReading()
+        try:
+            self._readLimit.consume(amount)
+        finally:
+            self.resumeReading()
+
+
+    def pauseReading(self):
+        """
+        Stop the underlying transport from reading, so that data the peer
+        sends backs up in the kernel's buffers and then at the peer, instead
+        of in this transport's, until L{resumeReading} is called.
+
+        Calls may be nested; reading resumes when the last one is undone.
+        """
+        self._readPauses += 1
+        if self._readPauses == 1:
+            self._transport.pauseProducing()
+
+
+    def resumeReading(self):
+        """
+        Undo a call to L{pauseReading}.
+        """
+        if not self._readPauses:
+            return
+        self._readPauses -= 1
+        if not self._readPauses and self._disconnected is None:
+            self._transport.resumeProducing()
 
 
     def write(self, data):
         """
         Write the given data to the transport.
 
-        This may block if the write buffer is full.
+        This may block if the write buffer is full, or if writes are rate
+        limited.
+
+        Anything supporting the buffer protocol, such as a C{bytearray} or a
+        C{memoryview} from L{readView}, may be written.  It is copied once,
+        since the underlying transport may hold on to it until the socket is
+        writable, and its memory may be reused before then.
 
         @param data: The data to write.
-        @type data: C{str}
+        @type data: C{bytes}, or an object supporting the buffer protocol.
         """
         if self._disconnected is not None:
             self._disconnected.raiseException()
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+        if self._writeLimit is not None:
+            self._writeLimit.consume(len(data))
+            if self._disconnected is not None:
+                self._disconnected.raiseException()
         if self._paused:
             self._state = WRITING
-            MAIN.switch()
-            self._state = None
+            try:
+                MAIN.switch()
+            finally:
+                self._state = None
+            # A scheduler may have queued us before the connection was lost.
+            if self._disconnected is not None:
+                self._disconnected.raiseException()
+        self._protocol._idleSweeps = 0
+        if _metrics.enabled:
+            _metrics.bytesSent.inc(len(data))
         self._transport.write(data)
+        if (self._highWatermark is not None
+            and self.bufferedAmount > self._highWatermark):
+            self.drain()
+
+
+    @property
+    def bufferedAmount(self):
+        """
+        The number of bytes written which have not yet been sent to the
+        network.  This is always 0 for transports which don't buffer in a
+        way we can see.
+        """
+        return _bufferedAmount(self._transport)
+
+
+    def setWriteWatermarks(self, high=None, low=None):
+        """
+        Set how much written data may wait to be sent on this connection.
+
+        Once more than C{high} bytes are buffered, L{write} blocks until no
+        more than C{low} are.  A small C{high} keeps latency down for
+        interactive streams, and a large one keeps the network busy for bulk
+        transfers.
+
+        @param high: The high watermark in bytes, or C{None} to block only
+            when the underlying transport asks us to pause.
+        @param low: The low watermark in bytes.  Defaults to half of C{high}.
+        """
+        if low is None:
+            low = 0
+            if high is not None:
+                low = high // 2
+        self._highWatermark = high
+        self._lowWatermark = low
+        socket = _socketTransport(self._transport)
+        if socket is not None and high is not None:
+            # Make Twisted pause us at the same point, rather than at its
+            # own buffer size.
+            socket.bufferSize = high
+
+
+    def drain(self):
+        """
+        Block until no more than the low watermark's bytes are buffered; see
+        L{setWriteWatermarks}.
+
+        This function must be called from a non-reactor greenlet.
+        """
+        while True:
+            if self._disconnected is not None:
+                self._disconnected.raiseException()
+            if self.bufferedAmount <= self._lowWatermark:
+                return
+            socket = _socketTransport(self._transport)
+            if socket is not None:
+                _watchWrites(socket, self._protocol)
+            self._state = WRITING
+            try:
+                MAIN.switch()
+            finally:
+                self._state = None
+
+
+    def _socket(self):
+        """
+        @return: The underlying L{socket.socket}, or C{None} if there isn't
+            one.
+        """
+        socket = _socketTransport(self._transport)
+        if socket is None or not hasattr(socket, "getHandle"):
+            return None
+        return socket.getHandle()
+
+
+    def setNoDelay(self, enabled=True):
+        """
+        Turn off Nagle's algorithm, so that small writes are sent straight
+        away instead of waiting for earlier ones to be acknowledged.  See
+        L{corotwine.sockopt}.
+        """
+        setNoDelay(self._socket(), enabled)
+
+
+    def setKeepAlive(self, idle=None, interval=None, count=None,
+                     enabled=True):
+        """
+        Send TCP keepalives, so that a dead peer is noticed.  See
+        L{corotwine.sockopt.setKeepAlive} for the arguments.
+        """
+        setKeepAlive(self._socket(), enabled, idle, interval, count)
+
+
+    def setBufferSizes(self, send=None, receive=None):
+        """
+        Set the sizes of the kernel's send and receive buffers, in bytes.
+        """
+        setBufferSizes(self._socket(), send, receive)
+
+
+    def setPriority(self, priority):
+        """
+        Set the priority with which a L{corotwine.scheduler.Scheduler} wakes
+        the greenlet handling this connection.  Lower numbers run first; the
+        default is C{0}.
+        """
+        _scheduler.setPriority(priority, self._protocol.greenlet)
+
+
+    def cork(self):
+        """
+        Hold back partial packets until L{uncork} is called, so that a
+        response written in several pieces, with blocking calls in between,
+        is sent in as few packets as possible.
+
+        Calls may be nested; the connection is uncorked when the last one is
+        undone.  The return value is a context manager which calls
+        L{uncork}::
+
+            with transport.cork():
+                transport.write(header)
+                transport.write(body)
+        """
+        if not self._corks:
+            setCork(self._socket(), True)
+        self._corks += 1
+        return _Cork(self)
+
+
+    def uncork(self):
+        """
+        Undo a call to L{cork}.
+        """
+        if not self._corks:
+            return
+        self._corks -= 1
+        if not self._corks:
+            setCork(self._socket(), False)
 
 
     def close(self):
         """
         Close the connection.
         """
-        self._transport.loseConnection()
-        self._protocol._closed = True
+        self._protocol._loseConnection()
+
+
+
+class _Cork(object):
+    """
+    The context manager returned by L{GreenletTransport.cork}.
+    """
+
+    __slots__ = ["_transport"]
+
+    def __init__(self, transport):
+        self._transport = transport
+
+
+    def __enter__(self):
+        return self._transport
+
+
+    def __exit__(self, type, value, traceback):
+        self._transport.uncork()
+
+
+
+def _watchWrites(socket, protocol):
+    """
+    Make C{socket} tell C{protocol} each time it has sent some data, so that
+    a greenlet waiting in L{GreenletTransport.drain} can be woken as soon as
+    the buffer is below the low watermark.  Twisted itself only resumes a
+    paused producer once the buffer is empty.
+
+    @param socket: A L{twisted.internet.abstract.FileDescriptor}.
+    @param protocol: The L{_GreenletProtocol} writing to it.
+    """
+    if "doWrite" in socket.__dict__:
+        return
+    doWrite = socket.doWrite
+    def watchedDoWrite():
+        result = doWrite()
+        protocol._dataSent()
+        return result
+    socket.doWrite = watchedDoWrite
 
 
 
@@ -143,15 +535,28 @@ class _GreenletProtocol(Protocol):
     @ivar function: The function that will be called to handle connected
         transports.
     @ivar _closed: Whether the connection should be considered done with.
+    @ivar _listener: The L{_GreenletFactory} which keeps track of this
+        connection, or C{None}.
+    @ivar _idleSweeps: The number of L{_IdleReaper} sweeps since the last
+        read or write.
+    @ivar _metered: Whether the connection was counted by
+        L{corotwine.metrics.runtime}, and so must be uncounted when it is
+        lost.
     """
 
-    def __init__(self, function):
+    _listener = None
+    _idleSweeps = 0
+    _metered = False
+
+    def __init__(self, function, listener=None):
         """
         @param function: A callable that will be passed one argument, an
             instance of L{GreenletTransport}.
+        @param listener: See L{_listener}.
         """
         self.function = function
         self._closed = False
+        self._listener = listener
 
 
     def _runAndDisconnect(self, transport):
@@ -161,21 +566,73 @@ class _GreenletProtocol(Protocol):
 
         @param transport: The connected L{GreenletTransport}.
         """
-        self.function(transport)
+        if self._listener is not None:
+            _install(self._listener._locals)
+        try:
+            self.function(transport)
+        finally:
+            _clear()
+            if self._listener is not None:
+                self._listener._handlerFinished(self)
+        if not self._closed:
+            self._loseConnection()
+
+
+    def _loseConnection(self):
+        """
+        Stop producing to the transport and close it.
+
+        The producer is unregistered first because some transports, such as
+        TLS, wait for it to go away before they really close.
+        """
+        self._closed = True
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+
+    def _abort(self, reason):
+        """
+        Close the connection, and throw C{reason} into the greenlet if it is
+        running.  Any exception the greenlet raises in response is logged,
+        unless it is C{reason} itself.
+
+        @type reason: L{Exception}
+        """
+        self.gtransport._disconnected = Failure(reason)
         if not self._closed:
-            self._closed = True
-            self.transport.loseConnection()
+            self._loseConnection()
+        if self.greenlet and self.greenlet is not greenlet.getcurrent():
+            self.gtransport._state = None
+            try:
+                self.greenlet.throw(reason)
+            except:
+                failure = Failure()
+                if failure.value is not reason:
+                    log.err(failure)
 
 
     def connectionMade(self):
         """
-        Initiate the connection by switching to the greenlet.
+        Initiate the connection by switching to the greenlet, unless the
+        listener says it must wait its turn.
         """
-        self._buffer = ""
+        self._buffer = []
         self.greenlet = greenlet(self._runAndDisconnect)
         self.gtransport = GreenletTransport(self.transport, self)
         self.transport.registerProducer(self, True)
-        self.greenlet.switch(self.gtransport)
+        self._meter()
+        if self._listener is None or self._listener._connectionMade(self):
+            self.greenlet.switch(self.gtransport)
+
+
+    def _meter(self):
+        """
+        Count a new connection in L{corotwine.metrics.runtime}.
+        """
+        if _metrics.enabled:
+            self._metered = True
+            _metrics.connections.inc()
+            _metrics.connectionsTotal.inc()
 
 
     def pauseProducing(self):
@@ -184,19 +641,66 @@ class _GreenletProtocol(Protocol):
         block until L{resumeProducing} is called.
         """
         self.gtransport._paused = True
+        if _metrics.enabled:
+            _metrics.writePauses.inc()
 
 
     def resumeProducing(self):
         """
         Unpause the L{GreenletTransport} and cause the blocking C{write} call
-        to return.
+        to return, if there is one.
+
+        A transport may pause us after a C{write} that did not block, and then
+        resume us while the greenlet is doing something else (for example, a
+        TLS transport pauses while its handshake is incomplete and resumes
+        when the peer's handshake data is received).
         """
-        # I'm pretty sure you can't possibly be doing anything other than
-        # writing if resumeProducing is called.
-        assert self.gtransport._state == WRITING
-        assert self.gtransport._paused == True
         self.gtransport._paused = False
-        self.greenlet.switch()
+        if self.gtransport._state == WRITING:
+            self._wake()
+
+
+    def _dataSent(self):
+        """
+        Some buffered data has been sent.  If the buffer is now below the low
+        watermark, unpause the L{GreenletTransport} and wake the greenlet if
+        it is blocked writing.
+        """
+        gtransport = self.gtransport
+        if gtransport.bufferedAmount > gtransport._lowWatermark:
+            return
+        gtransport._paused = False
+        if gtransport._state == WRITING:
+            self._wake()
+
+
+    def _wake(self, data=None):
+        """
+        Wake the greenlet, which is blocked reading or writing, giving it
+        C{data} if it is reading.
+
+        If a L{corotwine.scheduler.Scheduler} is installed, the greenlet is
+        queued instead, and C{data} is buffered, so that data which arrives
+        before the greenlet runs is read along with it.
+        """
+        scheduler = _scheduler._current
+        if scheduler is None:
+            self.greenlet.switch(data)
+            return
+        if data is not None:
+            self._buffer.append(data)
+        self.gtransport._state = QUEUED
+        scheduler.call(self._runQueued, _scheduler.getPriority(self.greenlet))
+
+
+    def _runQueued(self):
+        """
+        Switch to the greenlet queued by L{_wake}, unless something else
+        has woken it since.
+        """
+        if self.gtransport._state == QUEUED:
+            self.gtransport._state = None
+            self.greenlet.switch(_WOKEN)
 
 
     def stopProducing(self):
@@ -211,11 +715,20 @@ class _GreenletProtocol(Protocol):
         If the greenlet is currently reading, send the data to it.  Otherwise,
         buffer it, and the next call to L{GreenletTransport.read} will
         immediately return.
+
+        The buffer is a list of the chunks received, which is only joined
+        when it is read, and then only if there is more than one.
         """
-        self._buffer += data
+        self._idleSweeps = 0
+        if _metrics.enabled:
+            _metrics.bytesReceived.inc(len(data))
         if self.gtransport._state == READING:
-            buffer, self._buffer = self._buffer, ""
-            self.greenlet.switch(buffer)
+            self._wake(data)
+        else:
+            self._buffer.append(data)
+            if self.gtransport._selectors:
+                from corotwine.select import _notify
+                _notify(self.gtransport)
 
 
     def connectionLost(self, reason):
@@ -226,33 +739,490 @@ class _GreenletProtocol(Protocol):
         operations.
         """
         self._closed = True
+        if self._metered:
+            self._metered = False
+            _metrics.connections.dec()
+        if self._listener is not None:
+            self._listener._connectionLost(self)
         self.gtransport._disconnected = reason
         if self.gtransport._state in (READING, WRITING):
             reason.throwExceptionIntoGenerator(self.greenlet)
+        elif self.gtransport._selectors:
+            from corotwine.select import _notify
+            _notify(self.gtransport)
+
+
+
+class _IdleReaper(object):
+    """
+    Closes connections which have not read or written anything for a while.
+
+    One timer is shared by all of the connections.  It sweeps them every
+    quarter of L{timeout}, and closes those which have been idle for more than
+    four sweeps in a row, so an idle connection is closed between L{timeout}
+    and 1.25 times L{timeout} after its last activity.
+
+    @ivar timeout: The number of seconds a connection may be idle.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        schedule sweeps with.
+    @ivar _protocols: The set of L{_GreenletProtocol}s to watch.
+    @ivar _call: The L{twisted.internet.interfaces.IDelayedCall} of the next
+        sweep, or C{None} if there are no connections to sweep.
+    """
+
+    SWEEPS = 4
+
+    def __init__(self, timeout, clock):
+        self.timeout = timeout
+        self.clock = clock
+        self._protocols = set()
+        self._call = None
+
+
+    def add(self, protocol):
+        """
+        Start watching a connection.
+
+        @type protocol: L{_GreenletProtocol}
+        """
+        protocol._idleSweeps = 0
+        self._protocols.add(protocol)
+        if self._call is None:
+            self._schedule()
+
+
+    def remove(self, protocol):
+        """
+        Stop watching a connection.
+
+        @type protocol: L{_GreenletProtocol}
+        """
+        self._protocols.discard(protocol)
+        if not self._protocols and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+
+    def _schedule(self):
+        self._call = self.clock.callLater(
+            float(self.timeout) / self.SWEEPS, self._sweep)
+
+
+    def _sweep(self):
+        """
+        Close the connections which have been idle for more than L{SWEEPS}
+        sweeps.
+        """
+        self._call = None
+        idle = []
+        for protocol in self._protocols:
+            protocol._idleSweeps += 1
+            if protocol._idleSweeps > self.SWEEPS:
+                idle.append(protocol)
+        for protocol in idle:
+            self._protocols.discard(protocol)
+            protocol._loseConnection()
+        if self._protocols:
+            self._schedule()
 
 
 
 class _GreenletFactory(Factory):
     """
-    A simple factory which creates L{_GreenletProtocol}s.
+    A factory which creates L{_GreenletProtocol}s and keeps track of their
+    greenlets.
+
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        schedule things with.
+    @ivar maxConnections: The number of connections which may be handled at
+        once, or C{None} for no limit.  Connections beyond this are queued
+        until one of the handlers finishes.
+    @ivar readLimit: The L{corotwine.ratelimit.LimiterGroup} giving each
+        connection a bucket for bytes read, or C{None}.
+    @ivar writeLimit: The L{corotwine.ratelimit.LimiterGroup} giving each
+        connection a bucket for bytes written, or C{None}.
+    @ivar socketOptions: The L{corotwine.sockopt.SocketOptions} to set on
+        each connection, or C{None}.
+    @ivar _memoryGuard: The L{corotwine.memory._MemoryGuard} keeping the
+        handlers within their L{corotwine.memory.MemoryBudget}, or C{None}.
+    @ivar _admissionGuard: The L{corotwine.admission._AdmissionGuard}
+        turning connections away while the reactor is behind, or C{None}.
+    @ivar _locals: The inheriting L{corotwine.local.GreenletLocal}
+        attributes of the greenlet which created the factory, which each
+        handler starts with.
+    @ivar _acceptLimit: The L{corotwine.ratelimit.TokenBucket} which each
+        handler must spend a token from to start, or C{None}.  Connections
+        are queued while it is empty.
+    @ivar _acceptWaiting: Whether a token has been requested from
+        L{_acceptLimit}.
+    @ivar _acceptGranted: Whether a token requested from L{_acceptLimit} has
+        been spent but not yet used to start a handler.
+    @ivar _reaper: The L{_IdleReaper} shared by all of the connections, or
+        C{None} if idle connections are not closed.
+    @ivar _active: The set of L{_GreenletProtocol}s whose handler function is
+        running.
+    @ivar _queued: A L{collections.OrderedDict} whose keys are the
+        L{_GreenletProtocol}s whose handler function is waiting to run, in
+        order of arrival, and whose values are the times they were queued.
+    @ivar _startCall: The delayed call which will start queued handlers, or
+        C{None}.
+    @ivar _idleWaiters: A list of L{Deferred}s to fire when there are no
+        active or queued connections.
     """
-    def __init__(self, function):
+    def __init__(self, function, idleTimeout=None, clock=None,
+                 maxConnections=None, readLimit=None, writeLimit=None,
+                 acceptLimit=None, socketOptions=None, memoryBudget=None,
+                 admissionPolicy=None):
         """
         @param function: A greenlet function which will be used as per
         L{_GreenletProtocol}.
+        @param idleTimeout: The number of seconds after which to close
+            connections which have not read or written anything, or C{None}
+            to leave them open.
+        @param clock: See L{clock}.  Defaults to the reactor.
+        @param maxConnections: See L{maxConnections}.
+        @param readLimit: See L{readLimit}.
+        @param writeLimit: See L{writeLimit}.
+        @param acceptLimit: A L{corotwine.ratelimit.LimiterGroup} to take
+            L{_acceptLimit} from, or C{None}.
+        @param socketOptions: See L{socketOptions}.
+        @param memoryBudget: A L{corotwine.memory.MemoryBudget} to keep the
+            handlers within, or C{None}.
+        @param admissionPolicy: A L{corotwine.admission.AdmissionPolicy} to
+            turn connections away with, or C{None}.
         """
+        if clock is None:
+            from twisted.internet import reactor as clock
         self.function = function
+        self.clock = clock
+        self.maxConnections = maxConnections
+        self.readLimit = readLimit
+        self.writeLimit = writeLimit
+        self.socketOptions = socketOptions
+        self._locals = _inheritable()
+        self._acceptLimit = None
+        if acceptLimit is not None:
+            self._acceptLimit = acceptLimit.bucket()
+        self._acceptWaiting = False
+        self._acceptGranted = False
+        self._reaper = None
+        if idleTimeout is not None:
+            self._reaper = _IdleReaper(idleTimeout, clock)
+        self._active = set()
+        self._queued = OrderedDict()
+        self._startCall = None
+        self._idleWaiters = []
+        self._memoryGuard = None
+        if memoryBudget is not None:
+            self._memoryGuard = _MemoryGuard(memoryBudget, self, clock)
+        self._admissionGuard = None
+        if admissionPolicy is not None:
+            self._admissionGuard = _AdmissionGuard(
+                admissionPolicy, self, clock)
+        _listeners.add(self)
 
 
     def buildProtocol(self, addr):
         """
         @rtype: L{_GreenletProtocol}.
         """
-        return _GreenletProtocol(self.function)
+        return _GreenletProtocol(self.function, self)
+
+
+    def _connectionMade(self, protocol):
+        """
+        Keep track of a new connection.
+
+        @return: Whether the connection's handler may start now.  If not, it
+            has been queued and will be started later, or closed because the
+            handlers are over their memory budget or the reactor is behind.
+        """
+        if (self._admissionGuard is not None
+            and not self._admissionGuard.admit(protocol)):
+            return False
+        if self._memoryGuard is not None and not self._memoryGuard.admit():
+            protocol._loseConnection()
+            return False
+        if self._reaper is not None:
+            self._reaper.add(protocol)
+        if self.readLimit is not None:
+            protocol.gtransport._readLimit = self.readLimit.bucket()
+        if self.writeLimit is not None:
+            protocol.gtransport._writeLimit = self.writeLimit.bucket()
+        if self.socketOptions is not None:
+            self.socketOptions.apply(protocol.gtransport)
+        if self._queued or not self._mayStart():
+            self._queued[protocol] = self.clock.seconds()
+            return False
+        self._active.add(protocol)
+        return True
+
+
+    def _mayStart(self):
+        """
+        Decide whether another handler may start now, spending a token from
+        L{_acceptLimit} if so.  If there is no token, one is requested, and
+        queued handlers will be started when it arrives.
+        """
+        if (self._admissionGuard is not None
+            and not self._admissionGuard.mayStart()):
+            return False
+        if (self.maxConnections is not None
+            and len(self._active) >= self.maxConnections):
+            return False
+        if self._acceptLimit is None:
+            return True
+        if self._acceptGranted:
+            self._acceptGranted = False
+            return True
+        if self._acceptWaiting:
+            return False
+        if self._acceptLimit.tryConsume(1):
+            return True
+        self._acceptWaiting = True
+        self._acceptLimit.whenAvailable(1, self._acceptTokenArrived)
+        return False
+
+
+    def _acceptTokenArrived(self):
+        """
+        A token requested from L{_acceptLimit} has been spent; use it to
+        start a queued handler.
+        """
+        self._acceptWaiting = False
+        self._acceptGranted = True
+        self._startQueued()
+
+
+    def _connectionLost(self, protocol):
+        """
+        Stop keeping track of a connection which was lost.  If its handler
+        was still queued, it will never run.
+        """
+        if self._reaper is not None:
+            self._reaper.remove(protocol)
+        if protocol in self._queued:
+            del self._queued[protocol]
+            self._checkIdle()
+
+
+    def _handlerFinished(self, protocol):
+        """
+        Stop keeping track of a connection whose handler has finished, and
+        make room for a queued one.
+
+        This is called in the handler's greenlet, so queued handlers are
+        started, and L{Deferred}s fired, from the reactor's greenlet instead.
+        """
+        self._active.discard(protocol)
+        if self._queued and self._startCall is None:
+            self._startCall = self.clock.callLater(0, self._startQueued)
+        self._checkIdle()
+
+
+    def _startQueued(self):
+        """
+        Start queued handlers for as long as L{_mayStart} allows.
+        """
+        self._startCall = None
+        while self._queued and self._mayStart():
+            protocol, ignored = self._queued.popitem(last=False)
+            self._active.add(protocol)
+            protocol.greenlet.switch(protocol.gtransport)
+
+
+    def _checkIdle(self):
+        """
+        If there are no active or queued connections, fire the Deferreds
+        waiting for that to happen.
+        """
+        if self._idleWaiters and not self._active and not self._queued:
+            waiters, self._idleWaiters = self._idleWaiters, []
+            for d in waiters:
+                self.clock.callLater(0, d.callback, None)
+
+
+    def _whenIdle(self):
+        """
+        @return: A L{Deferred} which fires when there are no active or queued
+            connections.
+        """
+        d = Deferred()
+        self._idleWaiters.append(d)
+        self._checkIdle()
+        return d
+
+
+    def _memoryUsage(self):
+        """
+        Measure the memory used by the greenlets of the running handlers.
+
+        @rtype: L{corotwine.memory.MemoryUsage}
+        """
+        usage = MemoryUsage()
+        for protocol in self._active:
+            usage.add(protocol.greenlet)
+        return usage
+
+
+    def _abortAll(self, reason):
+        """
+        Close all connections, throwing C{reason} into their handlers.  Queued
+        handlers will never run.
+        """
+        queued, self._queued = list(self._queued), OrderedDict()
+        for protocol in queued + list(self._active):
+            protocol._abort(reason)
+        self._checkIdle()
 
 
 
-def gListenTCP(port, function, reactor=None):
+class GreenletServer(object):
+    """
+    A handle on a server started by L{gListenTCP}, L{gListen} or
+    L{corotwine.tls.gListenSSL}, which can be used to shut it down
+    gracefully: stop accepting connections, let the handlers finish, and then
+    close whatever connections are left.
+
+    @ivar port: The port the server is listening on.
+    @type port: L{twisted.internet.interfaces.IListeningPort}
+    """
+
+    def __init__(self, port, factory):
+        """
+        @param port: See L{port}.
+        @param factory: The L{_GreenletFactory} that the server is listening
+            with.
+        """
+        self.port = port
+        self._factory = factory
+        if factory._admissionGuard is not None:
+            factory._admissionGuard.port = port
+
+
+    @property
+    def activeConnections(self):
+        """
+        The number of connections whose handler function is running.
+        """
+        return len(self._factory._active)
+
+
+    @property
+    def queuedConnections(self):
+        """
+        The number of accepted connections whose handler function is waiting
+        to run.
+        """
+        return len(self._factory._queued)
+
+
+    def memoryUsage(self):
+        """
+        Measure the memory used by the greenlets of the running handlers,
+        including the copies of their stacks saved on the heap.
+
+        @rtype: L{corotwine.memory.MemoryUsage}
+        """
+        return self._factory._memoryUsage()
+
+
+    @property
+    def memoryRejectedConnections(self):
+        """
+        The number of connections closed without being handled because the
+        handlers were over their L{corotwine.memory.MemoryBudget}.
+        """
+        guard = self._factory._memoryGuard
+        return guard.rejected if guard is not None else 0
+
+
+    @property
+    def memoryClosedConnections(self):
+        """
+        The number of running connections closed to bring the handlers
+        within their L{corotwine.memory.MemoryBudget}.
+        """
+        guard = self._factory._memoryGuard
+        return guard.closed if guard is not None else 0
+
+
+    @property
+    def overloaded(self):
+        """
+        Whether the reactor has been behind for long enough that connections
+        are being turned away, according to the listener's
+        L{corotwine.admission.AdmissionPolicy}.
+        """
+        guard = self._factory._admissionGuard
+        return guard.overloaded if guard is not None else False
+
+
+    @property
+    def admissionRejectedConnections(self):
+        """
+        The number of new connections closed without being handled because
+        the listener was overloaded.
+        """
+        guard = self._factory._admissionGuard
+        return guard.rejected if guard is not None else 0
+
+
+    @property
+    def admissionShedConnections(self):
+        """
+        The number of queued connections closed without being handled because
+        the listener was overloaded.
+        """
+        guard = self._factory._admissionGuard
+        return guard.shed if guard is not None else 0
+
+
+    def stopAccepting(self):
+        """
+        Stop accepting new connections.  Existing connections are unaffected.
+
+        @return: A L{Deferred} which fires when the port has stopped
+            listening.
+        """
+        return maybeDeferred(self.port.stopListening)
+
+
+    def drain(self, timeout=None):
+        """
+        Stop accepting new connections and wait for the handlers of the
+        existing ones to finish.  Queued connections are still handled.
+
+        If they have not all finished after C{timeout} seconds, the remaining
+        connections are closed, and L{ConnectionDone} is thrown into their
+        handlers wherever they are blocked.
+
+        @param timeout: The number of seconds to wait, or C{None} to wait
+            forever.
+
+        @return: A L{Deferred} which fires when the port has stopped listening
+            and all of the handlers have finished.
+        """
+        idle = self._factory._whenIdle()
+        if timeout is not None:
+            call = self._factory.clock.callLater(
+                timeout, self._factory._abortAll,
+                ConnectionDone("The server is shutting down."))
+            def cancel(result):
+                if call.active():
+                    call.cancel()
+                return result
+            idle.addBoth(cancel)
+        d = gatherResults([self.stopAccepting(), idle])
+        d.addCallback(lambda ignored: None)
+        return d
+
+
+
+def gListenTCP(port, function, reactor=None, idleTimeout=None,
+               maxConnections=None, readLimit=None, writeLimit=None,
+               acceptLimit=None, socketOptions=None, memoryBudget=None,
+               admissionPolicy=None):
     """
     Listen for TCP connections and handle them with the given greenlet
     function.  The function will be called in a new greenlet for each incoming
@@ -264,10 +1234,48 @@ def gListenTCP(port, function, reactor=None):
     @type port: C{int}
     @param function: The greenlet function to call for each incoming connection.
     @type function: Callable of one argument, L{GreenletTransport}
+    @param idleTimeout: If not C{None}, connections which have not read or
+        written anything for this many seconds are closed.  I/O in the
+        connection's greenlet will raise L{ConnectionDone}.
+    @type idleTimeout: C{int} or C{float}
+    @param maxConnections: If not C{None}, the number of connections which
+        may be handled at once.  Further connections are accepted, but their
+        greenlet functions are only called as earlier ones finish.
+    @type maxConnections: C{int}
+    @param readLimit: If not C{None}, each connection gets a bucket from
+        this group, and reads block until they have spent a token for each
+        byte.  The underlying transport stops reading while they wait.
+    @type readLimit: L{corotwine.ratelimit.LimiterGroup}
+    @param writeLimit: If not C{None}, each connection gets a bucket from
+        this group, and writes block until they have spent a token for each
+        byte.
+    @type writeLimit: L{corotwine.ratelimit.LimiterGroup}
+    @param acceptLimit: If not C{None}, the listener gets a bucket from this
+        group, and each connection's greenlet function is only called once
+        it has spent a token.  Connections wait their turn as if
+        C{maxConnections} had been reached.
+    @type acceptLimit: L{corotwine.ratelimit.LimiterGroup}
+    @param socketOptions: If not C{None}, options to set on each
+        connection's socket before its greenlet function is called.
+    @type socketOptions: L{corotwine.sockopt.SocketOptions}
+    @param memoryBudget: If not C{None}, a limit on the memory used by the
+        greenlets handling connections.  While they use more, new
+        connections are closed without being handled.
+    @type memoryBudget: L{corotwine.memory.MemoryBudget}
+    @param admissionPolicy: If not C{None}, how to turn connections away
+        while the reactor is running timers late: by pausing accepting,
+        closing new connections, or closing queued ones.
+    @type admissionPolicy: L{corotwine.admission.AdmissionPolicy}
+
+    @return: A handle on the server, with which it can be shut down.
+    @rtype: L{GreenletServer}
     """
     if reactor is None:
         from twisted.internet import reactor
-    reactor.listenTCP(port, _GreenletFactory(function))
+    factory = _GreenletFactory(function, idleTimeout, reactor, maxConnections,
+                               readLimit, writeLimit, acceptLimit,
+                               socketOptions, memoryBudget, admissionPolicy)
+    return GreenletServer(reactor.listenTCP(port, factory), factory)
 
 
 
@@ -278,13 +1286,16 @@ class _GreenletClientProtocol(_GreenletProtocol):
     Mostly this exists because of special needs in L{connectionMade}.
     """
 
-    def __init__(self, deferred, greenlet):
+    def __init__(self, deferred, greenlet, socketOptions=None):
         """
         @param deferred: A Deferred to fire when a connection is made.
         @param greenlet: The greenlet to hook up to the L{GreenletTransport}.
+        @param socketOptions: The L{corotwine.sockopt.SocketOptions} to set
+            on the connection, or C{None}.
         """
         self._deferred = deferred
         self.greenlet = greenlet
+        self._socketOptions = socketOptions
 
 
     def connectionMade(self):
@@ -292,18 +1303,60 @@ class _GreenletClientProtocol(_GreenletProtocol):
         Fire the previously specified deferred with a fresh
         L{GreenletTransport}.
         """
-        self._buffer = ""
+        self._buffer = []
         self.transport.registerProducer(self, True)
         self.gtransport = GreenletTransport(self.transport, self)
+        self._meter()
+        if self._socketOptions is not None:
+            self._socketOptions.apply(self.gtransport)
         self._deferred.callback(self.gtransport)
 
 
 
-def gConnectTCP(host, port, reactor=None):
+class _GreenletClientFactory(ClientFactory):
+    """
+    A factory for one L{_GreenletClientProtocol}, which reports a failure to
+    connect.
+    """
+
+    def __init__(self, deferred, greenlet, socketOptions=None):
+        """
+        @param deferred: A L{Deferred} to fire with the L{GreenletTransport}
+            when the connection is made, or to fail if it can't be.
+        @param greenlet: See L{_GreenletClientProtocol}.
+        @param socketOptions: See L{_GreenletClientProtocol}.
+        """
+        self._deferred = deferred
+        self._greenlet = greenlet
+        self._socketOptions = socketOptions
+
+
+    def buildProtocol(self, addr):
+        return _GreenletClientProtocol(
+            self._deferred, self._greenlet, self._socketOptions)
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self._deferred.errback(reason)
+
+
+
+def gConnectTCP(host, port, reactor=None, socketOptions=None, resolver=None):
     """
     Return a L{GreenletTransport} connected to the given host and port.
 
     This function must NOT be called from the reactor's greenlet.
+
+    @param socketOptions: If not C{None}, options to set on the connection's
+        socket.
+    @type socketOptions: L{corotwine.sockopt.SocketOptions}
+    @param resolver: The resolver to look up C{host} with, and to race
+        connections to its addresses.  Defaults to
+        L{corotwine.resolver.defaultResolver}.
+    @type resolver: L{corotwine.resolver.Resolver}
+
+    @raise DNSLookupError: If C{host} could not be resolved.
+    @raise ConnectError: If the connection could not be made.
     """
     from corotwine.defer import blockOn
     current = greenlet.getcurrent()
@@ -311,8 +1364,93 @@ def gConnectTCP(host, port, reactor=None):
         "Don't run gConnectTCP from the reactor greenlet."
     if reactor is None:
         from twisted.internet import reactor
+    if resolver is None:
+        from corotwine.resolver import defaultResolver as resolver
+    abandoned = []
+    def connected(transport):
+        if abandoned:
+            transport.close()
+        return transport
+    connecting = resolver.connectTCP(
+        reactor, host, port,
+        lambda d: _GreenletClientFactory(d, current, socketOptions))
+    connecting.addCallback(connected)
+    try:
+        return blockOn(connecting)
+    except:
+        # An exception was thrown into us, e.g. by corotwine.hedge
+        # cancelling us; if the connection is made anyway, close it.
+        abandoned.append(True)
+        raise
+
+
+
+def gListen(endpointDescription, function, reactor=None, idleTimeout=None,
+            maxConnections=None, readLimit=None, writeLimit=None,
+            acceptLimit=None, socketOptions=None, memoryBudget=None,
+            admissionPolicy=None):
+    """
+    Listen on a server endpoint and handle connections with the given greenlet
+    function, as per L{gListenTCP}.
+
+    @param endpointDescription: A server endpoint description string, such as
+        C{"tcp:8080"}, C{"unix:/var/run/app.sock"} or
+        C{"ssl:443:privateKey=key.pem:certKey=cert.pem"}.  See
+        L{twisted.internet.endpoints.serverFromString}.
+    @type endpointDescription: C{str}
+    @param function: The greenlet function to call for each incoming
+        connection.
+    @type function: Callable of one argument, L{GreenletTransport}
+    @param idleTimeout: See L{gListenTCP}.
+    @param maxConnections: See L{gListenTCP}.
+    @param readLimit: See L{gListenTCP}.
+    @param writeLimit: See L{gListenTCP}.
+    @param acceptLimit: See L{gListenTCP}.
+    @param socketOptions: See L{gListenTCP}.
+    @param memoryBudget: See L{gListenTCP}.
+    @param admissionPolicy: See L{gListenTCP}.
+
+    @return: A Deferred which fires with a handle on the server when
+        listening has started.
+    @rtype: L{Deferred} firing with L{GreenletServer}
+    """
+    from twisted.internet.endpoints import serverFromString
+    if reactor is None:
+        from twisted.internet import reactor
+    endpoint = serverFromString(reactor, endpointDescription)
+    factory = _GreenletFactory(function, idleTimeout, reactor, maxConnections,
+                               readLimit, writeLimit, acceptLimit,
+                               socketOptions, memoryBudget, admissionPolicy)
+    d = endpoint.listen(factory)
+    d.addCallback(GreenletServer, factory)
+    return d
+
+
+
+def gConnect(endpointDescription, reactor=None, socketOptions=None):
+    """
+    Return a L{GreenletTransport} connected to the given client endpoint.
+
+    This function must NOT be called from the reactor's greenlet.
+
+    @param endpointDescription: A client endpoint description string, such as
+        C{"tcp:host=example.com:port=80"} or
+        C{"unix:path=/var/run/app.sock"}.  See
+        L{twisted.internet.endpoints.clientFromString}.
+    @type endpointDescription: C{str}
+    @param socketOptions: See L{gConnectTCP}.
+
+    @raise ConnectError: If the connection could not be made.
+    """
+    from twisted.internet.endpoints import clientFromString
+    from corotwine.defer import blockOn
+    current = greenlet.getcurrent()
+    assert current is not MAIN, \
+        "Don't run gConnect from the reactor greenlet."
+    if reactor is None:
+        from twisted.internet import reactor
     d = Deferred()
-    f = ClientFactory()
-    f.protocol = lambda: _GreenletClientProtocol(d, current)
-    reactor.connectTCP(host, port, f)
+    f = _GreenletClientFactory(d, current, socketOptions)
+    endpoint = clientFromString(reactor, endpointDescription)
+    endpoint.connect(f).addErrback(d.errback)
     return blockOn(d)
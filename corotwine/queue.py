@@ -0,0 +1,167 @@
+"""
+A queue for passing objects between greenlets.
+"""
+
+from collections import deque
+
+from corotwine import greenlet, MAIN
+
+
+__all__ = ["Queue"]
+
+
+class Queue(object):
+    """
+    A first-in, first-out queue whose C{get} blocks while it is empty and,
+    if it has a C{maxSize}, whose C{put} blocks while it is full.
+
+    Blocked greenlets are woken from the reactor's greenlet, on the next
+    reactor iteration, so that a greenlet putting or getting an object is
+    never left suspended by the greenlet it wakes.  A blocked greenlet which
+    an exception is thrown into stops waiting: if a getter had already been
+    handed an object, it goes to the next getter, or back to the front of
+    the queue, and if a putter's object had already been added to the
+    queue, it stays there.
+
+    @ivar maxSize: The number of objects the queue can hold, or C{None} if
+        it is unbounded.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        wake blocked greenlets with.
+    @ivar _items: A deque of the objects in the queue.
+    @ivar _getters: A deque of waiters for the greenlets blocked in L{get}.
+    @ivar _putters: A deque of waiters for the greenlets blocked in L{put}.
+        A waiter is a list of the greenlet, the object it is putting or
+        has been handed, and the delayed call which will wake it, or
+        C{None} until it is taken off the deque.
+    @ivar _selectors: See L{corotwine.select}.
+    """
+
+    def __init__(self, maxSize=None, clock=None):
+        """
+        @param maxSize: See L{maxSize}.
+        @param clock: See L{clock}.  Defaults to the reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxSize = maxSize
+        self.clock = clock
+        self._items = deque()
+        self._getters = deque()
+        self._putters = deque()
+        self._selectors = None
+
+
+    def __len__(self):
+        """
+        Return the number of objects in the queue.
+        """
+        return len(self._items)
+
+
+    def _selectReady(self):
+        """
+        Return whether L{get} would return without blocking.
+        """
+        return bool(self._items)
+
+
+    def full(self):
+        """
+        Return whether L{put} would block.
+        """
+        return self.maxSize is not None and len(self._items) >= self.maxSize
+
+
+    def put(self, item):
+        """
+        Add C{item} to the end of the queue, blocking while it is full.
+
+        This must not be called from the reactor's greenlet if the queue
+        might be full.
+        """
+        if self._getters:
+            self._wake(self._getters.popleft(), item)
+            return
+        if self.full():
+            current = greenlet.getcurrent()
+            assert current is not MAIN, \
+                "Don't block on a full Queue from the reactor greenlet."
+            waiter = [current, item, None]
+            self._putters.append(waiter)
+            try:
+                MAIN.switch()
+            except:
+                if waiter[2] is None:
+                    self._putters.remove(waiter)
+                else:
+                    waiter[2].cancel()
+                raise
+            return
+        self._items.append(item)
+        self._notify()
+
+
+    def _notify(self):
+        """
+        Wake the greenlets selecting on the queue, which has an object.
+        """
+        if self._selectors:
+            from corotwine.select import _notify
+            _notify(self)
+
+
+    def _wake(self, waiter, item):
+        """
+        Hand C{item} to the greenlet of C{waiter}, which has been taken off
+        L{_getters} or L{_putters}, and switch to it on the next reactor
+        iteration.
+        """
+        waiter[1] = item
+        waiter[2] = self.clock.callLater(0, waiter[0].switch, item)
+
+
+    def get(self):
+        """
+        Remove and return the object at the front of the queue, blocking while
+        it is empty.
+
+        This function must be called from a non-reactor greenlet.
+        """
+        if not self._items:
+            waiter = [greenlet.getcurrent(), None, None]
+            self._getters.append(waiter)
+            try:
+                return MAIN.switch()
+            except:
+                if waiter[2] is None:
+                    self._getters.remove(waiter)
+                else:
+                    waiter[2].cancel()
+                    self._giveBack(waiter[1])
+                raise
+        item = self._items.popleft()
+        if self._putters:
+            putter = self._putters.popleft()
+            self._items.append(putter[1])
+            self._wake(putter, None)
+        return item
+
+
+    def _giveBack(self, item):
+        """
+        Return C{item}, which was handed to a getter which stopped waiting
+        before it got it, to the next getter, or to the front of the queue.
+        """
+        if self._getters:
+            self._wake(self._getters.popleft(), item)
+            return
+        self._items.appendleft(item)
+        self._notify()
+
+
+    def __iter__(self):
+        """
+        Yield the result of L{get} forever.
+        """
+        while True:
+            yield self.get()
@@ -0,0 +1,246 @@
+"""
+Token bucket rate limiting for greenlets.
+
+A L{LimiterGroup} defines a rate and a burst size, and hands out
+L{TokenBucket}s which each allow that rate.  For example, to limit each
+client of a server to 64KB/s of writes::
+
+    gListenTCP(8080, handler, writeLimit=LimiterGroup(64 * 1024))
+
+A bucket can also be used directly to limit anything else, such as the
+number of messages a connection handles per second::
+
+    messages = LimiterGroup(100)
+
+    def handler(transport):
+        bucket = messages.bucket()
+        for line in LineBuffer(transport):
+            bucket.consume(1)
+            ...
+
+All the buckets of a group share a single timer, which only runs while a
+greenlet is waiting for tokens.
+"""
+
+from collections import deque
+
+from corotwine import greenlet, MAIN
+
+
+__all__ = ["LimiterGroup", "TokenBucket"]
+
+
+class LimiterGroup(object):
+    """
+    A rate and burst size shared by a group of L{TokenBucket}s.
+
+    @ivar rate: The number of tokens added to each bucket every second.
+    @ivar burst: The most tokens a bucket can hold.
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        measure and wait for time with.
+    @ivar _waiting: The set of buckets which have waiters.
+    @ivar _call: The delayed call which will next serve waiters, or C{None}.
+    """
+
+    def __init__(self, rate, burst=None, clock=None):
+        """
+        @param rate: See L{rate}.  It must be more than 0.
+        @param burst: See L{burst}.  Defaults to C{rate}.
+        @param clock: See L{clock}.  Defaults to the reactor.
+        """
+        if not rate > 0:
+            raise ValueError("Rate must be more than 0, not %r" % (rate,))
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if burst is None:
+            burst = rate
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self._waiting = set()
+        self._call = None
+
+
+    def bucket(self):
+        """
+        @return: A new, full L{TokenBucket} in this group.
+        """
+        return TokenBucket(self)
+
+
+    def _schedule(self):
+        """
+        Make sure the timer will fire when the first waiter can be served.
+        """
+        delay = min(bucket._delay() for bucket in self._waiting)
+        if self._call is not None:
+            if self._call.getTime() <= self.clock.seconds() + delay:
+                return
+            self._call.cancel()
+        self._call = self.clock.callLater(delay, self._serve)
+
+
+    def _unwait(self, bucket):
+        """
+        Forget C{bucket}, which no longer has waiters, and stop the timer if
+        no bucket does.
+        """
+        self._waiting.discard(bucket)
+        if not self._waiting and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+
+    def _serve(self):
+        """
+        Serve every waiter whose bucket has enough tokens now.
+        """
+        self._call = None
+        for bucket in list(self._waiting):
+            bucket._serve()
+            if not bucket._waiters:
+                self._waiting.discard(bucket)
+        if self._waiting:
+            self._schedule()
+
+
+
+class TokenBucket(object):
+    """
+    A store of tokens which fills up at its group's rate.
+
+    Tokens are spent by L{consume}.  A request for more tokens than the burst
+    size is allowed once the bucket is full, and leaves it in debt, so that
+    a large write is delayed for as long as it would take to earn its tokens.
+
+    Requests are served in order, so a small one never overtakes a large one
+    waiting in the same bucket.
+
+    @ivar _group: The L{LimiterGroup}.
+    @ivar _tokens: The number of tokens as of L{_updated}.
+    @ivar _updated: When L{_tokens} was last brought up to date.
+    @ivar _waiters: A deque of C{(amount, callback)} for the requests which
+        are waiting.
+    """
+
+    def __init__(self, group):
+        """
+        @param group: See L{_group}.
+        """
+        self._group = group
+        self._tokens = group.burst
+        self._updated = group.clock.seconds()
+        self._waiters = deque()
+
+
+    @property
+    def tokens(self):
+        """
+        The number of tokens in the bucket now.  This is negative if the
+        bucket is in debt.
+        """
+        self._refill()
+        return self._tokens
+
+
+    def _refill(self):
+        now = self._group.clock.seconds()
+        self._tokens = min(
+            self._group.burst,
+            self._tokens + (now - self._updated) * self._group.rate)
+        self._updated = now
+
+
+    def _needed(self, amount):
+        """
+        @return: The number of tokens which must be in the bucket before
+            C{amount} can be spent.
+        """
+        return min(amount, self._group.burst)
+
+
+    def _delay(self):
+        """
+        @return: The number of seconds until the first waiter can be served.
+        """
+        self._refill()
+        needed = self._needed(self._waiters[0][0])
+        return max(0, (needed - self._tokens) / self._group.rate)
+
+
+    def _serve(self):
+        """
+        Serve waiters, in order, for as long as there are tokens.
+        """
+        self._refill()
+        while self._waiters:
+            amount, callback = self._waiters[0]
+            if self._tokens < self._needed(amount):
+                return
+            self._waiters.popleft()
+            self._tokens -= amount
+            callback()
+
+
+    def tryConsume(self, amount):
+        """
+        Spend C{amount} tokens if that can be done without waiting.
+
+        @return: Whether the tokens were spent.
+        """
+        if self._waiters:
+            return False
+        self._refill()
+        if self._tokens < self._needed(amount):
+            return False
+        self._tokens -= amount
+        return True
+
+
+    def whenAvailable(self, amount, callback):
+        """
+        Spend C{amount} tokens as soon as there are enough, and then call
+        C{callback} with no arguments.  It will be called from the reactor's
+        greenlet, unless the tokens are available straight away.
+        """
+        if self.tryConsume(amount):
+            callback()
+            return
+        self._waiters.append((amount, callback))
+        self._group._waiting.add(self)
+        self._group._schedule()
+
+
+    def _cancel(self, amount, callback):
+        """
+        Stop waiting to spend C{amount} tokens and call C{callback}, if that
+        request has not been served yet.
+        """
+        try:
+            self._waiters.remove((amount, callback))
+        except ValueError:
+            return
+        if self._waiters:
+            # The request behind it may be served sooner.
+            self._group._schedule()
+        else:
+            self._group._unwait(self)
+
+
+    def consume(self, amount):
+        """
+        Spend C{amount} tokens, blocking until there are enough.
+
+        This function must be called from a non-reactor greenlet.  If an
+        exception is thrown into it while it waits, the request is withdrawn,
+        and no tokens are spent.
+        """
+        if self.tryConsume(amount):
+            return
+        callback = greenlet.getcurrent().switch
+        self.whenAvailable(amount, callback)
+        try:
+            MAIN.switch()
+        except:
+            self._cancel(amount, callback)
+            raise
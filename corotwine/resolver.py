@@ -0,0 +1,416 @@
+"""
+Cached, asynchronous host name resolution for greenlets.
+
+L{corotwine.protocol.gConnectTCP} resolves host names with
+L{defaultResolver}, which looks them up with the reactor's name resolver,
+that is, with C{getaddrinfo} in the reactor's thread pool, so that
+C{/etc/hosts}, nsswitch and the search domains of C{resolv.conf} apply as
+they do to other programs.  Answers are remembered for L{systemTTL}
+seconds, since C{getaddrinfo} doesn't say how long they are good for.
+Names which do not exist are remembered too, for C{negativeTTL} seconds.
+Greenlets which look up a name while a lookup of it is in progress share
+that lookup.
+
+A resolver made with C{lookup=namesLookup} asks the configured name servers
+with L{twisted.names} instead, without using threads, and remembers the
+answers for as long as their DNS records say.  L{twisted.names} doesn't
+apply search domains, so names must be fully qualified::
+
+    resolver = Resolver(lookup=namesLookup)
+    transport = gConnectTCP("db.example.com", 5432, resolver=resolver)
+
+When a name has both IPv6 and IPv4 addresses, connections are made with
+"happy eyeballs" (RFC 8305): addresses are tried alternately by family,
+starting with IPv6, and each attempt which has not succeeded after
+C{attemptDelay} seconds is raced by the next.  The first to connect wins,
+and the others are abandoned.
+
+A resolver can also be used directly::
+
+    for family, address in defaultResolver.resolve("example.com"):
+        ...
+"""
+
+import socket
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.interfaces import IResolutionReceiver
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.error import DNSLookupError
+from twisted.python.failure import Failure
+
+
+__all__ = ["Resolver", "defaultResolver", "systemLookup", "namesLookup"]
+
+
+# The seconds for which answers from systemLookup are remembered.
+systemTTL = 60
+
+
+@implementer(IResolutionReceiver)
+class _Addresses(object):
+    """
+    Gathers the addresses found by a reactor's name resolver.
+
+    @ivar addresses: A list of C{(family, address, ttl)}, without
+        duplicates.
+    @ivar deferred: A L{Deferred} which fires with L{addresses} when the
+        resolution is complete.
+    """
+
+    def __init__(self):
+        self.addresses = []
+        self.deferred = Deferred()
+
+
+    def resolutionBegan(self, resolution):
+        pass
+
+
+    def addressResolved(self, address):
+        family = socket.AF_INET
+        if isinstance(address, IPv6Address):
+            family = socket.AF_INET6
+        entry = (family, address.host, systemTTL)
+        if entry not in self.addresses:
+            self.addresses.append(entry)
+
+
+    def resolutionComplete(self):
+        self.deferred.callback(self.addresses)
+
+
+
+def systemLookup(host, reactor=None):
+    """
+    Look up the IPv4 and IPv6 addresses of C{host} with the reactor's name
+    resolver, which calls C{getaddrinfo} in the reactor's thread pool.
+
+    @return: A L{Deferred} firing with a list of C{(family, address, ttl)},
+        where C{ttl} is L{systemTTL}, or failing with L{DNSLookupError} if
+        the name does not exist.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    receiver = _Addresses()
+    reactor.nameResolver.resolveHostName(
+        receiver, host, 0, (IPv4Address, IPv6Address), "TCP")
+
+    def gotAddresses(addresses):
+        if not addresses:
+            raise DNSLookupError(host)
+        return addresses
+    return receiver.deferred.addCallback(gotAddresses)
+
+
+
+def namesLookup(host):
+    """
+    Look up the IPv4 and IPv6 addresses of C{host} with L{twisted.names},
+    which reads the hosts file and then asks the configured name servers.
+
+    @return: A L{Deferred} firing with a list of C{(family, address, ttl)},
+        or failing with L{DNSLookupError} if the name does not exist.
+    """
+    from twisted.names.client import getResolver
+    from twisted.names.dns import A, AAAA
+    resolver = getResolver()
+
+    def gotRecords(results):
+        addresses = []
+        for success, result in results:
+            if not success:
+                continue
+            for record in result[0]:
+                if record.type == A:
+                    addresses.append(
+                        (socket.AF_INET, record.payload.dottedQuad(),
+                         record.ttl))
+                elif record.type == AAAA:
+                    addresses.append(
+                        (socket.AF_INET6,
+                         socket.inet_ntop(socket.AF_INET6,
+                                          record.payload.address),
+                         record.ttl))
+        if not addresses:
+            for success, result in results:
+                if not success:
+                    raise DNSLookupError(host, result.getErrorMessage())
+            raise DNSLookupError(host)
+        return addresses
+
+    return DeferredList(
+        [resolver.lookupAddress(host), resolver.lookupIPV6Address(host)],
+        consumeErrors=True).addCallback(gotRecords)
+
+
+
+def _interleave(addresses):
+    """
+    Order C{addresses} for connecting, alternating between IPv6 and IPv4 and
+    starting with IPv6.
+
+    @param addresses: A list of C{(family, address)}.
+    """
+    families = {socket.AF_INET6: [], socket.AF_INET: []}
+    for family, address in addresses:
+        families.setdefault(family, []).append((family, address))
+    result = []
+    first, second = families[socket.AF_INET6], families[socket.AF_INET]
+    for i in range(max(len(first), len(second))):
+        result.extend(first[i:i + 1])
+        result.extend(second[i:i + 1])
+    return result
+
+
+
+class Resolver(object):
+    """
+    A cache of host name lookups.
+
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider
+        which cache entries expire by, or C{None} for the reactor.
+    @ivar maxTTL: The most seconds an answer is remembered for, whatever its
+        records say.
+    @ivar negativeTTL: The seconds for which a name which does not exist is
+        remembered.
+    @ivar maxSize: The most names to remember.  The least recently used is
+        forgotten to make room for a new one.
+    @ivar attemptDelay: The seconds each connection attempt gets before the
+        next address is tried alongside it.
+    @ivar _lookup: A function taking a host name and returning a
+        L{Deferred} which fires with a list of C{(family, address, ttl)}, or
+        fails with L{DNSLookupError} if the name does not exist.
+    @ivar _cache: An L{OrderedDict} mapping host names to C{(expires,
+        result)}, where C{result} is a list of C{(family, address)} or a
+        L{Failure}, least recently used first.
+    @ivar _pending: A C{dict} mapping host names being looked up to lists of
+        L{Deferred}s waiting for the answer.
+    """
+
+    def __init__(self, clock=None, lookup=systemLookup, maxTTL=300,
+                 negativeTTL=30, maxSize=1024, attemptDelay=0.25):
+        """
+        @param clock: See L{clock}.
+        @param lookup: See L{_lookup}.
+        """
+        self.clock = clock
+        self.maxTTL = maxTTL
+        self.negativeTTL = negativeTTL
+        self.maxSize = maxSize
+        self.attemptDelay = attemptDelay
+        self._lookup = lookup
+        self._cache = OrderedDict()
+        self._pending = {}
+
+
+    def resolveDeferred(self, host):
+        """
+        Find the addresses of C{host}, from the cache if they are there.
+
+        @return: A L{Deferred} firing with a list of C{(family, address)}, in
+            the order they should be connected to, or failing with
+            L{DNSLookupError}.
+        """
+        if isIPAddress(host):
+            return _succeed([(socket.AF_INET, host)])
+        if isIPv6Address(host):
+            return _succeed([(socket.AF_INET6, host)])
+        entry = self._cache.pop(host, None)
+        if entry is not None:
+            expires, result = entry
+            if expires > self._seconds():
+                self._cache[host] = entry
+                d = Deferred()
+                if isinstance(result, list):
+                    d.callback(list(result))
+                else:
+                    d.errback(result)
+                return d
+        d = Deferred()
+        if host in self._pending:
+            self._pending[host].append(d)
+            return d
+        self._pending[host] = [d]
+        self._lookup(host).addCallbacks(
+            self._found, self._notFound, (host,), None, (host,))
+        return d
+
+
+    def resolve(self, host):
+        """
+        Like L{resolveDeferred}, but block the calling greenlet until the
+        answer is known, and return it or raise L{DNSLookupError}.
+
+        This function must be called from a non-reactor greenlet.
+        """
+        from corotwine.defer import blockOn
+        return blockOn(self.resolveDeferred(host))
+
+
+    def forget(self, host):
+        """
+        Forget what is known about C{host}, so that the next request for it
+        looks it up again.
+        """
+        self._cache.pop(host, None)
+
+
+    def _seconds(self):
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        return clock.seconds()
+
+
+    def _remember(self, host, ttl, result):
+        if host not in self._cache and len(self._cache) >= self.maxSize:
+            self._cache.popitem(last=False)
+        self._cache[host] = (self._seconds() + ttl, result)
+
+
+    def _found(self, records, host):
+        """
+        Cache and hand out the answer to a lookup.
+        """
+        if not records:
+            self._notFound(Failure(DNSLookupError(host)), host)
+            return
+        ttl = min([self.maxTTL] + [record[2] for record in records])
+        addresses = _interleave(
+            [(family, address) for (family, address, recordTTL) in records])
+        self._remember(host, ttl, addresses)
+        for d in self._pending.pop(host):
+            d.callback(list(addresses))
+
+
+    def _notFound(self, failure, host):
+        """
+        Hand out the failure of a lookup, and cache it if the name does not
+        exist.  Other failures, such as timeouts, are not cached.
+        """
+        if failure.check(DNSLookupError):
+            self._remember(host, self.negativeTTL, failure)
+        for d in self._pending.pop(host):
+            d.errback(failure)
+
+
+    def connectTCP(self, reactor, host, port, factoryFor):
+        """
+        Resolve C{host} and connect to the first of its addresses which
+        accepts a connection, racing attempts as described in
+        L{corotwine.resolver}.
+
+        @param factoryFor: A function which takes a L{Deferred} and returns
+            a client factory which fires it with the connection's result
+            when it is made, or fails it if it can't be.  If more than one
+            attempt succeeds, the results of the losers must have a
+            C{close} method.
+
+        @return: A L{Deferred} firing with the result of the winning attempt,
+            or failing with the failure of the last attempt.
+        """
+        d = self.resolveDeferred(host)
+        d.addCallback(
+            lambda addresses: _HappyEyeballs(
+                reactor, addresses, port, factoryFor,
+                self.attemptDelay).start())
+        return d
+
+
+
+def _succeed(result):
+    d = Deferred()
+    d.callback(result)
+    return d
+
+
+
+class _HappyEyeballs(object):
+    """
+    A race to connect to one of several addresses.
+
+    @ivar _remaining: The C{(family, address)}s not yet tried.
+    @ivar _attempts: The connectors of the attempts in progress.
+    @ivar _timer: The delayed call which will start the next attempt, or
+        C{None}.
+    @ivar _result: The L{Deferred} returned by L{start}, or C{None} once it
+        has fired.
+    """
+
+    def __init__(self, reactor, addresses, port, factoryFor, attemptDelay):
+        self._reactor = reactor
+        self._remaining = list(addresses)
+        self._port = port
+        self._factoryFor = factoryFor
+        self._attemptDelay = attemptDelay
+        self._attempts = []
+        self._timer = None
+        self._result = Deferred()
+
+
+    def start(self):
+        result = self._result
+        self._next()
+        return result
+
+
+    def _next(self):
+        """
+        Start an attempt on the next address, and schedule the one after.
+        """
+        self._timer = None
+        family, address = self._remaining.pop(0)
+        attempt = Deferred()
+        connector = self._reactor.connectTCP(
+            address, self._port, self._factoryFor(attempt))
+        self._attempts.append(connector)
+        if self._remaining:
+            self._timer = self._reactor.callLater(
+                self._attemptDelay, self._next)
+        attempt.addCallbacks(self._connected, self._failed,
+                             (connector,), None, (connector,))
+
+
+    def _connected(self, result, connector):
+        self._attempts.remove(connector)
+        if self._result is None:
+            result.close()
+            return
+        d, self._result = self._result, None
+        self._stop()
+        d.callback(result)
+
+
+    def _failed(self, failure, connector):
+        self._attempts.remove(connector)
+        if self._result is None:
+            return
+        if self._remaining:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._next()
+        elif not self._attempts:
+            d, self._result = self._result, None
+            d.errback(failure)
+
+
+    def _stop(self):
+        """
+        Give up on the attempts which have not finished.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._remaining = []
+        for connector in self._attempts[:]:
+            if getattr(connector, "state", "connecting") == "connecting":
+                connector.stopConnecting()
+
+
+
+defaultResolver = Resolver()
@@ -0,0 +1,153 @@
+"""
+A run queue for waking greenlets.
+
+By default, a greenlet blocked in C{read}, C{write} or
+L{corotwine.defer.blockOn} is switched to as soon as what it is waiting for
+happens, from inside whatever reactor callback noticed it.  With a
+L{Scheduler} installed, woken greenlets are queued instead, and the queue is
+run once per reactor iteration::
+
+    Scheduler().install()
+
+This means:
+
+  - Data which arrives for a connection while its greenlet is queued is
+    added to what it will read, so several packets arriving in one
+    iteration cost one switch instead of several.
+  - Greenlets are always switched to from the reactor's greenlet, never
+    from inside another greenlet which fired a L{Deferred}, so switches
+    don't chain.
+  - Greenlets can be given priorities, so that, for example, the handlers
+    of control connections run before those of bulk transfers which were
+    woken in the same iteration::
+
+        def controlHandler(transport):
+            transport.setPriority(-1)
+            ...
+
+The cost is a little latency: a woken greenlet waits for the rest of the
+reactor iteration before it runs.
+"""
+
+from collections import deque
+
+from twisted.python import log
+
+from corotwine import greenlet
+
+
+__all__ = ["Scheduler", "setPriority", "getPriority"]
+
+
+# The installed Scheduler, or None to switch to woken greenlets directly.
+_current = None
+
+
+def setPriority(priority, g=None):
+    """
+    Set the priority of a greenlet for L{Scheduler}s.  Greenlets with lower
+    numbers run first; the default is C{0}.
+
+    @param g: The greenlet.  Defaults to the current one.
+    """
+    if g is None:
+        g = greenlet.getcurrent()
+    g._corotwinePriority = priority
+
+
+
+def getPriority(g=None):
+    """
+    Return the priority of a greenlet, which defaults to the current one.
+    """
+    if g is None:
+        g = greenlet.getcurrent()
+    return getattr(g, "_corotwinePriority", 0)
+
+
+
+class Scheduler(object):
+    """
+    A queue of calls which wake greenlets, run once per reactor iteration in
+    order of priority.
+
+    @ivar clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        schedule runs of the queue with.
+    @ivar calls: The number of calls queued.
+    @ivar runs: The number of times the queue has been run.
+    @ivar _queues: A C{dict} mapping priorities to C{deque}s of the calls
+        queued with them.
+    @ivar _call: The delayed call which will next run the queue, or
+        C{None}.
+    """
+
+    def __init__(self, clock=None):
+        """
+        @param clock: See L{clock}.  Defaults to the reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.calls = 0
+        self.runs = 0
+        self._queues = {}
+        self._call = None
+
+
+    def install(self):
+        """
+        Make this the scheduler which wakes greenlets, instead of switching
+        to them directly.
+        """
+        global _current
+        _current = self
+
+
+    def uninstall(self):
+        """
+        Go back to switching to woken greenlets directly.  Calls already
+        queued still run.
+        """
+        global _current
+        if _current is self:
+            _current = None
+
+
+    def call(self, function, priority=0):
+        """
+        Call C{function} with no arguments, from the reactor's greenlet, the
+        next time the queue is run.  Calls with lower C{priority} are made
+        first, and calls with the same priority in the order they were
+        queued.
+        """
+        self.calls += 1
+        try:
+            self._queues[priority].append(function)
+        except KeyError:
+            self._queues[priority] = deque([function])
+        if self._call is None:
+            self._call = self.clock.callLater(0, self._run)
+
+
+    def switch(self, g, *args):
+        """
+        Switch to C{g} with C{args} the next time the queue is run, with
+        C{g}'s priority.
+        """
+        self.call(lambda: g.switch(*args), getPriority(g))
+
+
+    def _run(self):
+        """
+        Make the calls queued before this run started.  Those queued while
+        it runs are made by the next run.  Exceptions they raise are logged.
+        """
+        self._call = None
+        self.runs += 1
+        queues, self._queues = self._queues, {}
+        for priority in sorted(queues):
+            for function in queues[priority]:
+                try:
+                    function()
+                except:
+                    log.err()
@@ -0,0 +1,145 @@
+"""
+Waiting for any of several things at once.
+
+A greenlet which handles several connections, such as a proxy, can wait for
+whichever of them has data first with L{select}::
+
+    while True:
+        for transport in select([client, server]):
+            other = server if transport is client else client
+            other.write(transport.read())
+
+L{select} understands L{corotwine.protocol.GreenletTransport}s, which are
+ready when C{read} would not block; L{corotwine.queue.Queue}s, which are
+ready when C{get} would not block; and L{Deferred}s, which are ready when
+they have fired.
+"""
+
+from twisted.internet.defer import Deferred
+
+from corotwine import greenlet, MAIN
+
+
+__all__ = ["select"]
+
+
+class _Selector(object):
+    """
+    A greenlet blocked in L{select}, registered in the C{_selectors} set of
+    each of the sources it is waiting for.
+
+    @ivar greenlet: The blocked greenlet.
+    @ivar clock: The clock to schedule its wake up with, if it is woken
+        from a greenlet other than the reactor's.
+    @ivar woken: Whether it has been woken already.
+    @ivar call: The delayed call which will resume the greenlet, if it was
+        woken from a greenlet other than the reactor's, or C{None}.
+    """
+
+    __slots__ = ["greenlet", "clock", "woken", "call"]
+
+    def __init__(self, greenlet, clock):
+        self.greenlet = greenlet
+        self.clock = clock
+        self.woken = False
+        self.call = None
+
+
+    def wake(self):
+        """
+        Resume the greenlet, unless that has been done already.
+        """
+        if self.woken:
+            return
+        self.woken = True
+        if greenlet.getcurrent() is MAIN:
+            self.greenlet.switch()
+        else:
+            self.call = self.clock.callLater(0, self.greenlet.switch)
+
+
+
+def _notify(source):
+    """
+    Wake every greenlet selecting on C{source}, which has become ready.
+    """
+    for selector in list(source._selectors):
+        selector.wake()
+
+
+
+def _notifyAndPass(result, d):
+    _notify(d)
+    return result
+
+
+
+def _register(source, selector):
+    """
+    Add C{selector} to the C{_selectors} set of C{source}.  A L{Deferred}
+    gets a set of its own, and one callback to notify it when it fires,
+    the first time it is selected on.
+    """
+    selectors = getattr(source, "_selectors", None)
+    if selectors is None:
+        selectors = source._selectors = set()
+        if isinstance(source, Deferred):
+            source.addBoth(_notifyAndPass, source)
+    selectors.add(selector)
+
+
+
+def _isReady(source):
+    if isinstance(source, Deferred):
+        return source.called
+    return source._selectReady()
+
+
+
+def select(sources, timeout=None, clock=None):
+    """
+    Block until at least one of C{sources} is ready or C{timeout} seconds
+    have passed, and return the ones which are ready.
+
+    The calling greenlet is registered with each source and resumed once,
+    by whichever becomes ready first.  All of the registrations, and any
+    wake up still scheduled, are removed when it resumes, however that
+    happens.
+
+    This function must be called from a non-reactor greenlet, unless none of
+    the sources can block.
+
+    @param sources: L{GreenletTransport}s, L{Queue}s and L{Deferred}s.
+    @type sources: C{list}
+    @param timeout: The most seconds to wait, or C{None} to wait forever.
+    @param clock: The L{twisted.internet.interfaces.IReactorTime} provider to
+        schedule the timeout with.  Defaults to the reactor.
+
+    @return: The ready sources, in the order they were given.  This is empty
+        if the timeout expired.
+    @rtype: C{list}
+    """
+    ready = [source for source in sources if _isReady(source)]
+    if ready or timeout == 0:
+        return ready
+    current = greenlet.getcurrent()
+    assert current is not MAIN, "Don't run select from the reactor greenlet."
+    if clock is None:
+        from twisted.internet import reactor as clock
+    selector = _Selector(current, clock)
+    for source in sources:
+        _register(source, selector)
+    call = None
+    if timeout is not None:
+        call = clock.callLater(timeout, selector.wake)
+    try:
+        MAIN.switch()
+    finally:
+        selector.woken = True
+        for source in sources:
+            source._selectors.discard(selector)
+        if call is not None and call.active():
+            call.cancel()
+        if selector.call is not None and selector.call.active():
+            selector.call.cancel()
+    return [source for source in sources if _isReady(source)]
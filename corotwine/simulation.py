@@ -0,0 +1,536 @@
+"""
+A deterministic, simulated network for load testing greenlet servers.
+
+L{simulateLoad} connects thousands of simulated clients to a greenlet server
+function in one process, with no real sockets.  Time is virtual, so a
+simulation of minutes of traffic over a slow network runs as fast as the
+server's code allows, and runs the same way every time::
+
+    def client(transport):
+        transport.write(b"hello")
+        transport.read()
+
+    report = simulateLoad(echo, client, clients=5000,
+                          network=SimulatedNetwork(latency=0.05,
+                                                   bandwidth=1000000))
+    print(report.throughput, report.fairness)
+
+Each direction of each connection delivers data after the network's
+C{latency}, no faster than its C{bandwidth}, and split into fragments of at
+most C{fragmentSize} bytes.  A sender whose unread data exceeds
+C{bufferSize} is paused with C{pauseProducing}, just as a real transport
+would be, so slow readers exercise the server's flow control.
+"""
+
+import os
+from heapq import heappush, heappop
+from itertools import count
+
+from twisted.internet.base import DelayedCall
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from corotwine.protocol import _GreenletFactory, _GreenletProtocol
+
+
+__all__ = ["SimulatedNetwork", "LoadReport", "simulateLoad"]
+
+
+class _SimulatedClock(Clock):
+    """
+    A L{Clock} which keeps its delayed calls in a heap, so that scheduling
+    one costs O(log n) instead of sorting them all.  A simulation of
+    thousands of connections has hundreds of thousands of calls pending.
+
+    Cancelled and rescheduled calls are left in the heap, and skipped when
+    they come to the top.
+
+    @ivar _heap: A heap of C{(time, sequence, call)}.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self._heap = []
+        self._sequence = count()
+
+
+    def callLater(self, when, what, *a, **kw):
+        call = DelayedCall(self.seconds() + when, what, a, kw,
+                           self._cancelled, self._push, self.seconds)
+        self._push(call)
+        return call
+
+
+    def _push(self, call):
+        heappush(self._heap, (call.getTime(), next(self._sequence), call))
+
+
+    def _cancelled(self, call):
+        pass
+
+
+    def _top(self):
+        """
+        Discard stale entries from the top of the heap, and return the first
+        live call, or C{None}.
+        """
+        heap = self._heap
+        while heap:
+            time, sequence, call = heap[0]
+            if not (call.cancelled or call.called) and call.getTime() == time:
+                return call
+            heappop(heap)
+        return None
+
+
+    def getDelayedCalls(self):
+        return [call for (time, sequence, call) in self._heap
+                if not (call.cancelled or call.called)
+                and call.getTime() == time]
+
+
+    def nextCallTime(self):
+        """
+        @return: When the next call is due, or C{None} if there are none.
+        """
+        call = self._top()
+        if call is None:
+            return None
+        return call.getTime()
+
+
+    def advance(self, amount):
+        self.rightNow += amount
+        while True:
+            call = self._top()
+            if call is None or call.getTime() > self.rightNow:
+                return
+            heappop(self._heap)
+            call.called = 1
+            call.func(*call.args, **call.kw)
+
+
+
+class _SimulatedAddress(object):
+    """
+    The address of one end of a simulated connection.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+
+    def __repr__(self):
+        return "<SimulatedAddress %s:%s>" % (self.host, self.port)
+
+
+
+class _SimulatedTransport(object):
+    """
+    One end of a simulated connection.  Data written to it is delivered to
+    the protocol at the other end.
+
+    @ivar network: The L{SimulatedNetwork}.
+    @ivar protocol: The protocol at this end.
+    @ivar peer: The L{_SimulatedTransport} at the other end.
+    @ivar bandwidth: The bytes per second this end can send, or C{None}.
+    @ivar producer: The registered producer, or C{None}.
+    @ivar producerPaused: Whether L{producer} has been paused.
+    @ivar pauses: The number of times L{producer} has been paused.
+    @ivar disconnecting: Whether L{loseConnection} has been called.
+    @ivar disconnected: Whether the connection has been lost.
+    @ivar bytesReceived: The number of bytes delivered to L{protocol}.
+    @ivar _unread: The number of bytes sent but not yet delivered to the
+        peer's protocol.
+    @ivar _sendFree: The time at which this end will have finished sending
+        what it has been given so far.
+    @ivar _readingPaused: Whether the protocol at this end has asked not to
+        be given any more data, with L{pauseProducing}.
+    @ivar _held: The fragments held back while L{_readingPaused}.
+    """
+
+    def __init__(self, network, protocol, host, port, bandwidth):
+        self.network = network
+        self.protocol = protocol
+        self.peer = None
+        self.bandwidth = bandwidth
+        self.producer = None
+        self.producerPaused = False
+        self.pauses = 0
+        self.disconnecting = False
+        self.disconnected = False
+        self.bytesReceived = 0
+        self._address = _SimulatedAddress(host, port)
+        self._unread = 0
+        self._sendFree = 0
+        self._readingPaused = False
+        self._held = []
+
+
+    def getHost(self):
+        return self._address
+
+
+    def getPeer(self):
+        return self.peer._address
+
+
+    def write(self, data):
+        """
+        Send C{data} to the peer, in fragments, and pause the producer if the
+        unread data has grown past the network's C{bufferSize}.
+        """
+        if self.disconnecting or self.disconnected or not data:
+            return
+        network = self.network
+        clock = network.clock
+        now = clock.seconds()
+        size = network.fragmentSize or len(data)
+        for offset in range(0, len(data), size):
+            fragment = data[offset:offset + size]
+            start = max(now, self._sendFree)
+            if self.bandwidth is not None:
+                self._sendFree = start + len(fragment) / float(self.bandwidth)
+            else:
+                self._sendFree = start
+            self._unread += len(fragment)
+            clock.callLater(self._sendFree + network.latency - now,
+                            self.peer._arrive, fragment)
+        if (self._unread > network.bufferSize and self.producer is not None
+            and not self.producerPaused):
+            self.producerPaused = True
+            self.pauses += 1
+            self.producer.pauseProducing()
+
+
+    def writeSequence(self, data):
+        self.write(b"".join(data))
+
+
+    def loseConnection(self):
+        """
+        Close the connection once everything written so far has arrived.
+        """
+        if self.disconnecting or self.disconnected:
+            return
+        self.disconnecting = True
+        network = self.network
+        delay = max(network.clock.seconds(), self._sendFree) + network.latency
+        network.clock.callLater(delay - network.clock.seconds(),
+                                self.peer._arrive, None)
+
+
+    def abortConnection(self):
+        self.loseConnection()
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    def pauseProducing(self):
+        """
+        Stop delivering data to the protocol at this end.
+        """
+        self._readingPaused = True
+
+
+    def resumeProducing(self):
+        """
+        Deliver any data held back by L{pauseProducing}, and carry on.
+        """
+        self._readingPaused = False
+        while self._held and not self._readingPaused:
+            self._deliver(self._held.pop(0))
+
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+    def _arrive(self, fragment):
+        """
+        A fragment sent by the peer has arrived.  C{None} means the peer has
+        closed the connection.
+        """
+        if self.disconnected:
+            return
+        if self._readingPaused or self._held:
+            self._held.append(fragment)
+        else:
+            self._deliver(fragment)
+
+
+    def _deliver(self, fragment):
+        if fragment is None:
+            self._lost()
+            self.peer._lost()
+            return
+        self.bytesReceived += len(fragment)
+        self.peer._delivered(len(fragment))
+        self.protocol.dataReceived(fragment)
+
+
+    def _delivered(self, amount):
+        """
+        The peer has delivered C{amount} of our bytes to its protocol.  Once
+        no more than half of the buffer is unread, resume the producer.
+        """
+        self._unread -= amount
+        if (self.producerPaused and self.producer is not None
+            and self._unread <= self.network.bufferSize // 2):
+            self.producerPaused = False
+            self.producer.resumeProducing()
+
+
+    def _lost(self):
+        if self.disconnected:
+            return
+        self.disconnected = True
+        self.network.connections.discard(self)
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+
+
+
+class SimulatedNetwork(object):
+    """
+    A network of simulated connections sharing a virtual clock.
+
+    @ivar clock: The L{Clock} that all timing is done with.  Give it to the
+        server and clients too, for things like L{corotwine.clock.wait}.
+        Simulations run much faster with the default, which schedules calls
+        in a heap, than with a plain L{Clock}.
+    @ivar latency: The seconds it takes data to cross the network.
+    @ivar bandwidth: The bytes per second each end of each connection can
+        send, or C{None} for no limit.
+    @ivar fragmentSize: The most bytes delivered by one C{dataReceived}
+        call, or C{None} to deliver each write whole.
+    @ivar bufferSize: The number of unread bytes after which a sender is
+        paused.
+    @ivar connections: The set of L{_SimulatedTransport}s whose connection
+        is open.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, fragmentSize=None,
+                 bufferSize=65536, clock=None):
+        if clock is None:
+            clock = _SimulatedClock()
+        self.clock = clock
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fragmentSize = fragmentSize
+        self.bufferSize = bufferSize
+        self.connections = set()
+        self._ports = count(1024)
+
+
+    def connect(self, serverFactory, clientProtocol, clientBandwidth=None):
+        """
+        Connect a client protocol to a protocol built by C{serverFactory}.
+
+        @param clientBandwidth: The bytes per second the client can receive,
+            to simulate a slow reader, or C{None} to use the network's
+            bandwidth.
+
+        @return: The server protocol.
+        """
+        port = next(self._ports)
+        serverProtocol = serverFactory.buildProtocol(None)
+        serverTransport = _SimulatedTransport(
+            self, serverProtocol, "server", 1, self.bandwidth)
+        clientTransport = _SimulatedTransport(
+            self, clientProtocol, "client", port, self.bandwidth)
+        if clientBandwidth is not None:
+            serverTransport.bandwidth = clientBandwidth
+        serverTransport.peer = clientTransport
+        clientTransport.peer = serverTransport
+        self.connections.add(serverTransport)
+        self.connections.add(clientTransport)
+        serverProtocol.makeConnection(serverTransport)
+        clientProtocol.makeConnection(clientTransport)
+        return serverProtocol
+
+
+    def run(self, until=None):
+        """
+        Run scheduled events in order until there are none left, or the clock
+        reaches C{until}.
+        """
+        clock = self.clock
+        while True:
+            if isinstance(clock, _SimulatedClock):
+                next = clock.nextCallTime()
+            else:
+                calls = clock.getDelayedCalls()
+                next = min([call.getTime() for call in calls] or [None])
+            if next is None:
+                return
+            if until is not None and next > until:
+                clock.advance(until - clock.seconds())
+                return
+            clock.advance(max(0, next - clock.seconds()))
+
+
+
+class LoadReport(object):
+    """
+    The results of L{simulateLoad}.
+
+    @ivar clients: The number of clients.
+    @ivar completed: The number of clients whose function returned.
+    @ivar errors: A list of L{Failure}s raised by client functions.
+    @ivar serverErrors: A list of L{Failure}s raised by the server function.
+    @ivar elapsed: The virtual seconds the simulation ran for.
+    @ivar bytesToServer: The bytes delivered to the server.
+    @ivar bytesToClients: The bytes delivered to the clients.
+    @ivar serverPauses: The number of times the server's connections were
+        paused because a client was not reading fast enough.
+    @ivar memoryPerConnection: The increase in the process's resident memory
+        while all clients were connected, divided by the number of clients,
+        or C{None} if it could not be measured.
+    @ivar clientBytes: A list of the bytes delivered to each client.
+    @ivar clientTimes: A list of the virtual seconds each completed client
+        took.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.completed = 0
+        self.errors = []
+        self.serverErrors = []
+        self.elapsed = 0.0
+        self.bytesToServer = 0
+        self.bytesToClients = 0
+        self.serverPauses = 0
+        self.memoryPerConnection = None
+        self.clientBytes = []
+        self.clientTimes = []
+
+
+    @property
+    def throughput(self):
+        """
+        The bytes delivered in both directions per virtual second.
+        """
+        if not self.elapsed:
+            return 0.0
+        return (self.bytesToServer + self.bytesToClients) / self.elapsed
+
+
+    @property
+    def fairness(self):
+        """
+        Jain's fairness index of the bytes delivered to each client: 1.0 when
+        every client got the same amount, and 1/n when one client got
+        everything.
+        """
+        total = sum(self.clientBytes)
+        squares = sum(x * x for x in self.clientBytes)
+        if not squares:
+            return 1.0
+        return float(total * total) / (len(self.clientBytes) * squares)
+
+
+    def __repr__(self):
+        return ("<LoadReport %d/%d clients completed in %.3fs, "
+                "%.0f bytes/s, fairness %.3f>" % (
+                    self.completed, self.clients, self.elapsed,
+                    self.throughput, self.fairness))
+
+
+
+def _residentSetSize():
+    """
+    Return the number of bytes of memory this process is using, or C{None} if
+    that can't be found out.
+    """
+    try:
+        statm = open("/proc/self/statm")
+    except IOError:
+        return None
+    try:
+        pages = int(statm.read().split()[1])
+    finally:
+        statm.close()
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+
+def simulateLoad(serverFunction, clientFunction, clients, network=None,
+                 slowReaders=0, slowReadRate=1024, duration=None,
+                 **listenerOptions):
+    """
+    Connect C{clients} simulated clients to a server and run them until they
+    are all finished, or for C{duration} virtual seconds.
+
+    @param serverFunction: The greenlet function handling each connection, as
+        for L{corotwine.protocol.gListenTCP}.
+    @param clientFunction: A greenlet function run for each client, which is
+        passed the client's L{GreenletTransport}.
+    @param clients: The number of clients.
+    @param network: The L{SimulatedNetwork} to use.  Defaults to one with no
+        latency and unlimited bandwidth.
+    @param slowReaders: How many of the clients only receive C{slowReadRate}
+        bytes per second.
+    @param duration: The most virtual seconds to run for, or C{None}.
+    @param listenerOptions: Options for the server, such as
+        C{maxConnections} or C{idleTimeout}, as for
+        L{corotwine.protocol.gListenTCP}.
+
+    @rtype: L{LoadReport}
+    """
+    if network is None:
+        network = SimulatedNetwork()
+    clock = network.clock
+    report = LoadReport(clients)
+    start = clock.seconds()
+    times = {}
+
+    def server(transport):
+        try:
+            serverFunction(transport)
+        except:
+            report.serverErrors.append(Failure())
+
+    def client(transport, index):
+        times[index] = clock.seconds()
+        try:
+            clientFunction(transport)
+        except:
+            report.errors.append(Failure())
+        else:
+            report.completed += 1
+            report.clientTimes.append(clock.seconds() - times[index])
+
+    factory = _GreenletFactory(server, clock=clock, **listenerOptions)
+    before = _residentSetSize()
+    clientTransports = []
+    for index in range(clients):
+        protocol = _GreenletProtocol(
+            lambda transport, index=index: client(transport, index))
+        bandwidth = None
+        if index < slowReaders:
+            bandwidth = slowReadRate
+        network.connect(factory, protocol, bandwidth)
+        clientTransports.append(protocol.transport)
+    after = _residentSetSize()
+    if before is not None and after is not None and clients:
+        report.memoryPerConnection = (after - before) / float(clients)
+
+    if duration is None:
+        network.run()
+    else:
+        network.run(start + duration)
+    report.elapsed = clock.seconds() - start
+    for transport in clientTransports:
+        report.clientBytes.append(transport.bytesReceived)
+        report.bytesToClients += transport.bytesReceived
+        report.bytesToServer += transport.peer.bytesReceived
+        report.serverPauses += transport.peer.pauses
+    return report
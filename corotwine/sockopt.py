@@ -0,0 +1,158 @@
+"""
+TCP socket options for greenlet connections.
+
+Each L{corotwine.protocol.GreenletTransport} can set its own options, for
+example to send small responses without waiting for Nagle's algorithm::
+
+    def handler(transport):
+        transport.setNoDelay()
+        for request in LineBuffer(transport):
+            ...
+
+or to send a header and a body in as few packets as possible::
+
+    with transport.cork():
+        transport.write(header)
+        transport.write(readBody())
+
+A L{SocketOptions} gives the same options to every connection of a listener
+or client, as in C{gListenTCP(8080, handler,
+socketOptions=SocketOptions(noDelay=True))}.
+
+Options which the platform does not support, options on connections which
+are not sockets (such as in-memory transports in tests), and TCP options,
+including keepalives, on sockets which are not TCP (such as UNIX sockets),
+are ignored.  Buffer sizes are set on any socket.
+"""
+
+import socket
+
+
+__all__ = ["SocketOptions"]
+
+
+def _isTCP(sock):
+    """
+    Return whether C{sock} is an IPv4 or IPv6 socket.
+    """
+    return sock.family in (socket.AF_INET, socket.AF_INET6)
+
+
+
+def _setOption(sock, level, name, value):
+    """
+    Set a socket option, if the platform has it, and, for an
+    C{IPPROTO_TCP} option, if the socket is TCP.
+
+    @param name: The name of the option's constant in the L{socket} module.
+    """
+    if sock is None or (level == socket.IPPROTO_TCP and not _isTCP(sock)):
+        return
+    option = getattr(socket, name, None)
+    if option is None:
+        return
+    sock.setsockopt(level, option, value)
+
+
+
+def setNoDelay(sock, enabled):
+    """
+    Turn Nagle's algorithm off (C{enabled} true) or on for C{sock}.
+    """
+    _setOption(sock, socket.IPPROTO_TCP, "TCP_NODELAY", int(bool(enabled)))
+
+
+
+def setCork(sock, enabled):
+    """
+    Turn C{TCP_CORK} on or off for C{sock}.  While it is on, the kernel
+    only sends full packets.  Platforms without C{TCP_CORK} use
+    C{TCP_NOPUSH} if they have it.
+    """
+    name = "TCP_CORK"
+    if not hasattr(socket, name):
+        name = "TCP_NOPUSH"
+    _setOption(sock, socket.IPPROTO_TCP, name, int(bool(enabled)))
+
+
+
+def setKeepAlive(sock, enabled, idle=None, interval=None, count=None):
+    """
+    Turn TCP keepalives on or off for C{sock}.
+
+    @param idle: The seconds a connection must be idle before the first
+        probe is sent, or C{None} for the system default.
+    @param interval: The seconds between probes, or C{None}.
+    @param count: The number of unanswered probes after which the connection
+        is dropped, or C{None}.
+    """
+    if sock is None or not _isTCP(sock):
+        return
+    _setOption(sock, socket.SOL_SOCKET, "SO_KEEPALIVE", int(bool(enabled)))
+    if not enabled:
+        return
+    if idle is not None:
+        # Darwin calls it TCP_KEEPALIVE.
+        name = "TCP_KEEPIDLE"
+        if not hasattr(socket, name):
+            name = "TCP_KEEPALIVE"
+        _setOption(sock, socket.IPPROTO_TCP, name, idle)
+    if interval is not None:
+        _setOption(sock, socket.IPPROTO_TCP, "TCP_KEEPINTVL", interval)
+    if count is not None:
+        _setOption(sock, socket.IPPROTO_TCP, "TCP_KEEPCNT", count)
+
+
+
+def setBufferSizes(sock, send=None, receive=None):
+    """
+    Set the kernel's send and receive buffer sizes for C{sock}, in bytes.
+    C{None} leaves a size as it is.
+    """
+    if send is not None:
+        _setOption(sock, socket.SOL_SOCKET, "SO_SNDBUF", send)
+    if receive is not None:
+        _setOption(sock, socket.SOL_SOCKET, "SO_RCVBUF", receive)
+
+
+
+class SocketOptions(object):
+    """
+    Socket options to set on each connection of a listener or client.  Each
+    option left as C{None} is not set, so the system default applies.
+
+    @ivar noDelay: Whether to turn Nagle's algorithm off.
+    @ivar keepAlive: Whether to send TCP keepalives.
+    @ivar keepAliveIdle: See L{setKeepAlive}'s C{idle}.
+    @ivar keepAliveInterval: See L{setKeepAlive}'s C{interval}.
+    @ivar keepAliveCount: See L{setKeepAlive}'s C{count}.
+    @ivar sendBuffer: The size of the kernel's send buffer.
+    @ivar receiveBuffer: The size of the kernel's receive buffer.
+    """
+
+    def __init__(self, noDelay=None, keepAlive=None, keepAliveIdle=None,
+                 keepAliveInterval=None, keepAliveCount=None, sendBuffer=None,
+                 receiveBuffer=None):
+        self.noDelay = noDelay
+        self.keepAlive = keepAlive
+        self.keepAliveIdle = keepAliveIdle
+        self.keepAliveInterval = keepAliveInterval
+        self.keepAliveCount = keepAliveCount
+        self.sendBuffer = sendBuffer
+        self.receiveBuffer = receiveBuffer
+
+
+    def apply(self, transport):
+        """
+        Set these options on a connection.
+
+        @type transport: L{corotwine.protocol.GreenletTransport}
+        """
+        if self.noDelay is not None:
+            transport.setNoDelay(self.noDelay)
+        if self.keepAlive is not None:
+            transport.setKeepAlive(
+                self.keepAliveIdle, self.keepAliveInterval,
+                self.keepAliveCount, self.keepAlive)
+        if self.sendBuffer is not None or self.receiveBuffer is not None:
+            transport.setBufferSizes(self.sendBuffer, self.receiveBuffer)
@@ -0,0 +1,219 @@
+"""
+Tests for L{corotwine.admission}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from corotwine.protocol import _GreenletFactory, GreenletServer
+from corotwine.admission import LagMonitor, AdmissionPolicy
+
+
+class FakePort(object):
+    """
+    A listening port which records whether it is paused.
+    """
+    paused = False
+
+    def stopListening(self):
+        pass
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+
+class LagMonitorTests(TestCase):
+    """
+    Tests for L{LagMonitor}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.monitor = LagMonitor(0.01, self.clock)
+
+
+    def test_lag(self):
+        """
+        Observers are called with how late the timer ran, each time it runs.
+        """
+        lags = []
+        self.monitor.addObserver(lags.append)
+        self.clock.advance(0.01)
+        self.clock.advance(0.5)
+        self.assertEquals(len(lags), 2)
+        self.assertEquals(lags[0], 0.0)
+        self.assertAlmostEqual(lags[1], 0.49)
+        self.assertAlmostEqual(self.monitor.lag, 0.49)
+
+
+    def test_removeObserver(self):
+        """
+        The timer stops when the last observer is removed.
+        """
+        lags = []
+        self.monitor.addObserver(lags.append)
+        self.monitor.addObserver(len)
+        self.monitor.removeObserver(len)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.monitor.removeObserver(lags.append)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+
+class AdmissionPolicyTests(TestCase):
+    """
+    Tests for L{AdmissionPolicy} applied to listeners.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.started = 0
+
+
+    def reader(self, transport):
+        """
+        Read until the connection is closed.
+        """
+        self.started += 1
+        try:
+            while True:
+                transport.read()
+        except ConnectionDone:
+            pass
+
+
+    def listen(self, policy, maxConnections=None):
+        self.port = FakePort()
+        self.factory = _GreenletFactory(
+            self.reader, clock=self.clock, maxConnections=maxConnections,
+            admissionPolicy=policy)
+        return GreenletServer(self.port, self.factory)
+
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport, protocol
+
+
+    def overload(self):
+        """
+        Make the reactor run the lag timer late for more than an interval.
+        """
+        self.clock.advance(0.5)
+        self.clock.advance(0.5)
+
+
+    def recover(self):
+        """
+        Let the reactor run the lag timer on time.
+        """
+        self.clock.advance(0.01)
+
+
+    def test_unknownAction(self):
+        """
+        An unknown action is rejected.
+        """
+        self.assertRaises(ValueError, AdmissionPolicy, action="panic")
+
+
+    def test_burst(self):
+        """
+        Lag above the target for less than an interval is tolerated.
+        """
+        server = self.listen(AdmissionPolicy())
+        self.connect()
+        self.clock.advance(0.5)
+        self.recover()
+        self.clock.advance(0.5)
+        self.assertFalse(server.overloaded)
+        self.assertFalse(self.connect()[0].disconnecting)
+        self.assertEquals(self.started, 2)
+
+
+    def test_reject(self):
+        """
+        While the listener is overloaded, new connections are written the
+        response and closed without being handled, until the lag falls
+        below the target again.
+        """
+        server = self.listen(AdmissionPolicy(response=b"busy\r\n"))
+        self.connect()
+        self.overload()
+        self.assertTrue(server.overloaded)
+        twistedTransport, protocol = self.connect()
+        self.assertTrue(twistedTransport.disconnecting)
+        self.assertEquals(twistedTransport.stream, [b"busy\r\n"])
+        self.assertEquals(self.started, 1)
+        self.assertEquals(server.admissionRejectedConnections, 1)
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(server.activeConnections, 1)
+
+        self.recover()
+        self.assertFalse(server.overloaded)
+        self.assertFalse(self.connect()[0].disconnecting)
+        self.assertEquals(self.started, 2)
+
+
+    def test_pause(self):
+        """
+        With the C{"pause"} action, the port stops accepting while the
+        listener is overloaded.
+        """
+        server = self.listen(AdmissionPolicy(action="pause"))
+        self.connect()
+        self.overload()
+        self.assertTrue(self.port.paused)
+        self.assertFalse(self.connect()[0].disconnecting)
+        self.assertEquals(server.admissionRejectedConnections, 0)
+        self.recover()
+        self.assertFalse(self.port.paused)
+
+
+    def test_shed(self):
+        """
+        With the C{"shed"} action, new connections are queued while the
+        listener is overloaded, those queued for longer than the interval
+        are closed, and the rest are started once it recovers.
+        """
+        server = self.listen(AdmissionPolicy(action="shed", response=b"x"))
+        self.connect()
+        self.overload()
+        old, oldProtocol = self.connect()
+        self.assertEquals(server.queuedConnections, 1)
+        self.clock.advance(0.5)
+        new, newProtocol = self.connect()
+        self.clock.advance(0.05)
+        self.assertTrue(old.disconnecting)
+        self.assertEquals(old.stream, [b"x"])
+        self.assertFalse(new.disconnecting)
+        self.assertEquals(server.admissionShedConnections, 1)
+        self.assertEquals(server.queuedConnections, 1)
+        self.assertEquals(self.started, 1)
+
+        self.recover()
+        self.assertEquals(server.queuedConnections, 0)
+        self.assertEquals(self.started, 2)
+
+
+    def test_idle(self):
+        """
+        The lag is only measured while the listener has connections, or is
+        overloaded.
+        """
+        self.listen(AdmissionPolicy())
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        twistedTransport, protocol = self.connect()
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.recover()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,156 @@
+"""
+Tests for L{corotwine.aio}.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+try:
+    from twisted.internet.asyncioreactor import AsyncioSelectorReactor
+except ImportError:
+    AsyncioSelectorReactor = None
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import CancelledError
+from twisted.internet.error import ConnectionDone
+
+from corotwine.aio import blockOnAwaitable, futureGreenlet
+from corotwine.protocol import gListenTCP, gConnectTCP
+from corotwine import greenlet
+
+
+class AwaitableTests(TestCase):
+    """
+    Tests for L{blockOnAwaitable} and L{futureGreenlet}.
+    """
+
+    if asyncio is None:
+        skip = "asyncio is not available."
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+
+    def runGreenlet(self, function, *args):
+        """
+        Run C{function} with L{futureGreenlet} and return its result.
+        """
+        return self.loop.run_until_complete(futureGreenlet(function)(*args))
+
+
+    def test_coroutine(self):
+        """
+        L{blockOnAwaitable} returns the result of a coroutine, run on the
+        current loop.
+        """
+        self.assertEquals(
+            self.runGreenlet(
+                lambda: blockOnAwaitable(asyncio.sleep(0, result=5))), 5)
+
+
+    def test_future(self):
+        """
+        L{blockOnAwaitable} waits for a future to get its result.
+        """
+        future = self.loop.create_future()
+        self.loop.call_later(0.01, future.set_result, "done")
+        self.assertEquals(self.runGreenlet(blockOnAwaitable, future), "done")
+
+
+    def test_exception(self):
+        """
+        L{blockOnAwaitable} raises the awaitable's exception.
+        """
+        future = self.loop.create_future()
+        future.set_exception(ZeroDivisionError())
+        def check():
+            self.assertRaises(ZeroDivisionError, blockOnAwaitable, future)
+            return "raised"
+        self.assertEquals(self.runGreenlet(check), "raised")
+
+
+    def test_cancelled(self):
+        """
+        L{blockOnAwaitable} raises L{CancelledError} if the future is
+        cancelled.
+        """
+        future = self.loop.create_future()
+        self.loop.call_soon(future.cancel)
+        def check():
+            self.assertRaises(CancelledError, blockOnAwaitable, future)
+            return "raised"
+        self.assertEquals(self.runGreenlet(check), "raised")
+
+
+    def test_futureGreenletException(self):
+        """
+        An exception raised by a L{futureGreenlet} function is set on its
+        future.
+        """
+        def fail():
+            blockOnAwaitable(asyncio.sleep(0))
+            1 / 0
+        self.assertRaises(ZeroDivisionError, self.runGreenlet, fail)
+
+
+    def test_futureGreenletSynchronous(self):
+        """
+        A L{futureGreenlet} function which does not block returns a future
+        which is already done, and keeps its name.
+        """
+        @futureGreenlet
+        def answer():
+            return 42
+        self.assertEquals(answer.__name__, "answer")
+        future = answer()
+        self.assertTrue(future.done())
+        self.assertEquals(future.result(), 42)
+
+
+
+class AsyncioReactorTests(TestCase):
+    """
+    Tests for running L{gListenTCP} and L{gConnectTCP} under Twisted's
+    asyncio reactor.
+    """
+
+    if AsyncioSelectorReactor is None:
+        skip = "twisted.internet.asyncioreactor is not available."
+
+    def test_echo(self):
+        """
+        A greenlet server and client on an asyncio reactor can talk to each
+        other, and the server's handler can wait for asyncio coroutines.
+        """
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        reactor = AsyncioSelectorReactor(loop)
+
+        def echo(transport):
+            try:
+                while True:
+                    data = transport.read()
+                    transport.write(
+                        blockOnAwaitable(asyncio.sleep(0, result=data)))
+            except ConnectionDone:
+                pass
+
+        @futureGreenlet
+        def client():
+            server = gListenTCP(0, echo, reactor=reactor)
+            transport = gConnectTCP(
+                "127.0.0.1", server.port.getHost().port, reactor=reactor)
+            transport.write(b"hello")
+            data = transport.read()
+            transport.close()
+            blockOnAwaitable(asyncio.sleep(0))
+            server.port.stopListening()
+            return data
+
+        self.assertEquals(loop.run_until_complete(client()), b"hello")
@@ -0,0 +1,264 @@
+"""
+Tests for L{corotwine.cache}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred, CancelledError
+
+from corotwine.cache import cached
+from corotwine.defer import blockOn, deferredGreenlet
+from corotwine import greenlet
+
+
+class CachedTests(TestCase):
+    """
+    Tests for L{cached} on greenlet functions which block.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.calls = []
+        self.requests = []
+        self.results = []
+
+
+    def fetch(self, key):
+        """
+        A greenlet function which blocks until the request for C{key} in
+        L{requests} is fired.
+        """
+        self.calls.append(key)
+        d = Deferred()
+        self.requests.append(d)
+        return blockOn(d)
+
+
+    def caller(self, function, *args):
+        """
+        Call C{function} in a new greenlet, appending its result, or the
+        exception it raises, to L{results}.
+        """
+        def run():
+            try:
+                self.results.append(function(*args))
+            except Exception as e:
+                self.results.append(e)
+        greenlet(run).switch()
+
+
+    def test_singleFlight(self):
+        """
+        Concurrent calls with the same arguments wait for the first caller's
+        call of the function, and are all given its result.
+        """
+        fetch = cached(clock=self.clock)(self.fetch)
+        for i in range(3):
+            self.caller(fetch, "key")
+        self.assertEquals(self.calls, ["key"])
+        self.requests[0].callback("value")
+        self.assertEquals(self.results, ["value"])
+        self.clock.advance(0)
+        self.assertEquals(self.results, ["value"] * 3)
+        self.assertEquals((fetch.cache.misses, fetch.cache.shared), (1, 2))
+
+
+    def test_hit(self):
+        """
+        A result is remembered, and later calls are answered with it without
+        calling the function.
+        """
+        fetch = cached(clock=self.clock)(self.fetch)
+        self.caller(fetch, "key")
+        self.requests[0].callback("value")
+        self.caller(fetch, "key")
+        self.assertEquals(self.calls, ["key"])
+        self.assertEquals(self.results, ["value", "value"])
+        self.assertEquals(fetch.cache.hits, 1)
+
+
+    def test_arguments(self):
+        """
+        Calls with different arguments, positional or keyword, are cached
+        separately.
+        """
+        @cached(clock=self.clock)
+        def add(a, b=0):
+            self.calls.append((a, b))
+            return a + b
+        self.assertEquals(add(1), 1)
+        self.assertEquals(add(1, b=2), 3)
+        self.assertEquals(add(1, b=2), 3)
+        self.assertEquals(add(2), 2)
+        self.assertEquals(self.calls, [(1, 0), (1, 2), (2, 0)])
+
+
+    def test_ttl(self):
+        """
+        A result expires C{ttl} seconds after it was remembered.
+        """
+        fetch = cached(ttl=10, clock=self.clock)(self.fetch)
+        self.caller(fetch, "key")
+        self.requests[0].callback("old")
+        self.clock.advance(9)
+        self.caller(fetch, "key")
+        self.assertEquals(self.calls, ["key"])
+        self.clock.advance(1)
+        self.caller(fetch, "key")
+        self.requests[1].callback("new")
+        self.assertEquals(self.calls, ["key", "key"])
+        self.assertEquals(self.results, ["old", "old", "new"])
+
+
+    def test_lru(self):
+        """
+        When more than C{maxsize} results would be remembered, the least
+        recently used is forgotten.
+        """
+        @cached(maxsize=2, clock=self.clock)
+        def identity(value):
+            self.calls.append(value)
+            return value
+        identity(1)
+        identity(2)
+        identity(1)
+        identity(3)
+        identity(1)
+        identity(2)
+        self.assertEquals(self.calls, [1, 2, 3, 2])
+
+
+    def test_errors(self):
+        """
+        An exception is raised to every caller waiting for the call which
+        raised it, but isn't remembered by default.
+        """
+        fetch = cached(clock=self.clock)(self.fetch)
+        self.caller(fetch, "key")
+        self.caller(fetch, "key")
+        self.requests[0].errback(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertEquals(len(self.results), 2)
+        for result in self.results:
+            self.assertIsInstance(result, ZeroDivisionError)
+        self.caller(fetch, "key")
+        self.assertEquals(self.calls, ["key", "key"])
+
+
+    def test_negativeTTL(self):
+        """
+        With C{negativeTTL}, an exception is remembered and raised to later
+        callers for that many seconds.
+        """
+        fetch = cached(ttl=60, negativeTTL=5, clock=self.clock)(self.fetch)
+        self.caller(fetch, "key")
+        self.requests[0].errback(ZeroDivisionError())
+        self.caller(fetch, "key")
+        self.assertIsInstance(self.results[1], ZeroDivisionError)
+        self.assertEquals(self.calls, ["key"])
+        self.clock.advance(5)
+        self.caller(fetch, "key")
+        self.assertEquals(self.calls, ["key", "key"])
+
+
+    def test_interrupted(self):
+        """
+        An exception thrown into the greenlet making a call is raised only
+        to it and isn't remembered, even with C{negativeTTL}, and a caller
+        waiting for the call makes it again.
+        """
+        fetch = cached(negativeTTL=5, clock=self.clock)(self.fetch)
+        owner = greenlet(lambda: self.results.append(fetch("key")))
+        owner.switch()
+        self.caller(fetch, "key")
+        self.assertRaises(CancelledError, owner.throw, CancelledError())
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ["key", "key"])
+        self.requests[1].callback("value")
+        self.assertEquals(self.results, ["value"])
+        self.caller(fetch, "key")
+        self.assertEquals(self.results, ["value", "value"])
+        self.assertEquals(self.calls, ["key", "key"])
+
+
+    def test_invalidate(self):
+        """
+        L{Cache.invalidate} forgets the result for some arguments, and
+        L{Cache.clear} forgets them all.
+        """
+        fetch = cached(clock=self.clock)(self.fetch)
+        self.caller(fetch, "a")
+        self.requests[0].callback(1)
+        self.caller(fetch, "b")
+        self.requests[1].callback(2)
+        fetch.cache.invalidate("a")
+        self.caller(fetch, "a")
+        self.caller(fetch, "b")
+        self.assertEquals(self.calls, ["a", "b", "a"])
+        fetch.cache.clear()
+        self.caller(fetch, "b")
+        self.assertEquals(self.calls, ["a", "b", "a", "b"])
+
+
+
+class CachedDeferredTests(TestCase):
+    """
+    Tests for L{cached} on functions decorated with L{deferredGreenlet}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.calls = []
+        self.requests = []
+        @cached(negativeTTL=1, clock=self.clock)
+        @deferredGreenlet
+        def fetch(key):
+            self.calls.append(key)
+            d = Deferred()
+            self.requests.append(d)
+            return blockOn(d)
+        self.fetch = fetch
+
+
+    def test_singleFlight(self):
+        """
+        Concurrent calls each get their own L{Deferred}, all fired with the
+        result of one call of the function.
+        """
+        first, second = self.fetch("key"), self.fetch("key")
+        self.assertNotIdentical(first, second)
+        self.assertEquals(self.calls, ["key"])
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        self.requests[0].callback("value")
+        self.clock.advance(0)
+        self.assertEquals(results, ["value", "value"])
+
+
+    def test_hit(self):
+        """
+        A remembered result is given to later callers in a fired
+        L{Deferred}.
+        """
+        self.fetch("key")
+        self.requests[0].callback("value")
+        self.clock.advance(0)
+        results = []
+        self.fetch("key").addCallback(results.append)
+        self.assertEquals(results, ["value"])
+        self.assertEquals(self.calls, ["key"])
+
+
+    def test_negativeTTL(self):
+        """
+        A remembered failure is given to later callers in a failed
+        L{Deferred}.
+        """
+        self.assertFailure(self.fetch("key"), ZeroDivisionError)
+        self.requests[0].errback(ZeroDivisionError())
+        self.clock.advance(0)
+        d = self.assertFailure(self.fetch("key"), ZeroDivisionError)
+        self.assertEquals(self.calls, ["key"])
+        return d
+
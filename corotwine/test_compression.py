@@ -0,0 +1,309 @@
+"""
+Tests for L{corotwine.compression}.
+"""
+
+import os
+import zlib
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.internet.error import ConnectionDone
+
+from corotwine.compression import CompressedTransport, FORMATS
+from corotwine.defer import deferredGreenlet
+from corotwine import greenlet
+
+
+class FakeTransport(object):
+    """
+    A greenlet transport which records what is written to it, and reads
+    from a list.
+
+    @ivar written: The data written.
+    @ivar toRead: The data which L{read} returns, in order, after which it
+        raises L{ConnectionDone}.
+    @ivar closed: Whether L{close} was called.
+    """
+
+    def __init__(self, toRead=()):
+        self.written = []
+        self.toRead = list(toRead)
+        self.closed = False
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def read(self):
+        if not self.toRead:
+            raise ConnectionDone()
+        return self.toRead.pop(0)
+
+
+    def close(self):
+        self.closed = True
+
+
+
+class CompressedTransportTests(TestCase):
+    """
+    Tests for L{CompressedTransport}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.transport = FakeTransport()
+
+
+    def compressed(self, **kwargs):
+        return CompressedTransport(self.transport, clock=self.clock,
+                                   reactor=self.clock, **kwargs)
+
+
+    def roundTrip(self, format):
+        """
+        Data written in C{format} and closed reads back the same.
+        """
+        writer = self.compressed(format=format)
+        writer.write(b"hello, ")
+        writer.write(bytearray(b"world"))
+        writer.close()
+        self.assertTrue(self.transport.closed)
+        reader = CompressedTransport(
+            FakeTransport(self.transport.written), format, clock=self.clock)
+        data = []
+        self.assertRaises(ConnectionDone,
+                          lambda: data.extend(iter(reader.read, None)))
+        self.assertEquals(b"".join(data), b"hello, world")
+
+
+    def test_zlib(self):
+        """
+        The C{"zlib"} format is a zlib stream.
+        """
+        self.roundTrip("zlib")
+        self.assertEquals(zlib.decompress(b"".join(self.transport.written)),
+                          b"hello, world")
+
+
+    def test_gzip(self):
+        """
+        The C{"gzip"} format has a gzip header.
+        """
+        self.roundTrip("gzip")
+        self.assertEquals(b"".join(self.transport.written)[:2], b"\x1f\x8b")
+
+
+    def test_deflate(self):
+        """
+        The C{"deflate"} format round trips.
+        """
+        self.roundTrip("deflate")
+
+
+    def test_bz2(self):
+        """
+        The C{"bz2"} format round trips.
+        """
+        self.roundTrip("bz2")
+    if "bz2" not in FORMATS:
+        test_bz2.skip = "The bz2 module is not available."
+
+
+    def test_unknownFormat(self):
+        """
+        An unknown format is rejected.
+        """
+        self.assertRaises(ValueError, self.compressed, format="rar")
+
+
+    def test_chunks(self):
+        """
+        Data bigger than C{chunkSize} is compressed a chunk at a time, and
+        the reactor is let run between chunks.
+        """
+        data = os.urandom(2500)
+        writer = self.compressed(chunkSize=1000)
+        done = []
+        def write():
+            writer.write(data)
+            done.append(True)
+        greenlet(write).switch()
+        self.assertEquals((writer.yields, done), (1, []))
+        self.clock.advance(0)
+        self.assertEquals((writer.yields, done), (2, [True]))
+        writer.finish()
+        self.assertEquals(zlib.decompress(b"".join(self.transport.written)),
+                          data)
+
+
+    def test_flush(self):
+        """
+        L{CompressedTransport.flush} writes what has been compressed so far,
+        so that it can all be decompressed, without ending the stream.
+        """
+        writer = self.compressed()
+        writer.write(b"hello")
+        writer.flush()
+        decompressor = zlib.decompressobj()
+        self.assertEquals(
+            decompressor.decompress(b"".join(self.transport.written)),
+            b"hello")
+        writer.write(b" again")
+        writer.finish()
+        self.assertEquals(zlib.decompress(b"".join(self.transport.written)),
+                          b"hello again")
+
+
+    def test_autoFlush(self):
+        """
+        With C{autoFlush}, each write can be decompressed as soon as it is
+        written.
+        """
+        writer = self.compressed(autoFlush=True)
+        decompressor = zlib.decompressobj()
+        for message in [b"one", b"two"]:
+            del self.transport.written[:]
+            writer.write(message)
+            self.assertEquals(
+                decompressor.decompress(b"".join(self.transport.written)),
+                message)
+
+
+    def test_unflushable(self):
+        """
+        Formats which can't be flushed refuse to.
+        """
+        if "bz2" not in FORMATS:
+            raise self.skipTest("The bz2 module is not available.")
+        self.assertRaises(ValueError, self.compressed(format="bz2").flush)
+        self.assertRaises(ValueError, self.compressed, format="bz2",
+                          autoFlush=True)
+
+
+    def test_writeAfterFinish(self):
+        """
+        Nothing can be written after the end of the stream.
+        """
+        writer = self.compressed()
+        writer.finish()
+        self.assertRaises(ValueError, writer.write, b"more")
+
+
+    def test_readSkipsEmpty(self):
+        """
+        L{CompressedTransport.read} keeps reading until there is some
+        decompressed data to return.
+        """
+        compressed = zlib.compress(b"hello")
+        reader = CompressedTransport(
+            FakeTransport([compressed[:1], compressed[1:]]),
+            clock=self.clock)
+        self.assertEquals(reader.read(), b"hello")
+        self.assertRaises(ConnectionDone, reader.read)
+
+
+    def boundedRead(self, format):
+        """
+        Decompressing data in C{format} which expands a lot returns at most
+        C{chunkSize} bytes from each read, and lets the reactor run between
+        them.
+        """
+        writer = self.compressed(format=format)
+        writer.write(b"\0" * 1000000)
+        writer.finish()
+        compressed = b"".join(self.transport.written)
+        self.assertTrue(len(compressed) < 10000)
+        reader = CompressedTransport(
+            FakeTransport([compressed]), format, chunkSize=4096,
+            clock=self.clock)
+        sizes = []
+        def read():
+            try:
+                while True:
+                    sizes.append(len(reader.read()))
+            except ConnectionDone:
+                sizes.append(None)
+        greenlet(read).switch()
+        while sizes[-1:] != [None]:
+            self.assertEquals(len(sizes), reader.yields)
+            self.clock.advance(0)
+        self.assertEquals(sum(sizes[:-1]), 1000000)
+        self.assertEquals(max(sizes[:-1]), 4096)
+
+
+    def test_boundedReadZlib(self):
+        """
+        Reads of zlib data are bounded by C{chunkSize}.
+        """
+        self.boundedRead("zlib")
+
+
+    def test_boundedReadBz2(self):
+        """
+        Reads of bz2 data are bounded by C{chunkSize}.
+        """
+        self.boundedRead("bz2")
+    if "bz2" not in FORMATS:
+        test_boundedReadBz2.skip = "The bz2 module is not available."
+
+
+    def test_boundedReadLzma(self):
+        """
+        Reads of lzma data are bounded by C{chunkSize}.
+        """
+        self.boundedRead("lzma")
+    if "lzma" not in FORMATS:
+        test_boundedReadLzma.skip = "The lzma module is not available."
+
+
+    def test_thread(self):
+        """
+        Payloads of C{threadThreshold} bytes or more are compressed in the
+        reactor's thread pool, in one go.
+        """
+        from twisted.internet import reactor
+        data = os.urandom(5000)
+        writer = CompressedTransport(self.transport, chunkSize=1000,
+                                     threadThreshold=4000, reactor=reactor)
+        @deferredGreenlet
+        def write():
+            writer.write(b"small")
+            writer.write(data)
+            writer.finish()
+        def check(result):
+            self.assertEquals(writer.yields, 0)
+            self.assertEquals(
+                zlib.decompress(b"".join(self.transport.written)),
+                b"small" + data)
+        return write().addCallback(check)
+
+
+    def test_backpressure(self):
+        """
+        Writes to a L{corotwine.protocol.GreenletTransport} whose writes are
+        paused block until they are resumed, between chunks.
+        """
+        from twisted.test.iosim import FakeTransport as TwistedTransport
+        from corotwine.protocol import _GreenletFactory
+        data = os.urandom(3000)
+        done = []
+        def handler(transport):
+            writer = CompressedTransport(transport, chunkSize=1000,
+                                         autoFlush=True, clock=self.clock)
+            writer.write(data)
+            writer.close()
+            done.append(True)
+        factory = _GreenletFactory(handler, clock=self.clock)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = TwistedTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        protocol.pauseProducing()
+        self.clock.advance(0)
+        self.assertEquals(done, [])
+        protocol.resumeProducing()
+        self.clock.advance(0)
+        self.assertEquals(done, [True])
+        self.assertEquals(zlib.decompress(b"".join(twistedTransport.stream)),
+                          data)
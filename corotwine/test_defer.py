@@ -44,7 +44,7 @@ class BlockOnTests(TestCase):
             events.append("waiting")
             try:
                 blockOn(deferred)
-            except Exception, e:
+            except Exception as e:
                 events.append(e)
         greenlet(catcher).switch()
         self.assertEquals(events, ["waiting"])
@@ -79,12 +79,35 @@ class BlockOnTests(TestCase):
             events.append("waiting")
             try:
                 blockOn(deferred)
-            except Exception, e:
+            except Exception as e:
                 events.append(e)
         greenlet(greeny).switch()
         self.assertEquals(events, ["waiting", e])
 
 
+    def test_resumedElsewhere(self):
+        """
+        If a greenlet blocked by L{blockOn} is resumed by something else,
+        the Deferred's result is dropped instead of being switched into
+        whatever the greenlet waits for next.
+        """
+        events = []
+        first, second = Deferred(), Deferred()
+        def greeny():
+            try:
+                blockOn(first)
+            except ZeroDivisionError:
+                events.append("interrupted")
+            events.append(blockOn(second))
+        g = greenlet(greeny)
+        g.switch()
+        g.throw(ZeroDivisionError())
+        first.callback("stale")
+        self.assertEquals(events, ["interrupted"])
+        second.callback("fresh")
+        self.assertEquals(events, ["interrupted", "fresh"])
+
+
 class DeferredGreenletTests(TestCase):
     """
     Tests for L{deferredGreenlet}.
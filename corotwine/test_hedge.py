@@ -0,0 +1,293 @@
+"""
+Tests for L{corotwine.hedge}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.internet.error import ConnectionDone
+
+from corotwine.hedge import Hedger, RetryBudget
+from corotwine.protocol import _GreenletFactory
+from corotwine.defer import blockOn
+from corotwine import greenlet
+
+
+class RetryBudgetTests(TestCase):
+    """
+    Tests for L{RetryBudget}.
+    """
+
+    def test_budget(self):
+        """
+        A budget starts full, and each request adds C{ratio} to it, up to
+        its capacity.
+        """
+        budget = RetryBudget(ratio=0.5, capacity=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        for i in range(10):
+            budget.deposit()
+        self.assertEquals(budget.balance, 2)
+
+
+
+class HedgerTests(TestCase):
+    """
+    Tests for L{Hedger}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.hedger = Hedger(maxDelay=1, backoff=0.5, clock=self.clock)
+        self.requests = {}
+        self.cancelled = []
+        self.results = []
+
+
+    def request(self, replica):
+        """
+        A request function which blocks until the test fires the
+        L{Deferred} for C{replica} in L{requests}.
+        """
+        d = Deferred()
+        self.requests[replica] = d
+        try:
+            return blockOn(d)
+        except CancelledError:
+            self.cancelled.append(replica)
+            raise
+
+
+    def call(self, replicas):
+        """
+        Call L{request} through the hedger in a new greenlet, and append its
+        result, or the exception it raises, to L{results}.
+        """
+        def run():
+            try:
+                self.results.append(self.hedger.call(self.request, replicas))
+            except Exception as e:
+                self.results.append(e)
+        greenlet(run).switch()
+        self.clock.advance(0)
+
+
+    def test_fast(self):
+        """
+        A request which is answered before the hedge delay isn't hedged.
+        """
+        self.call(["a", "b"])
+        self.assertEquals(list(self.requests), ["a"])
+        self.requests["a"].callback("answer")
+        self.clock.advance(0)
+        self.assertEquals(self.results, ["answer"])
+        self.clock.advance(1)
+        self.assertEquals(list(self.requests), ["a"])
+        self.assertEquals(self.hedger.hedgeRate, 0)
+
+
+    def test_hedgeWins(self):
+        """
+        A request which hasn't been answered after the hedge delay is sent
+        to the next replica too.  The first answer is returned, and the
+        other request is cancelled.
+        """
+        self.call(["a", "b"])
+        self.clock.advance(1)
+        self.assertEquals(sorted(self.requests), ["a", "b"])
+        self.requests["b"].callback("from b")
+        self.clock.advance(0)
+        self.assertEquals(self.results, ["from b"])
+        self.assertEquals(self.cancelled, ["a"])
+        self.assertEquals((self.hedger.hedges, self.hedger.hedgeWins), (1, 1))
+        self.assertEquals(self.hedger.hedgeWinRate, 1)
+
+
+    def test_originalWins(self):
+        """
+        If the original request answers first after all, the hedge is
+        cancelled.
+        """
+        self.call(["a", "b"])
+        self.clock.advance(1)
+        self.requests["a"].callback("from a")
+        self.clock.advance(0)
+        self.assertEquals(self.results, ["from a"])
+        self.assertEquals(self.cancelled, ["b"])
+        self.assertEquals(self.hedger.hedgeWinRate, 0)
+
+
+    def test_loserClosed(self):
+        """
+        A result returned by a request which lost is closed.
+        """
+        closed = []
+        class Result(object):
+            def close(self):
+                closed.append(self)
+        def request(replica):
+            if replica == "a":
+                return blockOn(self.requests.setdefault("a", Deferred()))
+            try:
+                blockOn(self.requests.setdefault("b", Deferred()))
+            except CancelledError:
+                return Result()
+        self.request = request
+        self.call(["a", "b"])
+        self.clock.advance(1)
+        self.requests["a"].callback("from a")
+        self.clock.advance(0)
+        self.assertEquals(self.results, ["from a"])
+        self.assertEquals(len(closed), 1)
+
+
+    def test_percentile(self):
+        """
+        The hedge delay is the given percentile of recent latencies, within
+        C{minDelay} and C{maxDelay}, once enough of them are known.
+        """
+        hedger = Hedger(percentile=50, window=10, minDelay=0.1, maxDelay=2)
+        self.assertEquals(hedger.delay(), 2)
+        hedger._observe(0.5)
+        self.assertEquals(hedger.delay(), 0.5)
+        for latency in [0.01, 0.02, 3]:
+            hedger._observe(latency)
+        self.assertEquals(hedger.delay(), 0.5)
+        hedger._observe(0.01)
+        self.assertEquals(hedger.delay(), 0.1)
+        for i in range(10):
+            hedger._observe(5)
+        self.assertEquals(hedger.delay(), 2)
+
+
+    def test_latencyObserved(self):
+        """
+        The latency of each winning request is observed.
+        """
+        self.call(["a", "b"])
+        self.clock.advance(0.25)
+        self.requests["a"].callback("answer")
+        self.assertEquals(self.hedger._sorted, [0.25])
+
+
+    def test_failureHedgedAtOnce(self):
+        """
+        If the original request fails before the hedge delay, the hedge is
+        sent straight away.
+        """
+        self.call(["a", "b"])
+        self.requests["a"].errback(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertEquals(sorted(self.requests), ["a", "b"])
+        self.requests["b"].callback("from b")
+        self.clock.advance(0)
+        self.assertEquals(self.results, ["from b"])
+
+
+    def test_retry(self):
+        """
+        A request which fails is retried on the next replica after a
+        backoff which doubles each time, until it has been retried
+        C{retries} times.
+        """
+        self.call(["a"])
+        for delay in [0.5, 1.0]:
+            self.requests.pop("a").errback(ZeroDivisionError())
+            self.clock.advance(0)
+            self.clock.advance(delay - 0.01)
+            self.assertEquals(self.requests, {})
+            self.clock.advance(0.01)
+            self.assertEquals(list(self.requests), ["a"])
+        self.requests["a"].errback(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertEquals(len(self.results), 1)
+        self.assertIsInstance(self.results[0], ZeroDivisionError)
+        self.assertEquals(self.hedger.retried, 2)
+
+
+    def test_budgetExhausted(self):
+        """
+        Hedges and retries aren't made when the retry budget is spent.
+        """
+        self.hedger.budget = RetryBudget(ratio=0, capacity=0)
+        self.call(["a", "b"])
+        self.clock.advance(1)
+        self.assertEquals(list(self.requests), ["a"])
+        self.requests["a"].errback(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertIsInstance(self.results[0], ZeroDivisionError)
+        self.assertEquals(self.hedger.budgetExhausted, 2)
+
+
+    def test_notRetried(self):
+        """
+        Exceptions which aren't in C{retryOn} are raised without a retry.
+        """
+        self.hedger.retryOn = (KeyError,)
+        self.call(["a"])
+        self.requests["a"].errback(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertIsInstance(self.results[0], ZeroDivisionError)
+        self.assertEquals(self.hedger.retried, 0)
+
+
+    def test_interrupted(self):
+        """
+        An exception thrown into the calling greenlet cancels the attempt in
+        progress and is raised without a retry.
+        """
+        caller = []
+        def run():
+            caller.append(greenlet.getcurrent())
+            try:
+                self.hedger.call(self.request, ["a", "b"])
+            except Exception as e:
+                self.results.append(e)
+        greenlet(run).switch()
+        self.clock.advance(0)
+        caller[0].throw(ConnectionDone())
+        self.clock.advance(0)
+        self.assertEquals(len(self.results), 1)
+        self.assertIsInstance(self.results[0], ConnectionDone)
+        self.assertEquals(self.cancelled, ["a"])
+        self.assertEquals(self.hedger.retried, 0)
+        self.clock.advance(1)
+        self.assertEquals(list(self.requests), ["a"])
+
+
+
+class CancelledReadTests(TestCase):
+    """
+    Tests for throwing an exception into a greenlet blocked in
+    L{corotwine.protocol.GreenletTransport.read}, as L{Hedger} does.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+
+
+    def test_stateReset(self):
+        """
+        The transport no longer thinks the greenlet is reading, so losing
+        the connection afterwards doesn't throw into it again.
+        """
+        events = []
+        def handler(transport):
+            try:
+                transport.read()
+            except CancelledError:
+                events.append("cancelled")
+        factory = _GreenletFactory(handler, clock=self.clock)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        protocol.greenlet.throw(CancelledError())
+        self.assertEquals(events, ["cancelled"])
+        self.assertIdentical(protocol.gtransport._state, None)
@@ -0,0 +1,90 @@
+"""
+Tests for the cost of importing Corotwine.
+"""
+
+import os, sys
+from subprocess import Popen, PIPE
+
+from twisted.trial.unittest import TestCase
+
+import corotwine
+
+
+# Modules which only some users need, and which take a long time to import.
+HEAVY = ["twisted.names", "twisted.web", "twisted.protocols.amp",
+         "twisted.protocols.tls", "twisted.internet.endpoints",
+         "twisted.internet.reactor", "OpenSSL.SSL"]
+
+
+def importedBy(*modules):
+    """
+    Import C{modules} in a new interpreter.
+
+    @return: The names of the modules that interpreter then has loaded.
+    """
+    path = os.path.dirname(os.path.dirname(os.path.abspath(
+        corotwine.__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [path] + [p for p in [env.get("PYTHONPATH")] if p])
+    process = Popen(
+        [sys.executable, "-c",
+         "import sys\n"
+         "for name in sys.argv[1:]: __import__(name)\n"
+         "sys.stdout.write(' '.join(name for name in sys.modules\n"
+         "                          if sys.modules[name] is not None))\n"]
+        + list(modules), stdout=PIPE, env=env)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError("Importing %s failed" % (modules,))
+    return set(output.decode("ascii").split())
+
+
+
+class LazyImportTests(TestCase):
+    """
+    Modules which only some users need are imported when they are used, not
+    when Corotwine is.
+    """
+
+    def assertNotImported(self, imported, names):
+        loaded = [name for name in imported
+                  for heavy in names
+                  if name == heavy or name.startswith(heavy + ".")]
+        self.assertEquals(loaded, [])
+
+
+    def test_package(self):
+        """
+        Importing C{corotwine} imports none of Twisted.
+        """
+        self.assertNotImported(importedBy("corotwine"), ["twisted"])
+
+
+    def test_defer(self):
+        """
+        L{corotwine.defer} does not need L{twisted.internet.protocol}.
+        """
+        self.assertNotImported(
+            importedBy("corotwine.defer", "corotwine.queue",
+                       "corotwine.select", "corotwine.local"),
+            HEAVY + ["twisted.internet.protocol"])
+
+
+    def test_protocol(self):
+        """
+        L{corotwine.protocol} doesn't import the resolver's L{twisted.names},
+        the endpoints used by C{gListen}, or the reactor.
+        """
+        self.assertNotImported(
+            importedBy("corotwine.protocol", "corotwine.clock",
+                       "corotwine.ratelimit", "corotwine.sockopt"),
+            HEAVY)
+
+
+    def test_examples(self):
+        """
+        L{corotwine.examples} leaves AMP and L{twisted.web} to
+        L{corotwine.ampexample}.
+        """
+        self.assertNotImported(importedBy("corotwine.examples"), HEAVY)
@@ -0,0 +1,157 @@
+"""
+Tests for L{corotwine.local}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.defer import Deferred
+
+from corotwine import greenlet
+from corotwine.local import GreenletLocal, inheritLocals, _locals
+from corotwine.defer import blockOn, deferredGreenlet
+from corotwine.protocol import _GreenletFactory
+
+
+class GreenletLocalTests(TestCase):
+    """
+    Tests for L{GreenletLocal}.
+    """
+
+    def test_perGreenlet(self):
+        """
+        Each greenlet sees its own attributes.
+        """
+        local = GreenletLocal()
+        local.value = "main"
+        seen = []
+        def other():
+            seen.append(getattr(local, "value", None))
+            local.value = "other"
+            seen.append(local.value)
+        greenlet(other).switch()
+        self.assertEquals(seen, [None, "other"])
+        self.assertEquals(local.value, "main")
+
+
+    def test_delete(self):
+        """
+        Attributes can be deleted, and deleting a missing one raises
+        C{AttributeError}.
+        """
+        local = GreenletLocal()
+        def run():
+            local.value = 1
+            del local.value
+            self.assertRaises(AttributeError, getattr, local, "value")
+            self.assertRaises(AttributeError, delattr, local, "value")
+        greenlet(run).switch()
+
+
+    def test_independentLocals(self):
+        """
+        Two locals do not share attributes.
+        """
+        first, second = GreenletLocal(), GreenletLocal()
+        def run():
+            first.value = 1
+            self.assertRaises(AttributeError, getattr, second, "value")
+        greenlet(run).switch()
+
+
+    def test_storedOnGreenlet(self):
+        """
+        The attributes are kept in the greenlet's context, so they go away
+        with it.
+        """
+        local = GreenletLocal()
+        def run():
+            local.value = 1
+        g = greenlet(run)
+        g.switch()
+        self.assertEquals(g.gr_context[_locals], {local: {"value": 1}})
+
+
+
+class InheritanceTests(TestCase):
+    """
+    Tests for passing L{GreenletLocal} attributes on to new greenlets.
+    """
+
+    def setUp(self):
+        self.inherited = GreenletLocal(inherit=True)
+        self.private = GreenletLocal()
+
+
+    def inParent(self, function):
+        """
+        Set both locals in a new greenlet, and call C{function} from it.
+        """
+        def parent():
+            self.inherited.value = "inherited"
+            self.private.value = "private"
+            function()
+        greenlet(parent).switch()
+
+
+    def seen(self):
+        return (getattr(self.inherited, "value", None),
+                getattr(self.private, "value", None))
+
+
+    def test_inheritLocals(self):
+        """
+        A function wrapped by L{inheritLocals} sees a copy of the inheriting
+        locals of the greenlet which wrapped it, and drops them when it
+        returns.
+        """
+        seen = []
+        children = []
+        def child():
+            seen.append(self.seen())
+            self.inherited.value = "changed"
+        def spawn():
+            children.append(greenlet(inheritLocals(child)))
+            children[0].switch()
+            seen.append(self.seen())
+        self.inParent(spawn)
+        self.assertEquals(seen, [("inherited", None),
+                                 ("inherited", "private")])
+        self.assertEquals(children[0].gr_context[_locals], {})
+
+
+    def test_deferredGreenlet(self):
+        """
+        A L{deferredGreenlet} function inherits its caller's inheriting
+        locals, and drops its locals when it finishes.
+        """
+        seen = []
+        d = Deferred()
+        @deferredGreenlet
+        def child():
+            seen.append(self.seen())
+            blockOn(d)
+            seen.append(greenlet.getcurrent())
+        self.inParent(child)
+        self.assertEquals(seen, [("inherited", None)])
+        d.callback(None)
+        self.assertEquals(seen[1].gr_context[_locals], {})
+
+
+    def test_handlers(self):
+        """
+        Connection handlers inherit the inheriting locals of the greenlet
+        which created the listener, and drop their locals when they finish.
+        """
+        seen = []
+        factories = []
+        def handler(transport):
+            seen.append(self.seen())
+            self.inherited.value = "changed"
+            seen.append(greenlet.getcurrent())
+        self.inParent(lambda: factories.append(_GreenletFactory(handler)))
+        for i in range(2):
+            protocol = factories[0].buildProtocol(None)
+            protocol.makeConnection(FakeTransport(protocol, True))
+        self.assertEquals(seen[0], ("inherited", None))
+        self.assertEquals(seen[2], ("inherited", None))
+        self.assertEquals(seen[1].gr_context[_locals], {})
@@ -0,0 +1,241 @@
+"""
+Tests for L{corotwine.memory}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from corotwine.protocol import _GreenletFactory, GreenletServer
+from corotwine.memory import (
+    MemoryBudget, MemoryUsage, greenletMemory, handlerMemory, liveGreenlets,
+    _handlerName)
+from corotwine import greenlet
+
+
+def deeply(depth, function, *args):
+    """
+    Call C{function} with C{depth} calls to C{map} on the C stack, so that a
+    greenlet which switches away in C{function} saves a large stack.  Calls
+    from one Python function to another don't use the C stack on some
+    versions of Python, but calls through C functions always do.
+    """
+    if not depth:
+        return function(*args)
+    return list(map(lambda ignored: deeply(depth - 1, function, *args),
+                    [None]))[0]
+
+
+
+class FakePort(object):
+    def stopListening(self):
+        pass
+
+
+
+class GreenletMemoryTests(TestCase):
+    """
+    Tests for L{greenletMemory} and L{liveGreenlets}.
+    """
+
+    def suspended(self, depth):
+        """
+        Return a greenlet which has switched back to this one from C{depth}
+        calls deep.
+        """
+        parent = greenlet.getcurrent()
+        g = greenlet(lambda: deeply(depth, parent.switch))
+        g.switch()
+        self.addCleanup(g.throw)
+        return g
+
+
+    def test_stackCounted(self):
+        """
+        The stack a greenlet saved when it switched away is counted.
+        """
+        shallow = greenletMemory(self.suspended(0))
+        deep = greenletMemory(self.suspended(200))
+        self.assertTrue(deep > shallow + 10000, (shallow, deep))
+
+
+    def test_liveGreenlets(self):
+        """
+        L{liveGreenlets} counts every greenlet which has not finished.
+        """
+        before = liveGreenlets()
+        g = self.suspended(200)
+        after = liveGreenlets()
+        self.assertEquals(after.greenlets, before.greenlets + 1)
+        self.assertTrue(after.bytes - before.bytes >= greenletMemory(g))
+
+
+    def test_handlerName(self):
+        """
+        Handlers are named by their module and name, including the class of
+        methods.
+        """
+        self.assertEquals(_handlerName(deeply), "corotwine.test_memory.deeply")
+        self.assertEquals(
+            _handlerName(self.test_handlerName),
+            "corotwine.test_memory.GreenletMemoryTests.test_handlerName")
+
+
+
+class ListenerMemoryTests(TestCase):
+    """
+    Tests for the memory reports and budgets of listeners.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.errors = []
+        self.started = 0
+        self.factory = None
+
+
+    def tearDown(self):
+        """
+        Finish the handlers, so that they don't count in other tests'
+        reports.
+        """
+        if self.factory is not None:
+            for protocol in list(self.factory._active):
+                protocol.connectionLost(Failure(ConnectionDone()))
+
+
+    def reader(self, transport):
+        """
+        Read until the connection is closed, recording the error.
+        """
+        self.started += 1
+        try:
+            while True:
+                transport.read()
+        except ConnectionDone as e:
+            self.errors.append(e)
+
+
+    def deepReader(self, transport):
+        """
+        Like L{reader}, but from deep down the stack.
+        """
+        deeply(200, self.reader, transport)
+
+
+    def listen(self, function, memoryBudget=None):
+        self.factory = _GreenletFactory(function, clock=self.clock,
+                                        memoryBudget=memoryBudget)
+        return GreenletServer(FakePort(), self.factory)
+
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport, protocol
+
+
+    def test_memoryUsage(self):
+        """
+        L{GreenletServer.memoryUsage} counts the greenlets of the running
+        handlers.
+        """
+        server = self.listen(self.reader)
+        self.assertEquals(server.memoryUsage(), MemoryUsage())
+        protocols = [self.connect()[1] for i in range(3)]
+        self.assertEquals(
+            server.memoryUsage(),
+            MemoryUsage(3, sum([greenletMemory(protocol.greenlet)
+                                for protocol in protocols])))
+        protocols[0].connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(server.memoryUsage().greenlets, 2)
+
+
+    def test_handlerMemory(self):
+        """
+        L{handlerMemory} reports the memory of each handler function's
+        greenlets, by name.
+        """
+        server = self.listen(self.deepReader)
+        self.connect()
+        self.connect()
+        usage = handlerMemory()[
+            "corotwine.test_memory.ListenerMemoryTests.deepReader"]
+        self.assertEquals(usage, server.memoryUsage())
+        self.assertEquals(usage.greenlets, 2)
+        self.assertTrue(usage.bytes > 2 * 10000, usage)
+
+
+    def test_reject(self):
+        """
+        Once the handlers are found to be over their L{MemoryBudget}, new
+        connections are closed without being handled, until they are found
+        to be within it again.
+        """
+        server = self.listen(self.deepReader, MemoryBudget(10000, interval=5))
+        self.connect()
+        self.connect()
+        self.assertEquals(self.started, 2)
+        self.clock.advance(5)
+        twistedTransport, protocol = self.connect()
+        self.assertTrue(twistedTransport.disconnecting)
+        self.assertEquals(self.started, 2)
+        self.assertEquals(server.memoryRejectedConnections, 1)
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(server.activeConnections, 2)
+
+        for protocol in self.factory._active.copy():
+            protocol.connectionLost(Failure(ConnectionDone()))
+        self.clock.advance(5)
+        self.assertFalse(self.connect()[0].disconnecting)
+        self.assertEquals(self.started, 3)
+
+
+    def test_closeLargest(self):
+        """
+        With C{closeLargest}, the connections with the largest greenlets are
+        closed until the rest fit in the budget.
+        """
+        shallow = []
+        def handler(transport):
+            if shallow:
+                self.deepReader(transport)
+            else:
+                shallow.append(greenlet.getcurrent())
+                self.reader(transport)
+        server = self.listen(handler, MemoryBudget(10000, closeLargest=True))
+        connections = [self.connect() for i in range(3)]
+        self.clock.advance(1)
+        self.assertEquals(
+            [twistedTransport.disconnecting
+             for (twistedTransport, protocol) in connections],
+            [False, True, True])
+        self.assertEquals(len(self.errors), 2)
+        self.assertEquals(server.memoryClosedConnections, 2)
+        self.assertEquals(server.memoryRejectedConnections, 0)
+        self.assertFalse(self.connect()[0].disconnecting)
+
+
+    def test_measuredOnlyWithConnections(self):
+        """
+        The handlers are only measured while there are connections.
+        """
+        self.listen(self.reader, MemoryBudget(10000))
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        twistedTransport, protocol = self.connect()
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.clock.advance(1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def test_noBudget(self):
+        """
+        A listener without a budget reports no closed connections.
+        """
+        server = self.listen(self.reader)
+        self.assertEquals(server.memoryRejectedConnections, 0)
+        self.assertEquals(server.memoryClosedConnections, 0)
@@ -0,0 +1,297 @@
+"""
+Tests for L{corotwine.metrics}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from corotwine.metrics import (
+    Counter, Gauge, Histogram, Registry, runtime, serveMetrics)
+from corotwine.protocol import _GreenletFactory, gConnectTCP
+from corotwine.defer import blockOn, deferredGreenlet
+from corotwine.clock import wait
+from corotwine import greenlet
+
+
+class RegistryTests(TestCase):
+    """
+    Tests for L{Registry} and the metrics it renders.
+    """
+
+    def setUp(self):
+        self.registry = Registry()
+
+
+    def test_counter(self):
+        """
+        A L{Counter} is rendered with its help, type and value.
+        """
+        counter = Counter("things_total", "Things.", self.registry)
+        counter.inc()
+        counter.inc(2)
+        self.assertEquals(
+            self.registry.render(),
+            "# HELP things_total Things.\n"
+            "# TYPE things_total counter\n"
+            "things_total 3\n")
+
+
+    def test_gauge(self):
+        """
+        A L{Gauge} goes up and down, or is measured by its function when it
+        is rendered.
+        """
+        gauge = Gauge("level", "Level.", self.registry)
+        gauge.inc(5)
+        gauge.dec(2)
+        Gauge("measured", "Measured.", self.registry, lambda: 1.5)
+        self.assertEquals(
+            self.registry.render(),
+            "# HELP level Level.\n"
+            "# TYPE level gauge\n"
+            "level 3\n"
+            "# HELP measured Measured.\n"
+            "# TYPE measured gauge\n"
+            "measured 1.5\n")
+
+
+    def test_histogram(self):
+        """
+        A L{Histogram} is rendered as cumulative buckets, with the sum and
+        count of the values observed.  A value equal to a bucket's bound is
+        counted in that bucket.
+        """
+        histogram = Histogram("latency_seconds", "Latency.", self.registry,
+                              [1, 0.5])
+        for value in [0.25, 0.5, 0.75, 2]:
+            histogram.observe(value)
+        self.assertEquals(histogram.count, 4)
+        self.assertEquals(
+            self.registry.render(),
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.5"} 2\n'
+            'latency_seconds_bucket{le="1.0"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            "latency_seconds_sum 3.5\n"
+            "latency_seconds_count 4\n")
+
+
+    def test_duplicate(self):
+        """
+        Two metrics with the same name can't be registered.
+        """
+        Counter("things_total", "Things.", self.registry)
+        self.assertRaises(ValueError, Counter, "things_total", "More.",
+                          self.registry)
+
+
+    def test_escapedHelp(self):
+        """
+        Backslashes and newlines in help text are escaped.
+        """
+        Counter("things_total", "Some\\all\nthings.", self.registry)
+        self.assertEquals(self.registry.render().splitlines()[0],
+                          "# HELP things_total Some\\\\all\\nthings.")
+
+
+
+class RuntimeMetricsTests(TestCase):
+    """
+    Tests for the hooks which update L{runtime}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        runtime.enable(self.clock, None)
+        self.addCleanup(runtime.disable)
+        self.patch(runtime, "seconds", self.clock.seconds)
+
+
+    def connect(self, function):
+        factory = _GreenletFactory(function, clock=self.clock)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport, protocol
+
+
+    def reader(self, transport):
+        try:
+            while True:
+                transport.write(transport.read())
+        except ConnectionDone:
+            pass
+
+
+    def test_connections(self):
+        """
+        Connections are counted while they are open, and in total.
+        """
+        connections = runtime.connections.value
+        total = runtime.connectionsTotal.value
+        twistedTransport, protocol = self.connect(self.reader)
+        self.assertEquals(runtime.connections.value, connections + 1)
+        self.assertEquals(runtime.connectionsTotal.value, total + 1)
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(runtime.connections.value, connections)
+        self.assertEquals(runtime.connectionsTotal.value, total + 1)
+
+
+    def test_connectionsWhileDisabled(self):
+        """
+        Connections made while collection is disabled are not uncounted when
+        they are lost after it is enabled.
+        """
+        connections = runtime.connections.value
+        runtime.disable()
+        twistedTransport, protocol = self.connect(self.reader)
+        runtime.enable(self.clock, None)
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(runtime.connections.value, connections)
+
+
+    def test_bytes(self):
+        """
+        Bytes received and written are counted.
+        """
+        received = runtime.bytesReceived.value
+        sent = runtime.bytesSent.value
+        twistedTransport, protocol = self.connect(self.reader)
+        protocol.dataReceived(b"hello")
+        self.assertEquals(runtime.bytesReceived.value, received + 5)
+        self.assertEquals(runtime.bytesSent.value, sent + 5)
+        protocol.connectionLost(Failure(ConnectionDone()))
+
+
+    def test_writePauses(self):
+        """
+        Each time the transport pauses writes, it is counted.
+        """
+        pauses = runtime.writePauses.value
+        twistedTransport, protocol = self.connect(self.reader)
+        protocol.pauseProducing()
+        protocol.resumeProducing()
+        protocol.pauseProducing()
+        self.assertEquals(runtime.writePauses.value, pauses + 2)
+        protocol.connectionLost(Failure(ConnectionDone()))
+
+
+    def test_blockOn(self):
+        """
+        The time greenlets spend waiting in L{blockOn} is observed, unless
+        the L{Deferred} has already fired.
+        """
+        histogram = runtime.blockOnSeconds
+        count, total = histogram.count, histogram.sum
+        d = Deferred()
+        fired = Deferred()
+        fired.callback(None)
+        def waiter():
+            blockOn(fired)
+            blockOn(d)
+        greenlet(waiter).switch()
+        self.clock.advance(0.25)
+        d.callback(None)
+        self.assertEquals(histogram.count, count + 1)
+        self.assertEquals(histogram.sum, total + 0.25)
+
+
+    def test_waitLag(self):
+        """
+        How late L{wait} returns is observed as the reactor's lag.
+        """
+        histogram = runtime.lagSeconds
+        count, total = histogram.count, histogram.sum
+        greenlet(wait).switch(1, self.clock)
+        self.clock.advance(1.5)
+        self.assertEquals(histogram.count, count + 1)
+        self.assertEquals(histogram.sum, total + 0.5)
+
+
+    def test_lagTimer(self):
+        """
+        L{RuntimeMetrics.enable} schedules a timer which measures the
+        reactor's lag every C{lagInterval} seconds, until
+        L{RuntimeMetrics.disable} is called.
+        """
+        histogram = runtime.lagSeconds
+        count, total = histogram.count, histogram.sum
+        runtime.enable(self.clock, 2)
+        self.clock.advance(2.25)
+        self.clock.advance(2)
+        self.assertEquals(histogram.count, count + 2)
+        self.assertEquals(histogram.sum, total + 0.25)
+        runtime.disable()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def test_disabled(self):
+        """
+        Nothing is counted while collection is disabled.
+        """
+        runtime.disable()
+        received = runtime.bytesReceived.value
+        connections = runtime.connectionsTotal.value
+        twistedTransport, protocol = self.connect(self.reader)
+        protocol.dataReceived(b"hello")
+        self.assertEquals(runtime.bytesReceived.value, received)
+        self.assertEquals(runtime.connectionsTotal.value, connections)
+        protocol.connectionLost(Failure(ConnectionDone()))
+
+
+
+class EndpointTests(TestCase):
+    """
+    Tests for L{serveMetrics}.
+    """
+
+    def get(self, path):
+        """
+        Request C{path} from a metrics server.
+
+        @return: A L{Deferred} firing with the status line and the body.
+        """
+        registry = Registry()
+        Counter("things_total", "Things.", registry).inc(7)
+        server = serveMetrics(0, registry, interface="127.0.0.1")
+        self.addCleanup(server.stopAccepting)
+        @deferredGreenlet
+        def client():
+            transport = gConnectTCP("127.0.0.1", server.port.getHost().port)
+            transport.write(b"GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n"
+                            % (path,))
+            response = []
+            try:
+                while True:
+                    response.append(transport.read())
+            except ConnectionDone:
+                pass
+            head, body = b"".join(response).split(b"\r\n\r\n", 1)
+            return head.split(b"\r\n")[0], body
+        return client()
+
+
+    def test_metrics(self):
+        """
+        C{/metrics} is answered with the registry's metrics.
+        """
+        def check(result):
+            status, body = result
+            self.assertEquals(status, b"HTTP/1.0 200 OK")
+            self.assertIn(b"things_total 7\n", body)
+        return self.get(b"/metrics").addCallback(check)
+
+
+    def test_notFound(self):
+        """
+        Other paths are not found.
+        """
+        def check(result):
+            status, body = result
+            self.assertEquals(status, b"HTTP/1.0 404 Not Found")
+        return self.get(b"/").addCallback(check)
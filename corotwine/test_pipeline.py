@@ -0,0 +1,236 @@
+"""
+Tests for L{corotwine.pipeline}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from corotwine import greenlet
+from corotwine.defer import blockOn
+from corotwine.protocol import _GreenletFactory
+from corotwine.pipeline import Pipeline, lines
+
+
+def upper(items):
+    for item in items:
+        yield item.upper()
+
+
+
+class PausingTransport(FakeTransport):
+    """
+    A L{FakeTransport} which records whether it is paused.
+    """
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+
+class PipelineTests(TestCase):
+    """
+    Tests for L{Pipeline}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+
+
+    def settle(self):
+        """
+        Run the delayed calls due now, and those they make, until there are
+        none.
+        """
+        while [call for call in self.clock.getDelayedCalls()
+               if call.getTime() <= self.clock.seconds()]:
+            self.clock.advance(0)
+
+
+    def runPipeline(self, pipeline, sink):
+        """
+        Run C{pipeline} into C{sink} in a new greenlet.
+
+        @return: A list which is given C{"done"} when it finishes, or the
+            exception it raised.
+        """
+        result = []
+        def runner():
+            try:
+                pipeline.run(sink)
+            except Exception as e:
+                result.append(e)
+            else:
+                result.append("done")
+        greenlet(runner).switch()
+        return result
+
+
+    def connect(self, function):
+        """
+        Connect C{function} to a L{PausingTransport}.
+
+        @return: The L{_GreenletProtocol} and the L{PausingTransport}.
+        """
+        protocol = _GreenletFactory(function, clock=self.clock).buildProtocol(
+            None)
+        twistedTransport = PausingTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return protocol, twistedTransport
+
+
+    def test_iterable(self):
+        """
+        The items of an iterable source pass through each stage in turn to
+        the sink.
+        """
+        pipeline = Pipeline([b"a", b"b", b"c"], clock=self.clock)
+        pipeline.stage(upper).stage(lambda items: (i * 2 for i in items))
+        output = []
+        result = self.runPipeline(pipeline, output.append)
+        self.settle()
+        self.assertEquals(output, [b"AA", b"BB", b"CC"])
+        self.assertEquals(result, ["done"])
+        self.assertEquals(pipeline._greenlets, [])
+
+
+    def test_noStages(self):
+        """
+        A pipeline with no stages passes the source's items to the sink.
+        """
+        output = []
+        result = self.runPipeline(Pipeline(range(3), clock=self.clock),
+                                  output.append)
+        self.settle()
+        self.assertEquals(output, [0, 1, 2])
+        self.assertEquals(result, ["done"])
+
+
+    def test_transport(self):
+        """
+        A transport source is read until the connection is done, and a sink
+        with a C{write} method is written to.
+        """
+        result = []
+        def handler(transport):
+            pipeline = Pipeline(transport, clock=self.clock)
+            pipeline.stage(lines).stage(upper)
+            pipeline.run(transport)
+            result.append("done")
+        protocol, twistedTransport = self.connect(handler)
+        protocol.dataReceived(b"hello\r\nwor")
+        self.settle()
+        self.assertEquals(twistedTransport.stream, [b"HELLO"])
+        protocol.dataReceived(b"ld\r\n")
+        self.settle()
+        self.assertEquals(twistedTransport.stream, [b"HELLO", b"WORLD"])
+        self.assertEquals(result, [])
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.settle()
+        self.assertEquals(result, ["done"])
+
+
+    def test_backpressure(self):
+        """
+        When a stage falls behind, the buffers before it fill up, and then
+        the transport stops reading until there is room again.
+        """
+        gates = []
+        def slow(items):
+            for item in items:
+                d = Deferred()
+                gates.append(d)
+                blockOn(d)
+                yield item
+        output = []
+        def handler(transport):
+            pipeline = Pipeline(transport, bufferSize=1, clock=self.clock)
+            pipeline.stage(upper).stage(slow)
+            pipeline.run(output.append)
+        protocol, twistedTransport = self.connect(handler)
+        for data in [b"a", b"b", b"c", b"d"]:
+            protocol.dataReceived(data)
+            self.settle()
+        # One item is in the slow stage, one waits to be put in the full
+        # buffer before it, and one is in the first buffer.
+        self.assertTrue(twistedTransport.paused)
+        self.assertEquals(len(gates), 1)
+        gates[0].callback(None)
+        self.settle()
+        self.assertEquals(output, [b"A"])
+        self.assertFalse(twistedTransport.paused)
+        self.assertEquals(len(gates), 2)
+
+
+    def test_stageFails(self):
+        """
+        An exception raised by a stage stops the other stages and is raised
+        by L{Pipeline.run}.
+        """
+        stopped = []
+        def waiter(items):
+            try:
+                for item in items:
+                    yield item
+            finally:
+                stopped.append(True)
+        def broken(items):
+            for item in items:
+                raise ZeroDivisionError()
+            yield
+        pipeline = Pipeline(iter([1]), clock=self.clock)
+        pipeline.stage(waiter).stage(broken)
+        result = self.runPipeline(pipeline, lambda item: None)
+        self.settle()
+        self.assertEquals(len(result), 1)
+        self.assertIsInstance(result[0], ZeroDivisionError)
+        self.assertEquals(stopped, [True])
+
+
+    def test_connectionLost(self):
+        """
+        If the transport source's connection is lost, the stages are stopped
+        and the reason is raised.
+        """
+        result = []
+        def handler(transport):
+            try:
+                Pipeline(transport, clock=self.clock).stage(upper).run(
+                    transport)
+            except ConnectionLost:
+                result.append("lost")
+        protocol, twistedTransport = self.connect(handler)
+        self.settle()
+        protocol.connectionLost(Failure(ConnectionLost()))
+        self.settle()
+        self.assertEquals(result, ["lost"])
+
+
+
+class LinesTests(TestCase):
+    """
+    Tests for L{lines}.
+    """
+
+    def test_lines(self):
+        """
+        Lines split across chunks, and several lines in one chunk, are
+        yielded without their delimiters.
+        """
+        self.assertEquals(
+            list(lines([b"a\r\nb", b"c\r", b"\nd\r\ne\r\n"])),
+            [b"a", b"bc", b"d", b"e"])
+
+
+    def test_delimiter(self):
+        """
+        Another delimiter may be given.
+        """
+        self.assertEquals(list(lines([b"a\nb\n"], b"\n")), [b"a", b"b"])
@@ -0,0 +1,155 @@
+"""
+Tests for L{corotwine.profiler}.
+"""
+
+import sys, time
+from io import StringIO
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+
+from corotwine.profiler import Profiler
+from corotwine.protocol import _GreenletFactory
+from corotwine.defer import blockOn, deferredGreenlet
+
+
+def spin(seconds):
+    """
+    Use the CPU for some seconds.
+    """
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+
+def busyHandler(transport):
+    spin(0.2)
+
+
+
+class ProfilerTests(TestCase):
+    """
+    Tests for L{Profiler}.
+    """
+
+    def connect(self, function):
+        factory = _GreenletFactory(function, clock=Clock())
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(
+            protocol, True, hostAddress=IPv4Address("TCP", "127.0.0.1", 8080))
+        protocol.makeConnection(twistedTransport)
+
+
+    def profile(self, mode):
+        """
+        Profile a busy connection handler in C{mode}, and check that its
+        samples are attributed to it and its listener.
+        """
+        profiler = Profiler(interval=0.001, mode=mode)
+        self.addCleanup(profiler.stop)
+        profiler.start()
+        self.connect(busyHandler)
+        profiler.stop()
+        handler = "corotwine.test_profiler.busyHandler"
+        self.assertTrue(profiler.handlers().get(handler) > 10,
+                        profiler.handlers())
+        self.assertEquals(profiler.listeners(),
+                          {"127.0.0.1:8080": profiler.handlers()[handler]})
+        top = profiler.collapsed()[0]
+        self.assertTrue(
+            top.startswith("127.0.0.1:8080;%s;_runAndDisconnect (" % (
+                handler,)), top)
+        self.assertIn(";spin (test_profiler.py:", top)
+        return profiler
+
+
+    def test_signal(self):
+        """
+        In signal mode, samples are taken by a CPU time timer.
+        """
+        self.profile("signal")
+
+
+    def test_thread(self):
+        """
+        In thread mode, samples are taken by a helper thread.
+        """
+        self.profile("thread")
+
+
+    def test_reactor(self):
+        """
+        Samples taken in the reactor's greenlet are attributed to
+        C{reactor}.
+        """
+        profiler = Profiler(interval=0.001)
+        self.addCleanup(profiler.stop)
+        profiler.start()
+        spin(0.1)
+        profiler.stop()
+        self.assertEquals(list(profiler.handlers()), ["reactor"])
+
+
+    def test_deferredGreenlet(self):
+        """
+        Samples taken in a greenlet started by L{deferredGreenlet} are
+        attributed to its function.
+        """
+        d = Deferred()
+        @deferredGreenlet
+        def work():
+            blockOn(d)
+            spin(0.1)
+        profiler = Profiler(interval=0.001)
+        self.addCleanup(profiler.stop)
+        work()
+        profiler.start()
+        d.callback(None)
+        profiler.stop()
+        name = ("corotwine.test_profiler.ProfilerTests.test_deferredGreenlet."
+                "<locals>.work")
+        self.assertIn(name, profiler.handlers())
+        self.assertTrue(profiler.collapsed()[0].startswith(
+            "deferredGreenlet;%s;" % (name,)))
+        self.assertEquals(profiler.listeners(), {})
+
+
+    def test_writeCollapsed(self):
+        """
+        L{Profiler.writeCollapsed} writes the collapsed stacks, a line each,
+        and L{Profiler.clear} forgets them.
+        """
+        profiler = Profiler()
+        profiler.sample(sys._getframe())
+        profiler.sample(sys._getframe())
+        output = StringIO()
+        profiler.writeCollapsed(output)
+        self.assertEquals(output.getvalue(),
+                          "\n".join(profiler.collapsed()) + "\n")
+        self.assertTrue(output.getvalue().endswith(" 2\n"))
+        profiler.clear()
+        self.assertEquals((profiler.collapsed(), profiler.samples), ([], 0))
+
+
+    def test_duration(self):
+        """
+        Given a duration, L{Profiler.start} stops sampling after that many
+        seconds.
+        """
+        clock = Clock()
+        profiler = Profiler()
+        self.addCleanup(profiler.stop)
+        profiler.start(duration=1, clock=clock)
+        clock.advance(1)
+        self.assertFalse(profiler.profiling)
+
+
+    def test_mode(self):
+        """
+        Unknown modes are rejected.
+        """
+        self.assertRaises(ValueError, Profiler, mode="psychic")
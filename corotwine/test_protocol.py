@@ -2,7 +2,7 @@
 Tests for L{corotwine.protocol}.
 """
 
-from cStringIO import StringIO
+from io import BytesIO
 
 from twisted.trial.unittest import TestCase
 from twisted.test.iosim import FakeTransport
@@ -10,8 +10,16 @@ from twisted.internet.error import ConnectionDone, ConnectionLost
 from twisted.python.failure import Failure
 
 from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+from twisted.internet.abstract import FileDescriptor
+from twisted.internet.testing import StringTransport
 
-from corotwine.protocol import _GreenletFactory, LineBuffer, gConnectTCP
+from twisted.internet.error import ConnectError
+
+from corotwine.protocol import (
+    _GreenletFactory, GreenletServer, LineBuffer, gConnectTCP, gListen,
+    gConnect)
+from corotwine.defer import blockOn, deferredGreenlet
 from corotwine.clock import wait
 from corotwine import greenlet
 
@@ -26,10 +34,9 @@ class ServerTests(TestCase):
         @param function: Function to pass to L{GreenletProtocol}
         @rtype: Two-tuple of L{FakeTransport}, L{GreenletProtocol}.
         """
-        twistedTransport = FakeTransport()
         factory = _GreenletFactory(function)
         protocol = factory.buildProtocol(None)
-        twistedTransport.protocol = protocol
+        twistedTransport = FakeTransport(protocol, True)
         return twistedTransport, protocol
 
 
@@ -58,8 +65,8 @@ class ServerTests(TestCase):
             data.append(transport.read())
 
         twistedTransport, protocol = self.connect(reader)
-        protocol.dataReceived("foo")
-        self.assertEquals(data, ["foo"])
+        protocol.dataReceived(b"foo")
+        self.assertEquals(data, [b"foo"])
 
 
     def test_multipleReads(self):
@@ -71,12 +78,12 @@ class ServerTests(TestCase):
             for i in range(3):
                 data.append(transport.read())
         twistedTransport, protocol = self.connect(multiReader)
-        protocol.dataReceived("foo")
-        self.assertEquals(data, ["foo"])
-        protocol.dataReceived("bar")
-        self.assertEquals(data, ["foo", "bar"])
-        protocol.dataReceived("baz")
-        self.assertEquals(data, ["foo", "bar", "baz"])
+        protocol.dataReceived(b"foo")
+        self.assertEquals(data, [b"foo"])
+        protocol.dataReceived(b"bar")
+        self.assertEquals(data, [b"foo", b"bar"])
+        protocol.dataReceived(b"baz")
+        self.assertEquals(data, [b"foo", b"bar", b"baz"])
 
 
     def test_write(self):
@@ -84,11 +91,11 @@ class ServerTests(TestCase):
         C{transport.write} sends data to the underlying Twisted transport.
         """
         def echo(transport):
-            transport.write("hi")
-            transport.write("there")
+            transport.write(b"hi")
+            transport.write(b"there")
 
         twistedTransport, protocol = self.connect(echo)
-        self.assertEquals(twistedTransport.stream, ["hi", "there"])
+        self.assertEquals(twistedTransport.stream, [b"hi", b"there"])
 
 
     def test_close(self):
@@ -96,7 +103,7 @@ class ServerTests(TestCase):
         C{transport.close} closes the underlying Twisted transport.
         """
         def close(transport):
-            transport.write("foo")
+            transport.write(b"foo")
             transport.close()
         twistedTransport, protocol = self.connect(close)
         self.assertTrue(twistedTransport.disconnecting)
@@ -126,7 +133,7 @@ class ServerTests(TestCase):
             transport.read()
             return
         twistedTransport, protocol = self.connect(nothing)
-        protocol.dataReceived("hello")
+        protocol.dataReceived(b"hello")
         self.assertTrue(twistedTransport.disconnecting)
 
 
@@ -144,7 +151,7 @@ class ServerTests(TestCase):
         disconnects = []
         twistedTransport.loseConnection = lambda: disconnects.append(True)
         protocol.makeConnection(twistedTransport)
-        protocol.dataReceived("foo")
+        protocol.dataReceived(b"foo")
         self.assertEquals(disconnects, [True])
 
 
@@ -180,7 +187,7 @@ class ServerTests(TestCase):
             transport.read()
             1/0
         twistedTransport, protocol = self.connect(explode)
-        self.assertRaises(ZeroDivisionError, protocol.dataReceived, "foo")
+        self.assertRaises(ZeroDivisionError, protocol.dataReceived, b"foo")
 
 
     def test_readOnClosedTransport(self):
@@ -193,7 +200,7 @@ class ServerTests(TestCase):
             def readOnClosed(transport):
                 try:
                     transport.read()
-                except errorType, e:
+                except errorType as e:
                     dones.append(e)
             twistedTransport, protocol = self.connect(readOnClosed)
             e = errorType("Oops!")
@@ -212,11 +219,11 @@ class ServerTests(TestCase):
             # We'll read so that we can get the ConnectionLost.
             try:
                 transport.read()
-            except Exception, firstE:
-                pass
+            except Exception as e:
+                firstE = e
             try:
-                transport.write("foo")
-            except Exception, secondE:
+                transport.write(b"foo")
+            except Exception as secondE:
                 assert type(firstE) == type(secondE), (firstE, secondE)
                 error.append(secondE)
         twistedTransport, protocol = self.connect(writeOnClosed)
@@ -239,7 +246,7 @@ class ServerTests(TestCase):
             wait(5, clock)
             try:
                 transport.read()
-            except ConnectionDone, e:
+            except ConnectionDone as e:
                 dones.append(e)
         twistedTransport, protocol = self.connect(waitThenRead)
         e = ConnectionDone("Oops!")
@@ -256,21 +263,21 @@ class ServerTests(TestCase):
         until the buffer clears.
         """
         def writeALot(transport):
-            transport.write("lot")
-            transport.write("of data")
+            transport.write(b"lot")
+            transport.write(b"of data")
         twistedTransport, protocol = self.getTransportAndProtocol(writeALot)
 
         def write(data):
             originalWrite(data)
-            if data == "lot":
+            if data == b"lot":
                 # Whoah, that's a lot!
                 twistedTransport.producer.pauseProducing()
         originalWrite = twistedTransport.write
         twistedTransport.write = write
         protocol.makeConnection(twistedTransport)
-        self.assertEquals(twistedTransport.stream, ["lot"])
+        self.assertEquals(twistedTransport.stream, [b"lot"])
         twistedTransport.producer.resumeProducing()
-        self.assertEquals(twistedTransport.stream, ["lot", "of data"])
+        self.assertEquals(twistedTransport.stream, [b"lot", b"of data"])
 
 
     def test_incomingDataOnlyGetsSentToReadCalls(self):
@@ -284,8 +291,8 @@ class ServerTests(TestCase):
             # We need to write *twice* because it's the *first* write which
             # will trigger the buffer full, and the *second* that will
             # actually block.
-            transport.write("lot")
-            transport.write("of")
+            transport.write(b"lot")
+            transport.write(b"of")
             datas.append(transport.read())
         twistedTransport, protocol = self.getTransportAndProtocol(writeThenRead)
 
@@ -295,12 +302,12 @@ class ServerTests(TestCase):
         protocol.makeConnection(twistedTransport)
         # Let's receive data multiple times to make sure it's actually
         # *buffering* incoming data, not just dropping it.
-        protocol.dataReceived("foo")
-        protocol.dataReceived("bar")
+        protocol.dataReceived(b"foo")
+        protocol.dataReceived(b"bar")
         twistedTransport.producer.resumeProducing()
         # make write return, which calls read(), which should immediately
         # return buffered data.
-        self.assertEquals(datas, ["foobar"])
+        self.assertEquals(datas, [b"foobar"])
 
 
     def test_writeRaisesInitialConnectionLost(self):
@@ -311,10 +318,10 @@ class ServerTests(TestCase):
         """
         error = []
         def writeLots(transport):
-            transport.write("whatever")
+            transport.write(b"whatever")
             try:
-                transport.write("again")
-            except Exception, e:
+                transport.write(b"again")
+            except Exception as e:
                 error.append(e)
         twistedTransport, protocol = self.getTransportAndProtocol(writeLots)
 
@@ -329,6 +336,23 @@ class ServerTests(TestCase):
         self.assertEquals(error, [e])
 
 
+    def test_resumeWhileNotWriting(self):
+        """
+        If the transport is paused and resumed while the greenlet is not
+        blocked in C{transport.write}, the next write does not block.
+        """
+        datas = []
+        def readThenWrite(transport):
+            datas.append(transport.read())
+            transport.write(b"more")
+        twistedTransport, protocol = self.connect(readThenWrite)
+        twistedTransport.producer.pauseProducing()
+        twistedTransport.producer.resumeProducing()
+        protocol.dataReceived(b"foo")
+        self.assertEquals(datas, [b"foo"])
+        self.assertEquals(twistedTransport.stream, [b"more"])
+
+
     def test_stopProducing(self):
         """
         L{stopProducing} can be called.
@@ -344,6 +368,606 @@ class ServerTests(TestCase):
 
 
 
+    def test_readBufferedChunks(self):
+        """
+        Data received in several chunks while the greenlet was not reading is
+        returned by one C{transport.read} call.
+        """
+        data = []
+        d = Deferred()
+        def slowReader(transport):
+            blockOn(d)
+            data.append(transport.read())
+        twistedTransport, protocol = self.connect(slowReader)
+        protocol.dataReceived(b"foo")
+        protocol.dataReceived(b"bar")
+        d.callback(None)
+        self.assertEquals(data, [b"foobar"])
+
+
+    def test_readView(self):
+        """
+        C{transport.readView} returns a C{memoryview} of the data, in a buffer
+        which is reused by the next call if it is big enough.
+        """
+        views = []
+        def reader(transport):
+            while True:
+                view = transport.readView()
+                views.append((view.tobytes(), view))
+        twistedTransport, protocol = self.connect(reader)
+        protocol.dataReceived(b"foo")
+        protocol.dataReceived(b"quux")
+        self.assertEquals([data for (data, view) in views], [b"foo", b"quux"])
+        self.assertIsInstance(views[0][1], memoryview)
+        self.assertEquals(views[0][1].tobytes(), b"quu")
+
+
+    def test_readViewGrows(self):
+        """
+        If the data is bigger than the buffer, C{transport.readView} makes a
+        bigger one, and views of the old one are left alone.
+        """
+        views = []
+        def reader(transport):
+            while True:
+                views.append(transport.readView())
+        twistedTransport, protocol = self.connect(reader)
+        protocol.dataReceived(b"foo")
+        protocol.dataReceived(b"x" * 5000)
+        self.assertEquals(views[0].tobytes(), b"foo")
+        self.assertEquals(views[1].tobytes(), b"x" * 5000)
+
+
+    def test_writeBuffers(self):
+        """
+        C{transport.write} accepts C{bytearray}s and C{memoryview}s, and
+        copies them, so they can be changed once it returns.
+        """
+        def writer(transport):
+            data = bytearray(b"foo")
+            transport.write(data)
+            data[:] = b"bar"
+            transport.write(memoryview(data)[1:])
+        twistedTransport, protocol = self.connect(writer)
+        self.assertEquals(twistedTransport.stream, [b"foo", b"ar"])
+
+
+    def test_echoViews(self):
+        """
+        The views returned by C{transport.readView} can be written.
+        """
+        def echo(transport):
+            while True:
+                transport.write(transport.readView())
+        twistedTransport, protocol = self.connect(echo)
+        protocol.dataReceived(b"foo")
+        protocol.dataReceived(b"bar")
+        self.assertEquals(twistedTransport.stream, [b"foo", b"bar"])
+
+
+
+class IdleTimeoutTests(TestCase):
+    """
+    Tests for closing idle connections.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.factory = _GreenletFactory(self.reader, idleTimeout=10,
+                                        clock=self.clock)
+        self.errors = []
+
+
+    def reader(self, transport):
+        try:
+            while True:
+                transport.read()
+        except ConnectionDone as e:
+            self.errors.append(e)
+
+
+    def connect(self):
+        """
+        Make a connection with C{self.factory}.
+
+        @rtype: Two-tuple of L{FakeTransport}, L{GreenletProtocol}.
+        """
+        protocol = self.factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport, protocol
+
+
+    def advance(self, seconds):
+        """
+        Advance C{self.clock} by C{seconds} in small steps, so that timers
+        scheduled by other timers are run at the right time.
+        """
+        self.clock.pump([0.5] * int(seconds * 2))
+
+
+    def test_idleConnectionClosed(self):
+        """
+        A connection which does no I/O for C{idleTimeout} seconds is closed
+        shortly afterwards.
+        """
+        twistedTransport, protocol = self.connect()
+        self.advance(10)
+        self.assertFalse(twistedTransport.disconnecting)
+        self.advance(2.5)
+        self.assertTrue(twistedTransport.disconnecting)
+        twistedTransport.reportDisconnect()
+        self.assertEquals(len(self.errors), 1)
+
+
+    def test_activityPostponesClose(self):
+        """
+        Receiving data restarts the idle time of a connection.
+        """
+        twistedTransport, protocol = self.connect()
+        self.advance(9)
+        protocol.dataReceived(b"foo")
+        self.advance(10)
+        self.assertFalse(twistedTransport.disconnecting)
+        self.advance(2.5)
+        self.assertTrue(twistedTransport.disconnecting)
+
+
+    def test_writingPostponesClose(self):
+        """
+        Writing data restarts the idle time of a connection.
+        """
+        twistedTransport, protocol = self.connect()
+        self.advance(9)
+        protocol.gtransport.write(b"foo")
+        self.advance(10)
+        self.assertFalse(twistedTransport.disconnecting)
+
+
+    def test_oneTimer(self):
+        """
+        One timer is used for all connections, and it is cancelled when there
+        are no connections left.
+        """
+        connections = [self.connect() for i in range(100)]
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        for twistedTransport, protocol in connections:
+            twistedTransport.reportDisconnect()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+
+class FakePort(object):
+    """
+    An L{IListeningPort} which records whether it has stopped listening.
+    """
+    listening = True
+
+    def stopListening(self):
+        self.listening = False
+
+
+
+class GreenletServerTests(TestCase):
+    """
+    Tests for L{GreenletServer}, for shutting servers down gracefully.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.port = FakePort()
+        self.events = []
+
+
+    def handler(self, transport):
+        """
+        Read one thing and record it, recording any error too.
+        """
+        try:
+            self.events.append(transport.read())
+        except ConnectionDone as e:
+            self.events.append(e)
+
+
+    def listen(self, maxConnections=None):
+        """
+        Make a L{GreenletServer} for C{self.handler}, with C{self.port}.
+        """
+        self.factory = _GreenletFactory(self.handler, clock=self.clock,
+                                        maxConnections=maxConnections)
+        return GreenletServer(self.port, self.factory)
+
+
+    def connect(self):
+        """
+        Make a connection to the server.
+
+        @rtype: Two-tuple of L{FakeTransport}, L{GreenletProtocol}.
+        """
+        protocol = self.factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport, protocol
+
+
+    def test_stopAccepting(self):
+        """
+        L{GreenletServer.stopAccepting} stops the port listening.
+        """
+        server = self.listen()
+        server.stopAccepting()
+        self.assertFalse(self.port.listening)
+
+
+    def test_activeConnections(self):
+        """
+        L{GreenletServer.activeConnections} is the number of handlers which
+        are running.
+        """
+        server = self.listen()
+        self.assertEquals(server.activeConnections, 0)
+        twistedTransport, protocol = self.connect()
+        self.connect()
+        self.assertEquals(server.activeConnections, 2)
+        protocol.dataReceived(b"foo")
+        self.assertEquals(server.activeConnections, 1)
+
+
+    def test_maxConnections(self):
+        """
+        Connections beyond C{maxConnections} are queued, and their handlers
+        start when earlier ones finish.
+        """
+        server = self.listen(maxConnections=1)
+        first = self.connect()[1]
+        second = self.connect()[1]
+        second.dataReceived(b"second")
+        self.assertEquals(
+            (server.activeConnections, server.queuedConnections), (1, 1))
+        self.assertEquals(self.events, [])
+        first.dataReceived(b"first")
+        self.clock.advance(0)
+        self.assertEquals(self.events, [b"first", b"second"])
+        self.assertEquals(
+            (server.activeConnections, server.queuedConnections), (0, 0))
+
+
+    def test_queuedConnectionLost(self):
+        """
+        If a queued connection is lost, its handler never runs.
+        """
+        server = self.listen(maxConnections=1)
+        first = self.connect()[1]
+        twistedTransport, second = self.connect()
+        twistedTransport.reportDisconnect()
+        self.assertEquals(server.queuedConnections, 0)
+        first.dataReceived(b"first")
+        self.clock.advance(0)
+        self.assertEquals(self.events, [b"first"])
+
+
+    def test_drain(self):
+        """
+        L{GreenletServer.drain} stops accepting and returns a L{Deferred}
+        which fires when the active handlers have finished.
+        """
+        server = self.listen()
+        twistedTransport, protocol = self.connect()
+        results = []
+        server.drain().addCallback(results.append)
+        self.assertFalse(self.port.listening)
+        self.clock.advance(0)
+        self.assertEquals(results, [])
+        protocol.dataReceived(b"foo")
+        self.clock.advance(0)
+        self.assertEquals(results, [None])
+        self.assertEquals(self.events, [b"foo"])
+
+
+    def test_drainIdle(self):
+        """
+        If there are no connections, the L{Deferred} returned by
+        L{GreenletServer.drain} fires straight away.
+        """
+        server = self.listen()
+        results = []
+        server.drain().addCallback(results.append)
+        self.clock.advance(0)
+        self.assertEquals(results, [None])
+
+
+    def test_drainTimeout(self):
+        """
+        When the C{timeout} passed to L{GreenletServer.drain} expires, the
+        remaining connections are closed and L{ConnectionDone} is thrown into
+        their handlers.
+        """
+        server = self.listen(maxConnections=1)
+        first, firstProtocol = self.connect()
+        second, secondProtocol = self.connect()
+        results = []
+        server.drain(10).addCallback(results.append)
+        self.clock.advance(10)
+        self.assertTrue(first.disconnecting)
+        self.assertTrue(second.disconnecting)
+        self.assertEquals(len(self.events), 1)
+        self.assertIsInstance(self.events[0], ConnectionDone)
+        self.clock.advance(0)
+        self.assertEquals(results, [None])
+
+
+    def test_drainFinishedBeforeTimeout(self):
+        """
+        If the handlers finish before the C{timeout} passed to
+        L{GreenletServer.drain}, the timeout is cancelled.
+        """
+        server = self.listen()
+        twistedTransport, protocol = self.connect()
+        server.drain(10)
+        protocol.dataReceived(b"foo")
+        self.clock.advance(0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+
+class MinimalTransport(object):
+    """
+    The least possible transport for a L{_GreenletProtocol}, so that
+    measurements of the protocol's memory use are not swamped by its
+    transport's.
+    """
+    def write(self, data):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+
+class MemoryFootprintTests(TestCase):
+    """
+    Tests for the memory used by each connection.
+    """
+
+    CONNECTIONS = 100000
+    BUDGET = 8 * 1024
+
+    def residentSetSize(self):
+        """
+        Return the number of bytes of memory this process is using.
+        """
+        import os
+        pages = int(open("/proc/self/statm").read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+    def test_footprint(self):
+        """
+        A connection whose greenlet is blocked reading uses less than
+        C{BUDGET} bytes, measured over C{CONNECTIONS} connections.
+        """
+        import gc
+        def reader(transport):
+            transport.read()
+        factory = _GreenletFactory(reader)
+        gc.collect()
+        before = self.residentSetSize()
+        protocols = []
+        for i in range(self.CONNECTIONS):
+            protocol = factory.buildProtocol(None)
+            protocol.makeConnection(MinimalTransport())
+            protocols.append(protocol)
+        gc.collect()
+        perConnection = (
+            (self.residentSetSize() - before) / float(self.CONNECTIONS))
+        self.assertTrue(perConnection < self.BUDGET,
+                        "%d bytes per connection" % (perConnection,))
+
+
+    def test_transportHasNoDict(self):
+        """
+        L{GreenletTransport} uses C{__slots__} rather than an instance
+        dictionary.
+        """
+        def nothing(transport):
+            self.assertFalse(hasattr(transport, "__dict__"))
+        factory = _GreenletFactory(nothing)
+        factory.buildProtocol(None).makeConnection(MinimalTransport())
+
+    import os
+    if not os.path.exists("/proc/self/statm"):
+        test_footprint.skip = "Memory use can only be measured on Linux."
+    del os
+
+
+
+class BufferingTransport(FileDescriptor):
+    """
+    A L{FileDescriptor} which buffers written data like a socket does, and
+    sends at most C{sendLimit} bytes each time L{doWrite} is called.
+
+    @ivar sent: The data sent so far.
+    """
+    sendLimit = 10
+
+    def __init__(self):
+        FileDescriptor.__init__(self)
+        self.connected = True
+        self.sent = b""
+
+    def startWriting(self):
+        pass
+
+    def stopWriting(self):
+        pass
+
+    def writeSomeData(self, data):
+        data = bytes(data)[:self.sendLimit]
+        self.sent += data
+        return len(data)
+
+
+
+class ReadPauseTests(TestCase):
+    """
+    Tests for L{GreenletTransport.pauseReading} and
+    L{GreenletTransport.resumeReading}.
+    """
+
+    def test_nested(self):
+        """
+        The underlying transport is paused by the first call to
+        C{pauseReading}, and resumed when the last is undone.
+        """
+        events = []
+        def handler(transport):
+            transport.pauseReading()
+            transport.pauseReading()
+            transport.resumeReading()
+            events.append(twistedTransport.producerState)
+            transport.resumeReading()
+            events.append(twistedTransport.producerState)
+            transport.resumeReading()
+            events.append(twistedTransport.producerState)
+        twistedTransport = StringTransport()
+        protocol = _GreenletFactory(handler).buildProtocol(None)
+        protocol.makeConnection(twistedTransport)
+        self.assertEquals(events, ["paused", "producing", "producing"])
+
+
+
+class WatermarkTests(TestCase):
+    """
+    Tests for L{GreenletTransport}'s write buffer watermarks.
+    """
+
+    def connect(self, function):
+        """
+        Connect C{function} to a L{BufferingTransport}.
+        """
+        twistedTransport = BufferingTransport()
+        protocol = _GreenletFactory(function).buildProtocol(None)
+        twistedTransport.protocol = protocol
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport
+
+
+    def test_bufferedAmount(self):
+        """
+        L{GreenletTransport.bufferedAmount} is the number of bytes written but
+        not yet sent.
+        """
+        amounts = []
+        def writer(transport):
+            transport.write(b"x" * 25)
+            amounts.append(transport.bufferedAmount)
+            transport.read()
+            amounts.append(transport.bufferedAmount)
+        twistedTransport = self.connect(writer)
+        twistedTransport.doWrite()
+        twistedTransport.protocol.dataReceived(b"go")
+        self.assertEquals(amounts, [25, 15])
+
+
+    def test_noBuffer(self):
+        """
+        A transport with no buffer we know about has nothing buffered, and
+        L{GreenletTransport.drain} returns straight away.
+        """
+        events = []
+        def writer(transport):
+            transport.setWriteWatermarks(1, 0)
+            transport.write(b"hello")
+            transport.drain()
+            events.append(transport.bufferedAmount)
+        protocol = _GreenletFactory(writer).buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        self.assertEquals(events, [0])
+
+
+    def test_highWatermark(self):
+        """
+        A write which leaves more than the high watermark buffered blocks
+        until no more than the low watermark is buffered.
+        """
+        events = []
+        def writer(transport):
+            transport.setWriteWatermarks(20, 5)
+            transport.write(b"x" * 15)
+            events.append("first")
+            transport.write(b"x" * 15)
+            events.append("second")
+        twistedTransport = self.connect(writer)
+        self.assertEquals(twistedTransport.bufferSize, 20)
+        self.assertEquals(events, ["first"])
+        twistedTransport.doWrite()
+        twistedTransport.doWrite()
+        self.assertEquals(events, ["first"])
+        twistedTransport.doWrite()
+        self.assertEquals(events, ["first", "second"])
+        self.assertEquals(twistedTransport.sent, b"x" * 30)
+
+
+    def test_defaultLowWatermark(self):
+        """
+        The low watermark defaults to half of the high watermark.
+        """
+        events = []
+        def writer(transport):
+            transport.setWriteWatermarks(20)
+            transport.write(b"x" * 30)
+            events.append("written")
+        twistedTransport = self.connect(writer)
+        twistedTransport.doWrite()
+        self.assertEquals(events, [])
+        twistedTransport.doWrite()
+        self.assertEquals(events, ["written"])
+
+
+    def test_drain(self):
+        """
+        L{GreenletTransport.drain} blocks until no more than the low
+        watermark is buffered, which is 0 by default.
+        """
+        events = []
+        def writer(transport):
+            transport.write(b"x" * 25)
+            transport.drain()
+            events.append(transport.bufferedAmount)
+        twistedTransport = self.connect(writer)
+        twistedTransport.doWrite()
+        twistedTransport.doWrite()
+        self.assertEquals(events, [])
+        twistedTransport.doWrite()
+        self.assertEquals(events, [0])
+
+
+    def test_drainConnectionLost(self):
+        """
+        If the connection is lost while draining, L{GreenletTransport.drain}
+        raises the reason.
+        """
+        events = []
+        def writer(transport):
+            transport.write(b"x" * 25)
+            try:
+                transport.drain()
+            except ConnectionLost:
+                events.append("lost")
+        twistedTransport = self.connect(writer)
+        twistedTransport.protocol.connectionLost(Failure(ConnectionLost()))
+        self.assertEquals(events, ["lost"])
+
+
+
 class ClientTests(TestCase):
     """
     Tests for the client connection APIs.
@@ -357,7 +981,7 @@ class ClientTests(TestCase):
         transports = []
         def connect():
             transports.append(
-                gConnectTCP("whatever", 9090, reactor=fakeReactor))
+                gConnectTCP("192.0.2.1", 9090, reactor=fakeReactor))
 
         class FakeReactor(object):
             def __init__(self):
@@ -369,14 +993,62 @@ class ClientTests(TestCase):
         greenlet(connect).switch()
         self.assertEquals(transports, [])
         self.assertEquals(len(fakeReactor.connections), 1)
-        self.assertEquals(fakeReactor.connections[0][0], "whatever")
+        self.assertEquals(fakeReactor.connections[0][0], "192.0.2.1")
         self.assertEquals(fakeReactor.connections[0][1], 9090)
         proto = fakeReactor.connections[0][2].buildProtocol(None)
-        proto.makeConnection(FakeTransport()) # This is gonna switch back!
+        proto.makeConnection(FakeTransport(proto, False)) # This is gonna switch back!
         self.assertEquals(transports, [proto.gtransport])
 
 
 
+class EndpointTests(TestCase):
+    """
+    Tests for L{gListen} and L{gConnect}, over real UNIX sockets.
+    """
+
+    def test_connect(self):
+        """
+        A client connected with L{gConnect} can talk to a server function
+        listening with L{gListen}.
+        """
+        path = self.mktemp()
+        def echo(transport):
+            transport.write(transport.read())
+            try:
+                transport.read()
+            except ConnectionDone:
+                pass
+
+        @deferredGreenlet
+        def client():
+            server = blockOn(gListen("unix:" + path, echo))
+            self.addCleanup(server.stopAccepting)
+            transport = gConnect("unix:path=" + path)
+            transport.write(b"hello")
+            result = transport.read()
+            transport.close()
+            try:
+                transport.read()
+            except ConnectionDone:
+                pass
+            return result
+        d = client()
+        d.addCallback(self.assertEquals, b"hello")
+        return d
+
+
+    def test_connectionFailed(self):
+        """
+        L{gConnect} raises an exception if the connection could not be made.
+        """
+        path = self.mktemp()
+        @deferredGreenlet
+        def client():
+            gConnect("unix:path=" + path)
+        return self.assertFailure(client(), ConnectError)
+
+
+
 class BoringTransport(object):
     """
     A thing with a L{read} method that returns a pre-set sequence of values.
@@ -392,7 +1064,7 @@ class BoringTransport(object):
         """
         Return the next value from C{reads}.
         """
-        return self.reads.next()
+        return next(self.reads)
 
 
 
@@ -405,9 +1077,9 @@ class LineBufferTests(TestCase):
         """
         C{readLine} returns a full line without delimiter.
         """
-        io = StringIO("Hello world\r\n")
+        io = BytesIO(b"Hello world\r\n")
         wrapper = LineBuffer(io)
-        self.assertEquals(wrapper.readLine(), "Hello world")
+        self.assertEquals(wrapper.readLine(), b"Hello world")
 
 
     def test_buffer(self):
@@ -415,9 +1087,9 @@ class LineBufferTests(TestCase):
         If C{readLine} cannot immediately get a full line from
         C{transport.read}, it will buffer that data until the next read.
         """
-        transport = BoringTransport(["a", "b\r\n"])
+        transport = BoringTransport([b"a", b"b\r\n"])
         wrapper = LineBuffer(transport)
-        self.assertEquals(wrapper.readLine(), "ab")
+        self.assertEquals(wrapper.readLine(), b"ab")
 
 
     def test_multipleLinesInOnePacket(self):
@@ -425,33 +1097,33 @@ class LineBufferTests(TestCase):
         C{readLine} handles multiple lines in one C{transport.read} result by
         only returning the first and saving the rest for the next call.
         """
-        transport = BoringTransport(["foo\r\nbar\r\nbaz\r\n", "quux\r\n"])
+        transport = BoringTransport([b"foo\r\nbar\r\nbaz\r\n", b"quux\r\n"])
         wrapper = LineBuffer(transport)
-        self.assertEquals(wrapper.readLine(), "foo")
-        self.assertEquals(wrapper.readLine(), "bar")
-        self.assertEquals(wrapper.readLine(), "baz")
-        self.assertEquals(wrapper.readLine(), "quux")
+        self.assertEquals(wrapper.readLine(), b"foo")
+        self.assertEquals(wrapper.readLine(), b"bar")
+        self.assertEquals(wrapper.readLine(), b"baz")
+        self.assertEquals(wrapper.readLine(), b"quux")
 
 
     def test_multipleLines(self):
         """
         Each call to C{readLine} returns the next line received.
         """
-        transport = BoringTransport(["a\r\n", "b\r\n"])
+        transport = BoringTransport([b"a\r\n", b"b\r\n"])
         wrapper = LineBuffer(transport)
-        self.assertEquals(wrapper.readLine(), "a")
-        self.assertEquals(wrapper.readLine(), "b")
+        self.assertEquals(wrapper.readLine(), b"a")
+        self.assertEquals(wrapper.readLine(), b"b")
 
 
     def test_delimiter(self):
         """
         The delimiter can be whatever you want it to be.
         """
-        transport = BoringTransport(["helloxtharx", "yesx"])
-        wrapper = LineBuffer(transport, delimiter="x")
-        self.assertEquals(wrapper.readLine(), "hello")
-        self.assertEquals(wrapper.readLine(), "thar")
-        self.assertEquals(wrapper.readLine(), "yes")
+        transport = BoringTransport([b"helloxtharx", b"yesx"])
+        wrapper = LineBuffer(transport, delimiter=b"x")
+        self.assertEquals(wrapper.readLine(), b"hello")
+        self.assertEquals(wrapper.readLine(), b"thar")
+        self.assertEquals(wrapper.readLine(), b"yes")
 
 
     def test_iterate(self):
@@ -459,12 +1131,39 @@ class LineBufferTests(TestCase):
         The L{LineBuffer} is iterable, and acts as an infinite series of calls
         to C{readLine}.
         """
-        transport = BoringTransport(["a\r\nb\r\nc\r\nd"])
+        transport = BoringTransport([b"a\r\nb\r\nc\r\nd"])
         wrapper = LineBuffer(transport)
         iterable = iter(wrapper)
-        self.assertEquals(iterable.next(), "a")
-        self.assertEquals(iterable.next(), "b")
-        self.assertEquals(iterable.next(), "c")
+        self.assertEquals(next(iterable), b"a")
+        self.assertEquals(next(iterable), b"b")
+        self.assertEquals(next(iterable), b"c")
+
+
+    def test_delimiterSplitAcrossReads(self):
+        """
+        A delimiter which arrives in two reads is found.
+        """
+        transport = BoringTransport([b"a\r", b"\nb\r", b"\n"])
+        wrapper = LineBuffer(transport)
+        self.assertEquals(wrapper.readLine(), b"a")
+        self.assertEquals(wrapper.readLine(), b"b")
+
+
+    def test_manyLines(self):
+        """
+        Many lines in one read are all returned, followed by lines from later
+        reads.
+        """
+        transport = BoringTransport([b"%d\r\n" % (i,) for i in range(10)]
+                                    + [b"".join([b"x%d\r\n" % (i,)
+                                                for i in range(1000)]) + b"y",
+                                       b"z\r\n"])
+        wrapper = LineBuffer(transport)
+        lines = [wrapper.readLine() for i in range(1011)]
+        self.assertEquals(
+            lines,
+            [b"%d" % (i,) for i in range(10)]
+            + [b"x%d" % (i,) for i in range(1000)] + [b"yz"])
 
 
     def test_writeLine(self):
@@ -472,19 +1171,19 @@ class LineBufferTests(TestCase):
         C{writeLine} is a convenience method for writing some data followed by
         a delimiter.
         """
-        io = StringIO()
+        io = BytesIO()
         wrapper = LineBuffer(io)
-        wrapper.writeLine("foo")
-        wrapper.writeLine("bar")
-        self.assertEquals(io.getvalue(), "foo\r\nbar\r\n")
+        wrapper.writeLine(b"foo")
+        wrapper.writeLine(b"bar")
+        self.assertEquals(io.getvalue(), b"foo\r\nbar\r\n")
 
 
     def test_writeLineWithDelimiter(self):
         """
         C{writeLine} honors the specified delimiter.
         """
-        io = StringIO()
-        wrapper = LineBuffer(io, delimiter="Woot,")
-        wrapper.writeLine("foo")
-        wrapper.writeLine("bar")
-        self.assertEquals(io.getvalue(), "fooWoot,barWoot,")
+        io = BytesIO()
+        wrapper = LineBuffer(io, delimiter=b"Woot,")
+        wrapper.writeLine(b"foo")
+        wrapper.writeLine(b"bar")
+        self.assertEquals(io.getvalue(), b"fooWoot,barWoot,")
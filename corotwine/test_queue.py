@@ -0,0 +1,151 @@
+"""
+Tests for L{corotwine.queue}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from corotwine import greenlet
+from corotwine.queue import Queue
+
+
+class QueueTests(TestCase):
+    """
+    Tests for L{Queue}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+
+
+    def test_putThenGet(self):
+        """
+        Objects are returned by L{Queue.get} in the order they were put.
+        """
+        queue = Queue(clock=self.clock)
+        queue.put(1)
+        queue.put(2)
+        results = []
+        def getter():
+            results.append(queue.get())
+            results.append(queue.get())
+        greenlet(getter).switch()
+        self.assertEquals(results, [1, 2])
+        self.assertEquals(len(queue), 0)
+
+
+    def test_getBlocks(self):
+        """
+        L{Queue.get} blocks while the queue is empty, and the greenlet is
+        woken on the next reactor iteration after something is put.
+        """
+        queue = Queue(clock=self.clock)
+        results = []
+        def getter():
+            results.append(queue.get())
+        greenlet(getter).switch()
+        self.assertEquals(results, [])
+        queue.put("hello")
+        self.assertEquals(results, [])
+        self.clock.advance(0)
+        self.assertEquals(results, ["hello"])
+        self.assertEquals(len(queue), 0)
+
+
+    def test_putBlocksWhenFull(self):
+        """
+        L{Queue.put} blocks while a bounded queue is full.
+        """
+        queue = Queue(maxSize=1, clock=self.clock)
+        events = []
+        def putter():
+            queue.put(1)
+            events.append("put 1")
+            queue.put(2)
+            events.append("put 2")
+        greenlet(putter).switch()
+        self.assertEquals(events, ["put 1"])
+        self.assertTrue(queue.full())
+        results = []
+        def getter():
+            results.append(queue.get())
+            results.append(queue.get())
+        greenlet(getter).switch()
+        self.assertEquals(results, [1, 2])
+        self.assertEquals(events, ["put 1"])
+        self.clock.advance(0)
+        self.assertEquals(events, ["put 1", "put 2"])
+
+
+    def interruptible(self, function, *args):
+        """
+        Call C{function} in a new greenlet, recording its result, or
+        C{"interrupted"} if C{ZeroDivisionError} is thrown into it.
+
+        @return: The greenlet, and a list the result will be appended to.
+        """
+        results = []
+        def run():
+            try:
+                results.append(function(*args))
+            except ZeroDivisionError:
+                results.append("interrupted")
+        g = greenlet(run)
+        g.switch()
+        return g, results
+
+
+    def test_getterInterrupted(self):
+        """
+        A greenlet interrupted while blocked in L{Queue.get} stops waiting,
+        and a later L{Queue.put} reaches the next getter.
+        """
+        queue = Queue(clock=self.clock)
+        first, firstResults = self.interruptible(queue.get)
+        second, secondResults = self.interruptible(queue.get)
+        first.throw(ZeroDivisionError())
+        queue.put("item")
+        self.clock.advance(0)
+        self.assertEquals(firstResults, ["interrupted"])
+        self.assertEquals(secondResults, ["item"])
+        self.assertEquals(len(queue), 0)
+
+
+    def test_getterInterruptedWhileWoken(self):
+        """
+        An object handed to a getter which is interrupted before it runs
+        goes to the next getter, or back to the front of the queue, and the
+        interrupted greenlet is not switched to.
+        """
+        queue = Queue(clock=self.clock)
+        first, firstResults = self.interruptible(queue.get)
+        second, secondResults = self.interruptible(queue.get)
+        queue.put("item")
+        first.throw(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertEquals(firstResults, ["interrupted"])
+        self.assertEquals(secondResults, ["item"])
+
+        third, thirdResults = self.interruptible(queue.get)
+        queue.put("other")
+        queue.put("last")
+        third.throw(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertEquals(thirdResults, ["interrupted"])
+        self.assertEquals(list(queue._items), ["other", "last"])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def test_putterInterrupted(self):
+        """
+        A greenlet interrupted while blocked in L{Queue.put} stops waiting,
+        and its object is not added to the queue.
+        """
+        queue = Queue(maxSize=1, clock=self.clock)
+        queue.put(1)
+        putter, putterResults = self.interruptible(queue.put, 2)
+        putter.throw(ZeroDivisionError())
+        self.assertEquals(putterResults, ["interrupted"])
+        self.assertEquals(queue.get(), 1)
+        self.assertEquals(len(queue), 0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,281 @@
+"""
+Tests for L{corotwine.ratelimit}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.task import Clock
+
+from corotwine import greenlet
+from corotwine.protocol import _GreenletFactory
+from corotwine.ratelimit import LimiterGroup
+
+
+class TokenBucketTests(TestCase):
+    """
+    Tests for L{TokenBucket} and L{LimiterGroup}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.group = LimiterGroup(10, 20, self.clock)
+
+
+    def test_startsFull(self):
+        """
+        A new bucket holds C{burst} tokens.
+        """
+        self.assertEquals(self.group.bucket().tokens, 20)
+
+
+    def test_tryConsume(self):
+        """
+        L{TokenBucket.tryConsume} spends tokens if there are enough, and
+        otherwise spends nothing.
+        """
+        bucket = self.group.bucket()
+        self.assertTrue(bucket.tryConsume(15))
+        self.assertFalse(bucket.tryConsume(15))
+        self.assertEquals(bucket.tokens, 5)
+
+
+    def test_refill(self):
+        """
+        Tokens are added at C{rate} per second, up to C{burst}.
+        """
+        bucket = self.group.bucket()
+        bucket.tryConsume(20)
+        self.clock.advance(1)
+        self.assertEquals(bucket.tokens, 10)
+        self.clock.advance(10)
+        self.assertEquals(bucket.tokens, 20)
+
+
+    def test_consumeBlocks(self):
+        """
+        L{TokenBucket.consume} blocks the calling greenlet until there are
+        enough tokens.
+        """
+        bucket = self.group.bucket()
+        events = []
+        def consumer():
+            bucket.consume(20)
+            events.append("first")
+            bucket.consume(5)
+            events.append("second")
+        greenlet(consumer).switch()
+        self.assertEquals(events, ["first"])
+        self.clock.advance(0.4)
+        self.assertEquals(events, ["first"])
+        self.clock.advance(0.1)
+        self.assertEquals(events, ["first", "second"])
+
+
+    def test_debt(self):
+        """
+        A request for more than C{burst} tokens is served once the bucket is
+        full, and leaves it in debt.
+        """
+        bucket = self.group.bucket()
+        events = []
+        def consumer():
+            bucket.consume(50)
+            events.append("done")
+        greenlet(consumer).switch()
+        self.assertEquals(events, ["done"])
+        self.assertEquals(bucket.tokens, -30)
+
+
+    def test_inOrder(self):
+        """
+        Waiters on a bucket are served in the order they arrived.
+        """
+        bucket = self.group.bucket()
+        bucket.tryConsume(20)
+        events = []
+        bucket.whenAvailable(20, lambda: events.append("big"))
+        self.assertFalse(bucket.tryConsume(1))
+        bucket.whenAvailable(1, lambda: events.append("small"))
+        self.clock.advance(1)
+        self.assertEquals(events, [])
+        self.clock.advance(1)
+        self.assertEquals(events, ["big"])
+        self.clock.advance(0.1)
+        self.assertEquals(events, ["big", "small"])
+
+
+    def test_oneTimer(self):
+        """
+        All the buckets in a group share one timer, which is only scheduled
+        while there are waiters.
+        """
+        buckets = [self.group.bucket() for i in range(10)]
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        served = []
+        for i, bucket in enumerate(buckets):
+            bucket.tryConsume(20)
+            bucket.whenAvailable(i + 1, lambda i=i: served.append(i))
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.clock.pump([0.1] * 10)
+        self.assertEquals(served, list(range(10)))
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def test_zeroRate(self):
+        """
+        A group's rate must be more than 0.
+        """
+        self.assertRaises(ValueError, LimiterGroup, 0, 20, self.clock)
+        self.assertRaises(ValueError, LimiterGroup, -1, 20, self.clock)
+
+
+    def test_consumeInterrupted(self):
+        """
+        If an exception is thrown into a greenlet waiting in
+        L{TokenBucket.consume}, its request is withdrawn, so it is not woken
+        later in whatever else it waits for, and those behind it are served
+        as though it had not been made.
+        """
+        bucket = self.group.bucket()
+        bucket.tryConsume(20)
+        events = []
+        def consumer():
+            try:
+                bucket.consume(20)
+            except ZeroDivisionError:
+                events.append("interrupted")
+            events.append(greenlet.getcurrent().parent.switch())
+        g = greenlet(consumer)
+        g.switch()
+        bucket.whenAvailable(1, lambda: events.append("small"))
+        g.throw(ZeroDivisionError())
+        self.assertEquals(events, ["interrupted"])
+        self.clock.advance(0.1)
+        self.assertEquals(events, ["interrupted", "small"])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.clock.advance(2)
+        self.assertEquals(events, ["interrupted", "small"])
+        g.switch("woken")
+        self.assertEquals(events, ["interrupted", "small", "woken"])
+
+
+    def test_lastWaiterInterrupted(self):
+        """
+        The timer is stopped when the only waiter is interrupted.
+        """
+        bucket = self.group.bucket()
+        bucket.tryConsume(20)
+        def consumer():
+            try:
+                bucket.consume(20)
+            except ZeroDivisionError:
+                pass
+        g = greenlet(consumer)
+        g.switch()
+        g.throw(ZeroDivisionError())
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.assertEquals(bucket.tokens, 0)
+
+
+
+class TransportLimitTests(TestCase):
+    """
+    Tests for rate limits on L{GreenletTransport} and on accepting
+    connections.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+
+
+    def connect(self, function, **kwargs):
+        """
+        Connect C{function} via a L{_GreenletFactory} created with C{kwargs}
+        to a L{FakeTransport}.
+
+        @rtype: Two-tuple of L{FakeTransport}, L{GreenletProtocol}.
+        """
+        factory = _GreenletFactory(function, clock=self.clock, **kwargs)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport, protocol
+
+
+    def test_writeLimit(self):
+        """
+        Writes block until their bytes' tokens are available.
+        """
+        def writer(transport):
+            transport.write(b"x" * 10)
+            transport.write(b"y" * 10)
+        twistedTransport, protocol = self.connect(
+            writer, writeLimit=LimiterGroup(10, 10, self.clock))
+        self.assertEquals(twistedTransport.stream, [b"x" * 10])
+        self.clock.advance(1)
+        self.assertEquals(twistedTransport.stream, [b"x" * 10, b"y" * 10])
+
+
+    def test_writeLimitAndPause(self):
+        """
+        A write which waited for tokens still waits for the transport to
+        resume producing.
+        """
+        def writer(transport):
+            transport.write(b"x" * 10)
+            transport.write(b"y" * 10)
+        twistedTransport, protocol = self.connect(
+            writer, writeLimit=LimiterGroup(10, 10, self.clock))
+        protocol.pauseProducing()
+        self.clock.advance(1)
+        self.assertEquals(twistedTransport.stream, [b"x" * 10])
+        protocol.resumeProducing()
+        self.assertEquals(twistedTransport.stream, [b"x" * 10, b"y" * 10])
+
+
+    def test_readLimit(self):
+        """
+        Reads block until their bytes' tokens are available, and the
+        transport stops reading while they wait.
+        """
+        reads = []
+        def reader(transport):
+            while True:
+                reads.append(transport.read())
+        pauses = []
+        twistedTransport, protocol = self.connect(
+            reader, readLimit=LimiterGroup(10, 10, self.clock))
+        twistedTransport.pauseProducing = lambda: pauses.append("pause")
+        twistedTransport.resumeProducing = lambda: pauses.append("resume")
+        protocol.dataReceived(b"x" * 10)
+        self.assertEquals(reads, [b"x" * 10])
+        protocol.dataReceived(b"y" * 10)
+        self.assertEquals(reads, [b"x" * 10])
+        self.assertEquals(pauses, ["pause"])
+        self.clock.advance(1)
+        self.assertEquals(reads, [b"x" * 10, b"y" * 10])
+        self.assertEquals(pauses, ["pause", "resume"])
+
+
+    def test_acceptLimit(self):
+        """
+        Handlers only start once the listener has a token for them, and
+        connections are queued until then.
+        """
+        started = []
+        def handler(transport):
+            started.append(transport)
+            transport.read()
+        factory = _GreenletFactory(
+            handler, clock=self.clock,
+            acceptLimit=LimiterGroup(1, 1, self.clock))
+        for i in range(3):
+            protocol = factory.buildProtocol(None)
+            protocol.makeConnection(FakeTransport(protocol, True))
+        self.assertEquals(len(started), 1)
+        self.assertEquals(len(factory._queued), 2)
+        self.clock.advance(1)
+        self.assertEquals(len(started), 2)
+        self.clock.advance(1)
+        self.assertEquals(len(started), 3)
+        self.assertEquals(len(factory._queued), 0)
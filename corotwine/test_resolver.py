@@ -0,0 +1,368 @@
+"""
+Tests for L{corotwine.resolver}.
+"""
+
+from socket import AF_INET, AF_INET6
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+from twisted.internet.error import (
+    DNSLookupError, ConnectionRefusedError, UserError, ConnectError)
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.python.failure import Failure
+
+from corotwine.protocol import gConnectTCP
+from corotwine.resolver import Resolver, systemLookup, systemTTL, _interleave
+from corotwine import greenlet
+
+
+class FakeConnector(object):
+    """
+    A connector whose connection attempt can be made to succeed or fail.
+    """
+
+    def __init__(self, host, port, factory):
+        self.host = host
+        self.port = port
+        self.factory = factory
+        self.state = "connecting"
+        self.protocol = None
+
+
+    def succeed(self):
+        self.state = "connected"
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.makeConnection(FakeTransport(self.protocol, False))
+
+
+    def fail(self, reason):
+        self.state = "disconnected"
+        self.factory.clientConnectionFailed(self, Failure(reason))
+
+
+    def stopConnecting(self):
+        self.fail(UserError())
+
+
+
+class FakeReactor(Clock):
+    """
+    A clock which records TCP connection attempts.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.connectors = []
+
+
+    def connectTCP(self, host, port, factory):
+        connector = FakeConnector(host, port, factory)
+        self.connectors.append(connector)
+        return connector
+
+
+
+class FakeNameResolver(object):
+    """
+    A reactor name resolver which answers with the given addresses.
+    """
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.resolved = []
+
+
+    def resolveHostName(self, receiver, hostName, portNumber=0,
+                        addressTypes=None, transportSemantics="TCP"):
+        self.resolved.append(hostName)
+        receiver.resolutionBegan(None)
+        for address in self.addresses:
+            receiver.addressResolved(address)
+        receiver.resolutionComplete()
+
+
+
+class SystemLookupTests(TestCase):
+    """
+    Tests for L{systemLookup}.
+    """
+
+    def lookup(self, addresses):
+        reactor = Clock()
+        reactor.nameResolver = FakeNameResolver(addresses)
+        results = []
+        systemLookup("db", reactor).addBoth(results.append)
+        self.assertEquals(reactor.nameResolver.resolved, ["db"])
+        return results
+
+
+    def test_addresses(self):
+        """
+        The addresses found by the reactor's name resolver are returned
+        once each, with their families and L{systemTTL}.
+        """
+        address = IPv4Address("TCP", "10.0.0.1", 0)
+        results = self.lookup(
+            [address, address, IPv6Address("TCP", "::1", 0)])
+        self.assertEquals(results, [[(AF_INET, "10.0.0.1", systemTTL),
+                                     (AF_INET6, "::1", systemTTL)]])
+
+
+    def test_notFound(self):
+        """
+        If no addresses are found, the lookup fails with
+        L{DNSLookupError}.
+        """
+        results = self.lookup([])
+        self.assertIsInstance(results[0].value, DNSLookupError)
+
+
+
+class ResolverTests(TestCase):
+    """
+    Tests for L{Resolver}'s cache.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.lookups = []
+        self.resolver = Resolver(self.clock, self.lookup, maxTTL=100,
+                                 negativeTTL=10)
+
+
+    def lookup(self, host):
+        d = Deferred()
+        self.lookups.append((host, d))
+        return d
+
+
+    def resolve(self, host):
+        results = []
+        self.resolver.resolveDeferred(host).addBoth(results.append)
+        return results
+
+
+    def test_literal(self):
+        """
+        IP addresses are returned without being looked up.
+        """
+        self.assertEquals(self.resolve("10.0.0.1"), [[(AF_INET, "10.0.0.1")]])
+        self.assertEquals(self.resolve("::1"), [[(AF_INET6, "::1")]])
+        self.assertEquals(self.lookups, [])
+
+
+    def test_cached(self):
+        """
+        An answer is cached for the shortest TTL of its records.
+        """
+        results = self.resolve("example.com")
+        self.lookups[0][1].callback(
+            [(AF_INET, "10.0.0.1", 60), (AF_INET, "10.0.0.2", 30)])
+        addresses = [(AF_INET, "10.0.0.1"), (AF_INET, "10.0.0.2")]
+        self.assertEquals(results, [addresses])
+        self.clock.advance(29)
+        self.assertEquals(self.resolve("example.com"), [addresses])
+        self.assertEquals(len(self.lookups), 1)
+        self.clock.advance(1)
+        self.assertEquals(self.resolve("example.com"), [])
+        self.assertEquals(len(self.lookups), 2)
+
+
+    def test_cachedCopy(self):
+        """
+        Changing the list of addresses returned from the cache doesn't
+        change the cache.
+        """
+        self.resolve("example.com")
+        self.lookups[0][1].callback([(AF_INET, "10.0.0.1", 60)])
+        self.resolve("example.com")[0].append((AF_INET, "10.0.0.2"))
+        self.assertEquals(self.resolve("example.com"),
+                          [[(AF_INET, "10.0.0.1")]])
+
+
+    def test_maxTTL(self):
+        """
+        No answer is cached for longer than C{maxTTL}.
+        """
+        self.resolve("example.com")
+        self.lookups[0][1].callback([(AF_INET, "10.0.0.1", 86400)])
+        self.clock.advance(100)
+        self.resolve("example.com")
+        self.assertEquals(len(self.lookups), 2)
+
+
+    def test_negative(self):
+        """
+        A name which does not exist is remembered for C{negativeTTL} seconds.
+        """
+        results = self.resolve("nowhere.invalid")
+        self.lookups[0][1].errback(DNSLookupError("nowhere.invalid"))
+        results[0].trap(DNSLookupError)
+        self.clock.advance(9)
+        self.resolve("nowhere.invalid")[0].trap(DNSLookupError)
+        self.assertEquals(len(self.lookups), 1)
+        self.clock.advance(1)
+        self.resolve("nowhere.invalid")
+        self.assertEquals(len(self.lookups), 2)
+
+
+    def test_noAddresses(self):
+        """
+        A lookup which finds no addresses fails with L{DNSLookupError}.
+        """
+        results = self.resolve("example.com")
+        self.lookups[0][1].callback([])
+        results[0].trap(DNSLookupError)
+
+
+    def test_otherErrorsNotCached(self):
+        """
+        Failures other than L{DNSLookupError}, such as timeouts, are passed on
+        but not cached.
+        """
+        results = self.resolve("example.com")
+        self.lookups[0][1].errback(ZeroDivisionError())
+        results[0].trap(ZeroDivisionError)
+        self.resolve("example.com")
+        self.assertEquals(len(self.lookups), 2)
+
+
+    def test_shared(self):
+        """
+        Requests for a name which is being looked up share that lookup.
+        """
+        first = self.resolve("example.com")
+        second = self.resolve("example.com")
+        self.assertEquals(len(self.lookups), 1)
+        self.lookups[0][1].callback([(AF_INET, "10.0.0.1", 60)])
+        self.assertEquals(first, second)
+        self.assertEquals(first, [[(AF_INET, "10.0.0.1")]])
+
+
+    def test_maxSize(self):
+        """
+        When the cache is full, the least recently used name is forgotten.
+        """
+        self.resolver.maxSize = 2
+        for name in ["a", "b"]:
+            self.resolve(name)
+            self.lookups[-1][1].callback([(AF_INET, "10.0.0.1", 60)])
+        self.resolve("a")
+        self.resolve("c")
+        self.lookups[-1][1].callback([(AF_INET, "10.0.0.1", 60)])
+        self.assertEquals(list(self.resolver._cache), ["a", "c"])
+
+
+    def test_forget(self):
+        """
+        L{Resolver.forget} removes a name from the cache.
+        """
+        self.resolve("example.com")
+        self.lookups[0][1].callback([(AF_INET, "10.0.0.1", 60)])
+        self.resolver.forget("example.com")
+        self.resolve("example.com")
+        self.assertEquals(len(self.lookups), 2)
+
+
+    def test_interleave(self):
+        """
+        Addresses are ordered alternately by family, starting with IPv6.
+        """
+        self.assertEquals(
+            _interleave([(AF_INET, "a"), (AF_INET, "b"), (AF_INET, "c"),
+                         (AF_INET6, "x"), (AF_INET6, "y")]),
+            [(AF_INET6, "x"), (AF_INET, "a"), (AF_INET6, "y"),
+             (AF_INET, "b"), (AF_INET, "c")])
+
+
+
+class ConnectTests(TestCase):
+    """
+    Tests for L{gConnectTCP}'s use of a L{Resolver}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.resolver = Resolver(self.reactor, self.lookup)
+        self.addresses = [(AF_INET6, "::1", 60), (AF_INET, "10.0.0.1", 60),
+                          (AF_INET, "10.0.0.2", 60)]
+        self.results = []
+
+
+    def lookup(self, host):
+        d = Deferred()
+        d.callback(self.addresses)
+        return d
+
+
+    def connect(self):
+        def connect():
+            try:
+                self.results.append(gConnectTCP(
+                    "example.com", 80, self.reactor, resolver=self.resolver))
+            except:
+                self.results.append(Failure())
+        greenlet(connect).switch()
+
+
+    def test_firstAddress(self):
+        """
+        If the first address connects within C{attemptDelay}, no others are
+        tried.
+        """
+        self.connect()
+        self.assertEquals([c.host for c in self.reactor.connectors], ["::1"])
+        self.reactor.connectors[0].succeed()
+        self.assertEquals(self.results,
+                          [self.reactor.connectors[0].protocol.gtransport])
+        self.assertEquals(self.reactor.getDelayedCalls(), [])
+
+
+    def test_race(self):
+        """
+        An attempt which has not connected after C{attemptDelay} is raced by
+        the next address, and the loser is abandoned.
+        """
+        self.connect()
+        self.reactor.advance(0.25)
+        connectors = self.reactor.connectors
+        self.assertEquals([c.host for c in connectors], ["::1", "10.0.0.1"])
+        connectors[1].succeed()
+        self.assertEquals(self.results, [connectors[1].protocol.gtransport])
+        self.assertEquals(connectors[0].state, "disconnected")
+        self.assertEquals(self.reactor.getDelayedCalls(), [])
+
+
+    def test_failureTriesNext(self):
+        """
+        When an attempt fails, the next address is tried straight away.
+        """
+        self.connect()
+        self.reactor.connectors[0].fail(ConnectionRefusedError())
+        self.assertEquals([c.host for c in self.reactor.connectors],
+                          ["::1", "10.0.0.1"])
+        self.reactor.connectors[1].succeed()
+        self.assertEquals(len(self.results), 1)
+
+
+    def test_allFail(self):
+        """
+        If every address fails, L{gConnectTCP} raises the last failure.
+        """
+        self.connect()
+        for i in range(3):
+            self.reactor.connectors[-1].fail(ConnectionRefusedError())
+        self.assertEquals(len(self.reactor.connectors), 3)
+        self.results[0].trap(ConnectError)
+
+
+    def test_lookupFails(self):
+        """
+        If the name can't be resolved, L{gConnectTCP} raises
+        L{DNSLookupError}.
+        """
+        self.addresses = []
+        self.connect()
+        self.results[0].trap(DNSLookupError)
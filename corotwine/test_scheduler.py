@@ -0,0 +1,274 @@
+"""
+Tests for L{corotwine.scheduler}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from corotwine.scheduler import Scheduler, setPriority, getPriority
+from corotwine.protocol import _GreenletFactory
+from corotwine.defer import blockOn
+from corotwine import greenlet
+
+
+class SchedulerTests(TestCase):
+    """
+    Tests for L{Scheduler}'s queue.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = Scheduler(self.clock)
+        self.calls = []
+
+
+    def test_order(self):
+        """
+        Queued calls are made by the next run, lowest priority first, and
+        in the order they were queued within a priority.
+        """
+        for name, priority in [("a", 1), ("b", 0), ("c", 1), ("d", -1)]:
+            self.scheduler.call(
+                lambda name=name: self.calls.append(name), priority)
+        self.assertEquals(self.calls, [])
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ["d", "b", "a", "c"])
+        self.assertEquals((self.scheduler.calls, self.scheduler.runs), (4, 1))
+
+
+    def test_queuedWhileRunning(self):
+        """
+        Calls queued while the queue runs are made by the next run, even if
+        they have a lower priority.
+        """
+        runs = []
+        def first():
+            runs.append(self.scheduler.runs)
+            self.scheduler.call(
+                lambda: runs.append(self.scheduler.runs), -1)
+        self.scheduler.call(first)
+        self.scheduler.call(lambda: runs.append(self.scheduler.runs))
+        self.clock.advance(0)
+        self.assertEquals(runs, [1, 1, 2])
+
+
+    def test_exceptionLogged(self):
+        """
+        An exception raised by a call is logged, and the rest of the calls
+        are still made.
+        """
+        self.scheduler.call(lambda: 1 / 0)
+        self.scheduler.call(lambda: self.calls.append("after"))
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ["after"])
+        self.assertEquals(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+    def test_switch(self):
+        """
+        L{Scheduler.switch} queues a switch to a greenlet with its priority.
+        """
+        def waiter():
+            self.calls.append(greenlet.getcurrent().parent.switch())
+        low, high = greenlet(waiter), greenlet(waiter)
+        low.switch()
+        high.switch()
+        setPriority(-1, high)
+        self.scheduler.switch(low, "low")
+        self.scheduler.switch(high, "high")
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ["high", "low"])
+
+
+    def test_priority(self):
+        """
+        Greenlets have priority C{0} until it is set.
+        """
+        g = greenlet(lambda: None)
+        self.assertEquals(getPriority(g), 0)
+        setPriority(5, g)
+        self.assertEquals(getPriority(g), 5)
+
+
+    def test_install(self):
+        """
+        L{Scheduler.uninstall} only uninstalls the installed scheduler.
+        """
+        from corotwine import scheduler
+        self.scheduler.install()
+        Scheduler(self.clock).uninstall()
+        self.assertIdentical(scheduler._current, self.scheduler)
+        self.scheduler.uninstall()
+        self.assertIdentical(scheduler._current, None)
+
+
+
+class ScheduledIOTests(TestCase):
+    """
+    Tests for waking greenlets blocked in I/O with an installed
+    L{Scheduler}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = Scheduler(self.clock)
+        self.scheduler.install()
+        self.addCleanup(self.scheduler.uninstall)
+        self.events = []
+
+
+    def connect(self, function):
+        factory = _GreenletFactory(function, clock=self.clock)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return twistedTransport, protocol
+
+
+    def reader(self, transport):
+        try:
+            while True:
+                self.events.append(transport.read())
+        except ConnectionDone as e:
+            self.events.append(e)
+
+
+    def test_coalesce(self):
+        """
+        Data which arrives in one reactor iteration is read at once, by one
+        switch, at the end of the iteration.
+        """
+        twistedTransport, protocol = self.connect(self.reader)
+        protocol.dataReceived(b"a")
+        protocol.dataReceived(b"b")
+        self.assertEquals(self.events, [])
+        self.clock.advance(0)
+        self.assertEquals(self.events, [b"ab"])
+        self.assertEquals(self.scheduler.calls, 1)
+
+
+    def test_priorities(self):
+        """
+        A connection whose handler has a lower priority runs first.
+        """
+        def control(transport):
+            transport.setPriority(-1)
+            self.events.append(("control", transport.read()))
+        def bulk(transport):
+            self.events.append(("bulk", transport.read()))
+        bulkTransport, bulkProtocol = self.connect(bulk)
+        controlTransport, controlProtocol = self.connect(control)
+        bulkProtocol.dataReceived(b"data")
+        controlProtocol.dataReceived(b"stop")
+        self.clock.advance(0)
+        self.assertEquals(self.events, [("control", b"stop"), ("bulk", b"data")])
+
+
+    def test_resumeWriting(self):
+        """
+        A greenlet blocked writing is queued when the transport resumes it.
+        """
+        def writer(transport):
+            transport._paused = True
+            transport.write(b"data")
+            self.events.append("written")
+        twistedTransport, protocol = self.connect(writer)
+        protocol.resumeProducing()
+        self.assertEquals(self.events, [])
+        self.clock.advance(0)
+        self.assertEquals(self.events, ["written"])
+
+
+    def test_lostWhileQueuedWriting(self):
+        """
+        If the connection is lost while a greenlet woken from writing is
+        queued, its write raises the reason.
+        """
+        def writer(transport):
+            transport._paused = True
+            try:
+                transport.write(b"data")
+            except ConnectionDone as e:
+                self.events.append(e)
+        twistedTransport, protocol = self.connect(writer)
+        protocol.resumeProducing()
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.clock.advance(0)
+        self.assertEquals(len(self.events), 1)
+        self.assertIsInstance(self.events[0], ConnectionDone)
+
+
+    def test_lostWhileQueuedReading(self):
+        """
+        If the connection is lost while a greenlet woken from reading is
+        queued, it reads the data which woke it, and then the reason.
+        """
+        twistedTransport, protocol = self.connect(self.reader)
+        protocol.dataReceived(b"last")
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.clock.advance(0)
+        self.assertEquals(self.events[0], b"last")
+        self.assertIsInstance(self.events[1], ConnectionDone)
+
+
+    def test_abortedWhileQueued(self):
+        """
+        A queued greenlet which is woken by something else before the queue
+        runs is not switched to again.
+        """
+        twistedTransport, protocol = self.connect(self.reader)
+        protocol.dataReceived(b"data")
+        protocol._abort(ConnectionDone())
+        self.clock.advance(0)
+        self.assertEquals(len(self.events), 1)
+        self.assertIsInstance(self.events[0], ConnectionDone)
+
+
+    def test_blockOn(self):
+        """
+        A greenlet blocked on a L{Deferred} is queued when it fires, with
+        its result or its failure.
+        """
+        succeeding, failing = Deferred(), Deferred()
+        def waiter():
+            self.events.append(blockOn(succeeding))
+            try:
+                blockOn(failing)
+            except ZeroDivisionError:
+                self.events.append("failed")
+        greenlet(waiter).switch()
+        succeeding.callback("result")
+        self.assertEquals(self.events, [])
+        self.clock.advance(0)
+        self.assertEquals(self.events, ["result"])
+        failing.errback(ZeroDivisionError())
+        self.assertEquals(self.events, ["result"])
+        self.clock.advance(0)
+        self.assertEquals(self.events, ["result", "failed"])
+
+
+    def test_blockOnResumedElsewhere(self):
+        """
+        A greenlet queued by L{blockOn} is not switched to if something else
+        resumes it before the queue runs.
+        """
+        first, second = Deferred(), Deferred()
+        def waiter():
+            try:
+                blockOn(first)
+            except ZeroDivisionError:
+                self.events.append("interrupted")
+            self.events.append(blockOn(second))
+        g = greenlet(waiter)
+        g.switch()
+        first.callback("stale")
+        g.throw(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertEquals(self.events, ["interrupted"])
+        second.callback("fresh")
+        self.clock.advance(0)
+        self.assertEquals(self.events, ["interrupted", "fresh"])
@@ -0,0 +1,198 @@
+"""
+Tests for L{corotwine.select}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from corotwine import greenlet
+from corotwine.protocol import _GreenletFactory
+from corotwine.queue import Queue
+from corotwine.select import select
+
+
+class SelectTests(TestCase):
+    """
+    Tests for L{select}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+
+
+    def connect(self, function):
+        """
+        Connect C{function} to a L{FakeTransport}.
+
+        @return: The L{_GreenletProtocol}.
+        """
+        factory = _GreenletFactory(function, clock=self.clock)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        return protocol
+
+
+    def transports(self, count):
+        """
+        Make C{count} connected L{GreenletTransport}s whose handlers do
+        nothing but wait.
+
+        @return: A list of two-tuples of L{GreenletTransport} and
+            L{_GreenletProtocol}.
+        """
+        def waiter(transport):
+            greenlet.getcurrent().parent.switch()
+        result = []
+        for i in range(count):
+            protocol = self.connect(waiter)
+            result.append((protocol.gtransport, protocol))
+        return result
+
+
+    def select(self, sources, timeout=None):
+        """
+        Call L{select} in a new greenlet.
+
+        @return: A list which the result of L{select} will be appended to.
+        """
+        results = []
+        def selecter():
+            results.append(select(sources, timeout, self.clock))
+        greenlet(selecter).switch()
+        return results
+
+
+    def test_alreadyReady(self):
+        """
+        If some sources are already ready, L{select} returns them straight
+        away.
+        """
+        (first, firstProtocol), (second, secondProtocol) = self.transports(2)
+        secondProtocol.dataReceived(b"foo")
+        d = Deferred()
+        d.callback(None)
+        self.assertEquals(select([first, second, d]), [second, d])
+
+
+    def test_transport(self):
+        """
+        L{select} returns when data is received by one of the transports.
+        """
+        (first, firstProtocol), (second, secondProtocol) = self.transports(2)
+        results = self.select([first, second])
+        self.assertEquals(results, [])
+        secondProtocol.dataReceived(b"foo")
+        self.assertEquals(results, [[second]])
+        self.assertEquals(second.read(), b"foo")
+
+
+    def test_deregister(self):
+        """
+        Once L{select} returns, it is no longer registered with any source.
+        """
+        (first, firstProtocol), (second, secondProtocol) = self.transports(2)
+        queue = Queue(clock=self.clock)
+        results = self.select([first, second, queue])
+        firstProtocol.dataReceived(b"foo")
+        self.assertEquals(results, [[first]])
+        self.assertEquals(first._selectors, set())
+        self.assertEquals(second._selectors, set())
+        self.assertEquals(queue._selectors, set())
+        secondProtocol.dataReceived(b"bar")
+        self.assertEquals(results, [[first]])
+
+
+    def test_connectionLost(self):
+        """
+        A transport whose connection is lost is ready, since C{read} will
+        raise.
+        """
+        [(transport, protocol)] = self.transports(1)
+        results = self.select([transport])
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(results, [[transport]])
+
+
+    def test_deferred(self):
+        """
+        L{select} returns when one of the L{Deferred}s fires, without
+        changing its result.
+        """
+        d = Deferred()
+        results = self.select([Deferred(), d])
+        d.callback("result")
+        self.assertEquals(results, [[d]])
+        d.addCallback(self.assertEquals, "result")
+
+
+    def test_queue(self):
+        """
+        L{select} returns on the next reactor iteration after something is put
+        in one of the queues, when it was put from another greenlet.
+        """
+        queue = Queue(clock=self.clock)
+        results = self.select([queue])
+        greenlet(queue.put).switch("hello")
+        self.assertEquals(results, [])
+        self.clock.advance(0)
+        self.assertEquals(results, [[queue]])
+        self.assertEquals(len(queue), 1)
+
+
+    def test_timeout(self):
+        """
+        If nothing is ready within C{timeout} seconds, L{select} returns an
+        empty list, and the timer is cancelled otherwise.
+        """
+        results = self.select([Deferred()], timeout=5)
+        self.clock.advance(5)
+        self.assertEquals(results, [[]])
+        d = Deferred()
+        results = self.select([d], timeout=5)
+        d.callback(None)
+        self.assertEquals(results, [[d]])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def test_deferredRegisteredOnce(self):
+        """
+        Selecting on a L{Deferred} over and over adds one callback to it,
+        and each selector is removed from it when its select returns.
+        """
+        d = Deferred()
+        for i in range(100):
+            self.select([d], timeout=1)
+            self.clock.advance(1)
+        self.assertEquals(len(d.callbacks), 1)
+        self.assertEquals(d._selectors, set())
+        results = self.select([d])
+        d.callback(None)
+        self.assertEquals(results, [[d]])
+
+
+    def test_wakeCancelled(self):
+        """
+        A wake up scheduled from a greenlet other than the reactor's is
+        cancelled if L{select} ends some other way first, so that it does
+        not resume whatever the greenlet waits for next.
+        """
+        queue = Queue(clock=self.clock)
+        events = []
+        def selecter():
+            try:
+                select([queue], None, self.clock)
+            except ZeroDivisionError:
+                events.append("interrupted")
+            events.append(greenlet.getcurrent().parent.switch())
+        g = greenlet(selecter)
+        g.switch()
+        greenlet(queue.put).switch("item")
+        g.throw(ZeroDivisionError())
+        self.clock.advance(0)
+        self.assertEquals(events, ["interrupted"])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,214 @@
+"""
+Tests for L{corotwine.simulation}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.error import ConnectionClosed
+
+from corotwine.protocol import _GreenletFactory, _GreenletProtocol
+from corotwine.simulation import SimulatedNetwork, simulateLoad
+
+
+def echo(transport):
+    try:
+        while True:
+            transport.write(transport.read())
+    except ConnectionClosed:
+        pass
+
+
+
+def pingClient(size, count=1):
+    """
+    Return a client function which sends C{size} bytes and reads them back,
+    C{count} times.
+    """
+    def client(transport):
+        for i in range(count):
+            transport.write(b"x" * size)
+            received = 0
+            while received < size:
+                received += len(transport.read())
+    return client
+
+
+
+def drain(transport):
+    try:
+        while True:
+            transport.read()
+    except ConnectionClosed:
+        pass
+
+
+
+class SimulatedNetworkTests(TestCase):
+    """
+    Tests for L{SimulatedNetwork}.
+    """
+
+    def connect(self, network, server, client):
+        """
+        Connect greenlet functions C{server} and C{client} over C{network}.
+
+        @return: The client's L{GreenletProtocol}.
+        """
+        protocol = _GreenletProtocol(client)
+        network.connect(
+            _GreenletFactory(server, clock=network.clock), protocol)
+        return protocol
+
+
+    def test_latency(self):
+        """
+        Data arrives C{latency} seconds after it is written.
+        """
+        network = SimulatedNetwork(latency=0.25)
+        times = []
+        def client(transport):
+            transport.write(b"hello")
+            transport.read()
+            times.append(network.clock.seconds())
+        self.connect(network, echo, client)
+        network.run()
+        self.assertEquals(times, [0.5])
+
+
+    def test_bandwidth(self):
+        """
+        A write takes as long to send as its size divided by the bandwidth.
+        """
+        network = SimulatedNetwork(bandwidth=100)
+        times = []
+        def server(transport):
+            transport.write(b"x" * 200)
+        def client(transport):
+            received = 0
+            while received < 200:
+                received += len(transport.read())
+            times.append(network.clock.seconds())
+        self.connect(network, server, client)
+        network.run()
+        self.assertEquals(times, [2.0])
+
+
+    def test_fragmentSize(self):
+        """
+        Writes are delivered in fragments of at most C{fragmentSize} bytes.
+        """
+        network = SimulatedNetwork(fragmentSize=3)
+        reads = []
+        def server(transport):
+            transport.write(b"abcdefgh")
+        def client(transport):
+            try:
+                while True:
+                    reads.append(transport.read())
+            except ConnectionClosed:
+                pass
+        self.connect(network, server, client)
+        network.run()
+        self.assertEquals(reads, [b"abc", b"def", b"gh"])
+
+
+    def test_until(self):
+        """
+        L{SimulatedNetwork.run} stops when the clock reaches C{until}.
+        """
+        network = SimulatedNetwork(latency=1)
+        self.connect(network, echo, pingClient(1, 10))
+        network.run(until=5)
+        self.assertEquals(network.clock.seconds(), 5)
+        self.assertEquals(len(network.connections), 2)
+        network.run()
+        self.assertEquals(network.clock.seconds(), 21)
+        self.assertEquals(len(network.connections), 0)
+
+
+    def test_slowReaderPausesWriter(self):
+        """
+        A writer whose peer has more than C{bufferSize} bytes unread is paused
+        until the peer catches up.
+        """
+        network = SimulatedNetwork(bandwidth=1000, bufferSize=1000)
+        writes = []
+        def server(transport):
+            for i in range(10):
+                transport.write(b"x" * 500)
+                writes.append(network.clock.seconds())
+        self.connect(network, server, drain)
+        network.run()
+        self.assertEquals(writes[:3], [0, 0, 0])
+        self.assertTrue(writes[-1] >= 4)
+
+
+
+class SimulateLoadTests(TestCase):
+    """
+    Tests for L{simulateLoad}.
+    """
+
+    def test_allComplete(self):
+        """
+        Every client of a server which treats them alike completes, with a
+        fair share of the bytes.
+        """
+        report = simulateLoad(
+            echo, pingClient(100, 5), 200,
+            SimulatedNetwork(latency=0.125, fragmentSize=10))
+        self.assertEquals(report.completed, 200)
+        self.assertEquals(report.errors, [])
+        self.assertEquals(report.serverErrors, [])
+        self.assertEquals(report.bytesToServer, 200 * 500)
+        self.assertEquals(report.bytesToClients, 200 * 500)
+        self.assertEquals(report.clientTimes, [1.25] * 200)
+        self.assertAlmostEquals(report.fairness, 1.0)
+        # And one more trip across the network to close the connections.
+        self.assertEquals(report.elapsed, 1.375)
+
+
+    def test_errors(self):
+        """
+        Exceptions from clients and from the server are collected in the
+        report.
+        """
+        def server(transport):
+            transport.read()
+            1 / 0
+        def client(transport):
+            transport.write(b"x")
+            transport.read()
+        report = simulateLoad(server, client, 3)
+        self.assertEquals(report.completed, 0)
+        self.assertEquals(len(report.errors), 3)
+        self.assertEquals(len(report.serverErrors), 3)
+        report.serverErrors[0].trap(ZeroDivisionError)
+
+
+    def test_slowReaders(self):
+        """
+        Slow readers pause the server's writes to them, take longer, and make
+        the distribution of bytes unfair when the run is cut short.
+        """
+        def server(transport):
+            for i in range(100):
+                transport.write(b"x" * 1000)
+        report = simulateLoad(
+            server, drain, 4,
+            SimulatedNetwork(bandwidth=100000, bufferSize=10000),
+            slowReaders=2, slowReadRate=10000, duration=2)
+        self.assertTrue(report.serverPauses > 0)
+        self.assertEquals(report.clientBytes[2:], [100000, 100000])
+        self.assertTrue(report.clientBytes[0] < 30000)
+        self.assertTrue(report.fairness < 0.8)
+
+
+    def test_listenerOptions(self):
+        """
+        Extra keyword arguments configure the server, as for C{gListenTCP}.
+        """
+        report = simulateLoad(
+            echo, pingClient(10), 10, SimulatedNetwork(latency=0.5),
+            maxConnections=2)
+        self.assertEquals(report.completed, 10)
+        self.assertEquals(sorted(report.clientTimes)[-1], 5.0)
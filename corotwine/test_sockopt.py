@@ -0,0 +1,254 @@
+"""
+Tests for L{corotwine.sockopt} and the socket option methods of
+L{corotwine.protocol.GreenletTransport}.
+"""
+
+import socket
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.abstract import FileDescriptor
+from twisted.internet.error import ConnectionDone
+
+from corotwine.protocol import _GreenletFactory, gListenTCP, gConnectTCP
+from corotwine.defer import deferredGreenlet
+from corotwine.sockopt import SocketOptions
+
+
+class SocketTransport(FileDescriptor):
+    """
+    A transport whose handle is a real, unconnected TCP socket.
+    """
+
+    def __init__(self, family=socket.AF_INET):
+        FileDescriptor.__init__(self)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+
+    def getHandle(self):
+        return self.socket
+
+
+
+class TransportOptionTests(TestCase):
+    """
+    Tests for the socket option methods of L{GreenletTransport}.
+    """
+
+    def connect(self, function, twistedTransport=None, socketOptions=None):
+        """
+        Run C{function} with a L{GreenletTransport} on C{twistedTransport},
+        which defaults to a L{SocketTransport}.
+
+        @return: The Twisted transport.
+        """
+        if twistedTransport is None:
+            twistedTransport = SocketTransport()
+            self.addCleanup(twistedTransport.socket.close)
+        factory = _GreenletFactory(function, socketOptions=socketOptions)
+        factory.buildProtocol(None).makeConnection(twistedTransport)
+        return twistedTransport
+
+
+    def option(self, twistedTransport, level, name):
+        return twistedTransport.socket.getsockopt(
+            level, getattr(socket, name))
+
+
+    def test_noDelay(self):
+        """
+        L{GreenletTransport.setNoDelay} sets C{TCP_NODELAY}.
+        """
+        values = []
+        def handler(transport):
+            transport.setNoDelay()
+            values.append(self.option(
+                twistedTransport, socket.IPPROTO_TCP, "TCP_NODELAY"))
+            transport.setNoDelay(False)
+            values.append(self.option(
+                twistedTransport, socket.IPPROTO_TCP, "TCP_NODELAY"))
+        twistedTransport = SocketTransport()
+        self.addCleanup(twistedTransport.socket.close)
+        self.connect(handler, twistedTransport)
+        self.assertTrue(values[0])
+        self.assertFalse(values[1])
+
+
+    def test_keepAlive(self):
+        """
+        L{GreenletTransport.setKeepAlive} turns on C{SO_KEEPALIVE} and sets
+        the probe timings.
+        """
+        def handler(transport):
+            transport.setKeepAlive(60, 10, 5)
+        twistedTransport = self.connect(handler)
+        self.assertTrue(self.option(
+            twistedTransport, socket.SOL_SOCKET, "SO_KEEPALIVE"))
+        self.assertEquals(self.option(
+            twistedTransport, socket.IPPROTO_TCP, "TCP_KEEPIDLE"), 60)
+        self.assertEquals(self.option(
+            twistedTransport, socket.IPPROTO_TCP, "TCP_KEEPINTVL"), 10)
+        self.assertEquals(self.option(
+            twistedTransport, socket.IPPROTO_TCP, "TCP_KEEPCNT"), 5)
+
+    if not hasattr(socket, "TCP_KEEPIDLE"):
+        test_keepAlive.skip = "This platform has no TCP_KEEPIDLE."
+
+
+    def test_bufferSizes(self):
+        """
+        L{GreenletTransport.setBufferSizes} sets C{SO_SNDBUF} and
+        C{SO_RCVBUF}.
+        """
+        def handler(transport):
+            transport.setBufferSizes(send=32768)
+        twistedTransport = self.connect(handler)
+        receive = self.option(
+            twistedTransport, socket.SOL_SOCKET, "SO_RCVBUF")
+        def handler(transport):
+            transport.setBufferSizes(receive=receive * 2)
+        self.connect(handler, twistedTransport)
+        # Linux doubles the sizes it is given, for its own bookkeeping.
+        self.assertIn(self.option(
+            twistedTransport, socket.SOL_SOCKET, "SO_SNDBUF"),
+            (32768, 65536))
+        self.assertIn(self.option(
+            twistedTransport, socket.SOL_SOCKET, "SO_RCVBUF"),
+            (receive * 2, receive * 4))
+
+
+    def test_cork(self):
+        """
+        L{GreenletTransport.cork} sets C{TCP_CORK} until the outermost
+        context it returns exits.
+        """
+        values = []
+        def corked():
+            values.append(self.option(
+                twistedTransport, socket.IPPROTO_TCP, "TCP_CORK"))
+        def handler(transport):
+            with transport.cork() as corkedTransport:
+                self.assertIdentical(corkedTransport, transport)
+                corked()
+                with transport.cork():
+                    corked()
+                corked()
+            corked()
+        twistedTransport = SocketTransport()
+        self.addCleanup(twistedTransport.socket.close)
+        self.connect(handler, twistedTransport)
+        self.assertEquals(list(map(bool, values)), [True, True, True, False])
+
+    if not hasattr(socket, "TCP_CORK"):
+        test_cork.skip = "This platform has no TCP_CORK."
+
+
+    def test_uncorkWithoutCork(self):
+        """
+        L{GreenletTransport.uncork} does nothing if the connection is not
+        corked.
+        """
+        def handler(transport):
+            transport.uncork()
+            transport.cork()
+            self.assertTrue(self.option(
+                twistedTransport, socket.IPPROTO_TCP, "TCP_CORK"))
+        twistedTransport = SocketTransport()
+        self.addCleanup(twistedTransport.socket.close)
+        self.connect(handler, twistedTransport)
+
+    if not hasattr(socket, "TCP_CORK"):
+        test_uncorkWithoutCork.skip = "This platform has no TCP_CORK."
+
+
+    def test_notTCP(self):
+        """
+        Options are ignored on transports with no socket, and on sockets
+        which are not TCP.
+        """
+        def handler(transport):
+            transport.setNoDelay()
+            transport.setKeepAlive(1, 1, 1)
+            with transport.cork():
+                pass
+        self.connect(handler, FakeTransport(None, True))
+        twistedTransport = SocketTransport(socket.AF_UNIX)
+        self.addCleanup(twistedTransport.socket.close)
+        self.connect(handler, twistedTransport)
+        self.assertFalse(self.option(
+            twistedTransport, socket.SOL_SOCKET, "SO_KEEPALIVE"))
+
+
+    def test_unixBufferSizes(self):
+        """
+        L{GreenletTransport.setBufferSizes} sets C{SO_SNDBUF} on UNIX
+        sockets too.
+        """
+        def handler(transport):
+            transport.setBufferSizes(send=32768)
+        twistedTransport = SocketTransport(socket.AF_UNIX)
+        self.addCleanup(twistedTransport.socket.close)
+        self.connect(handler, twistedTransport)
+        self.assertIn(self.option(
+            twistedTransport, socket.SOL_SOCKET, "SO_SNDBUF"),
+            (32768, 65536))
+
+
+    def test_listenerOptions(self):
+        """
+        A listener's L{SocketOptions} are set on each connection before its
+        handler runs.
+        """
+        values = []
+        def handler(transport):
+            values.append(self.option(
+                twistedTransport, socket.IPPROTO_TCP, "TCP_NODELAY"))
+            values.append(self.option(
+                twistedTransport, socket.SOL_SOCKET, "SO_KEEPALIVE"))
+        twistedTransport = SocketTransport()
+        self.addCleanup(twistedTransport.socket.close)
+        self.connect(handler, twistedTransport,
+                     SocketOptions(noDelay=True, keepAlive=True))
+        self.assertTrue(values[0])
+        self.assertTrue(values[1])
+
+
+
+class TCPOptionTests(TestCase):
+    """
+    Tests for socket options on real TCP connections.
+    """
+
+    def test_options(self):
+        """
+        L{gListenTCP} and L{gConnectTCP} set their C{socketOptions} on their
+        connections.
+        """
+        options = SocketOptions(noDelay=True)
+        serverValues = []
+        def handler(transport):
+            serverValues.append(transport._socket().getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            transport.write(b"done")
+            try:
+                transport.read()
+            except ConnectionDone:
+                pass
+
+        @deferredGreenlet
+        def client():
+            server = gListenTCP(0, handler, socketOptions=options)
+            self.addCleanup(server.stopAccepting)
+            transport = gConnectTCP(
+                "127.0.0.1", server.port.getHost().port,
+                socketOptions=options)
+            value = transport._socket().getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            transport.read()
+            transport.close()
+            return value, serverValues
+        d = client()
+        def check(result):
+            clientValue, serverValues = result
+            self.assertTrue(clientValue)
+            self.assertEquals(list(map(bool, serverValues)), [True])
+        return d.addCallback(check)
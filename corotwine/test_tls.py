@@ -0,0 +1,371 @@
+"""
+Tests for L{corotwine.tls}.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.internet.task import Clock
+
+try:
+    from OpenSSL import SSL, crypto
+except ImportError:
+    SSL = None
+else:
+    import datetime, ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+    from twisted.internet.ssl import (
+        ClientContextFactory, Certificate, optionsForClientTLS)
+    from corotwine.tls import TLSSessionCache, gListenSSL, gConnectSSL
+
+from corotwine.protocol import _GreenletFactory
+from corotwine.defer import deferredGreenlet, blockOn
+
+
+class ServerContextFactory(object):
+    """
+    A context factory with a throwaway self-signed certificate, which returns
+    the same context every time so that its session cache is shared between
+    connections.
+    """
+
+    def __init__(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name(
+            [x509.NameAttribute(NameOID.COMMON_NAME, u"localhost")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = x509.CertificateBuilder(
+            ).subject_name(name
+            ).issuer_name(name
+            ).public_key(key.public_key()
+            ).serial_number(1
+            ).not_valid_before(now - datetime.timedelta(minutes=1)
+            ).not_valid_after(now + datetime.timedelta(hours=1)
+            ).add_extension(
+                x509.SubjectAlternativeName([
+                    x509.DNSName(u"localhost"),
+                    x509.IPAddress(ipaddress.ip_address(u"127.0.0.1"))]),
+                critical=False
+            ).sign(key, hashes.SHA256())
+        self.certificate = crypto.X509.from_cryptography(certificate)
+        self.context = SSL.Context(SSL.SSLv23_METHOD)
+        self.context.use_privatekey(crypto.PKey.from_cryptography_key(key))
+        self.context.use_certificate(self.certificate)
+        self.context.set_session_id(b"corotwine-tests")
+
+
+    def getContext(self):
+        return self.context
+
+
+    def clientOptions(self):
+        """
+        Return client options which trust the certificate, for C{localhost}.
+        """
+        return optionsForClientTLS(
+            u"localhost", trustRoot=Certificate(self.certificate))
+
+
+
+def sessionReused(transport):
+    """
+    Return whether the TLS connection underlying a L{GreenletTransport}
+    resumed a session.
+    """
+    from OpenSSL._util import lib
+    return bool(lib.SSL_session_reused(transport._transport.getHandle()._ssl))
+
+
+
+def closeAndWait(transport):
+    """
+    Close a L{GreenletTransport} and block until the connection is lost.
+    """
+    transport.close()
+    try:
+        transport.read()
+    except ConnectionDone:
+        pass
+
+
+
+class TLSSessionCacheTests(TestCase):
+    """
+    Tests for L{TLSSessionCache}.
+    """
+
+    def test_setAndGet(self):
+        """
+        L{TLSSessionCache.get} returns the session last passed to
+        L{TLSSessionCache.set} for the same key, or C{None}.
+        """
+        cache = TLSSessionCache()
+        cache.set(("example.com", 443), "first", "context")
+        cache.set(("example.com", 443), "second")
+        self.assertEquals(cache.get(("example.com", 443)), "second")
+        self.assertEquals(cache.get(("example.com", 80)), None)
+
+
+    def test_maxSize(self):
+        """
+        L{TLSSessionCache} never remembers more than C{maxSize} sessions.
+        """
+        cache = TLSSessionCache(maxSize=2)
+        for port in range(5):
+            cache.set(("example.com", port), port)
+        self.assertEquals(len(cache._sessions), 2)
+        self.assertEquals(cache.get(("example.com", 4)), 4)
+
+
+    def test_forget(self):
+        """
+        L{TLSSessionCache.forget} removes a remembered session.
+        """
+        cache = TLSSessionCache()
+        cache.set("key", "session")
+        cache.forget("key")
+        cache.forget("key")
+        self.assertEquals(cache.get("key"), None)
+
+
+
+class TLSTests(TestCase):
+    """
+    Tests for L{gListenSSL} and L{gConnectSSL} over real connections.
+    """
+
+    def setUp(self):
+        self.serverContextFactory = ServerContextFactory()
+
+
+    def listen(self, function):
+        """
+        Start a TLS server on an arbitrary port running C{function} for each
+        connection.
+
+        @return: The port number.
+        """
+        from twisted.internet import reactor
+        server = gListenSSL(0, function, self.serverContextFactory,
+                            reactor=reactor)
+        self.addCleanup(server.stopAccepting)
+        return server.port.getHost().port
+
+
+    def test_echo(self):
+        """
+        Data written by a L{gConnectSSL} client is received by the
+        L{gListenSSL} server function and vice versa.
+        """
+        closed = Deferred()
+        def echo(transport):
+            transport.write(transport.read())
+            try:
+                transport.read()
+            except ConnectionDone:
+                closed.callback(None)
+        portNumber = self.listen(echo)
+
+        @deferredGreenlet
+        def client():
+            from corotwine.defer import blockOn
+            transport = gConnectSSL(
+                "127.0.0.1", portNumber,
+                self.serverContextFactory.clientOptions(), TLSSessionCache())
+            transport.write(b"hello")
+            result = transport.read()
+            closeAndWait(transport)
+            blockOn(closed)
+            return result
+        d = client()
+        d.addCallback(self.assertEquals, b"hello")
+        return d
+
+
+    def test_sessionResumption(self):
+        """
+        A second connection to the same server resumes the session negotiated
+        by the first.
+        """
+        closed = []
+        def echo(transport):
+            transport.write(transport.read())
+            try:
+                transport.read()
+            except ConnectionDone:
+                closed.pop(0).callback(None)
+        portNumber = self.listen(echo)
+        cache = TLSSessionCache()
+        contextFactory = ClientContextFactory()
+
+        @deferredGreenlet
+        def client():
+            from corotwine.defer import blockOn
+            reused = []
+            for i in range(2):
+                done = Deferred()
+                closed.append(done)
+                transport = gConnectSSL("127.0.0.1", portNumber,
+                                        contextFactory, cache)
+                transport.write(b"hello")
+                transport.read()
+                reused.append(sessionReused(transport))
+                closeAndWait(transport)
+                blockOn(done)
+            return reused
+        d = client()
+        d.addCallback(self.assertEquals, [False, True])
+        return d
+
+
+    def test_sessionResumptionWithOptions(self):
+        """
+        Sessions are resumed on connections made with the same client
+        options.
+        """
+        closed = []
+        def echo(transport):
+            transport.write(transport.read())
+            try:
+                transport.read()
+            except ConnectionDone:
+                closed.pop(0).callback(None)
+        portNumber = self.listen(echo)
+        cache = TLSSessionCache()
+        options = self.serverContextFactory.clientOptions()
+
+        @deferredGreenlet
+        def client():
+            reused = []
+            for i in range(2):
+                done = Deferred()
+                closed.append(done)
+                transport = gConnectSSL("127.0.0.1", portNumber, options,
+                                        cache)
+                transport.write(b"hello")
+                transport.read()
+                reused.append(sessionReused(transport))
+                closeAndWait(transport)
+                blockOn(done)
+            return reused
+        d = client()
+        d.addCallback(self.assertEquals, [False, True])
+        return d
+
+
+    def test_sessionThroughPublicAPI(self):
+        """
+        A session read with L{TLSSessionCache.get} and remembered again with
+        L{TLSSessionCache.set}, without its context, is still resumed, and a
+        session which can't be resumed on a connection's context just means
+        a full handshake.
+        """
+        closed = []
+        def echo(transport):
+            transport.write(transport.read())
+            try:
+                transport.read()
+            except ConnectionDone:
+                closed.pop(0).callback(None)
+        portNumber = self.listen(echo)
+        cache = TLSSessionCache()
+        options = self.serverContextFactory.clientOptions()
+        key = ("127.0.0.1", portNumber)
+
+        @deferredGreenlet
+        def client():
+            reused = []
+            for contextFactory in [options, options,
+                                   self.serverContextFactory.clientOptions()]:
+                done = Deferred()
+                closed.append(done)
+                transport = gConnectSSL("127.0.0.1", portNumber,
+                                        contextFactory, cache)
+                transport.write(b"hello")
+                transport.read()
+                reused.append(sessionReused(transport))
+                closeAndWait(transport)
+                blockOn(done)
+                session = cache.get(key)
+                self.assertIsInstance(session, SSL.Session)
+                cache.set(key, session)
+            return reused
+        d = client()
+        d.addCallback(self.assertEquals, [False, True, False])
+        return d
+
+
+    def test_verifiesByDefault(self):
+        """
+        By default, the client refuses a server whose certificate it doesn't
+        trust.
+        """
+        def handler(transport):
+            try:
+                transport.read()
+            except Exception:
+                pass
+        portNumber = self.listen(handler)
+
+        @deferredGreenlet
+        def client():
+            transport = gConnectSSL("127.0.0.1", portNumber,
+                                    sessionCache=TLSSessionCache())
+            transport.write(b"hello")
+            transport.read()
+        return self.assertFailure(client(), SSL.Error)
+
+
+    def test_connectionRefused(self):
+        """
+        If the connection can't be made, L{gConnectSSL} raises the error.
+        """
+        from twisted.internet import reactor
+        from twisted.internet.protocol import Factory
+        port = reactor.listenTCP(0, Factory())
+        portNumber = port.getHost().port
+
+        @deferredGreenlet
+        def client():
+            blockOn(port.stopListening())
+            gConnectSSL("127.0.0.1", portNumber)
+        return self.assertFailure(client(), ConnectionRefusedError)
+
+
+    def test_backpressure(self):
+        """
+        Writes block while the TLS layer has paused the connection and continue
+        when it resumes.  The TLS layer pauses a server connection when data
+        written before the handshake is complete reaches it, which happens
+        once the writes it has gathered up are flushed.
+        """
+        written = []
+        gate = Deferred()
+        def writeTwice(transport):
+            transport.write(b"lot")
+            written.append("lot")
+            blockOn(gate)
+            transport.write(b"of data")
+            written.append("of data")
+        from twisted.protocols.tls import TLSMemoryBIOFactory
+        clock = Clock()
+        factory = TLSMemoryBIOFactory(
+            self.serverContextFactory, False,
+            _GreenletFactory(writeTwice, clock=clock), clock)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(protocol, True)
+        protocol.makeConnection(twistedTransport)
+        clock.advance(1)
+        gate.callback(None)
+        self.assertEquals(written, ["lot"])
+        twistedTransport.producer.resumeProducing()
+        self.assertEquals(written, ["lot", "of data"])
+
+
+
+if SSL is None:
+    TLSSessionCacheTests.skip = TLSTests.skip = "pyOpenSSL is not installed"
@@ -0,0 +1,239 @@
+"""
+Tests for L{corotwine.tracing}.
+"""
+
+import json, os, signal
+from io import StringIO
+
+from twisted.trial.unittest import TestCase
+from twisted.test.iosim import FakeTransport
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+
+from corotwine.tracing import Tracer, installSignalHandler
+from corotwine.protocol import _GreenletFactory
+from corotwine.defer import blockOn, deferredGreenlet
+from corotwine.clock import wait
+from corotwine import greenlet
+
+
+class TracerTests(TestCase):
+    """
+    Tests for L{Tracer}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.tracer = Tracer(seconds=self.clock.seconds)
+        self.addCleanup(self.tracer.stop)
+
+
+    def spans(self, category=None):
+        """
+        Return C{(name, tid, start, duration)} for each complete event, in
+        microseconds, optionally only those in C{category}.
+        """
+        return [(event["name"], event["tid"], event["ts"], event["dur"])
+                for event in self.tracer.events()
+                if event["ph"] == "X"
+                and category in (None, event["cat"])]
+
+
+    def names(self):
+        """
+        Return a C{dict} mapping greenlet numbers to their labels.
+        """
+        return dict([(event["tid"], event["args"]["name"])
+                     for event in self.tracer.events() if event["ph"] == "M"])
+
+
+    def test_blocked(self):
+        """
+        Each time a greenlet runs, and each time it waits, and what for, is
+        recorded.
+        """
+        d = Deferred()
+        def waiter():
+            self.clock.advance(1)
+            blockOn(d)
+            self.clock.advance(2)
+            wait(3, self.clock)
+        self.tracer.start()
+        greenlet(waiter).switch()
+        self.clock.advance(4)
+        d.callback(None)
+        self.clock.advance(3)
+        self.tracer.stop()
+        names = self.names()
+        reactor = [tid for tid in names if names[tid] == "reactor"][0]
+        waiterID = [tid for tid in names if names[tid] == "waiter"][0]
+        self.assertEquals(
+            [span for span in self.spans() if span[1] == waiterID],
+            [("run", waiterID, 0, 1e6),
+             ("blockOn", waiterID, 1e6, 4e6),
+             ("run", waiterID, 5e6, 2e6),
+             ("wait", waiterID, 7e6, 3e6),
+             ("run", waiterID, 10e6, 0)])
+        self.assertEquals(
+            [span[0] for span in self.spans("run") if span[1] == reactor],
+            ["run", "run"])
+        self.assertEquals(
+            [span for span in self.spans("blocked") if span[1] == reactor],
+            [])
+
+
+    def test_handlerLabel(self):
+        """
+        A connection handler's greenlet is labelled with the handler
+        function and the connection's peer.
+        """
+        def echo(transport):
+            transport.write(transport.read())
+        factory = _GreenletFactory(echo, clock=self.clock)
+        protocol = factory.buildProtocol(None)
+        twistedTransport = FakeTransport(
+            protocol, True, peerAddress=IPv4Address("TCP", "10.0.0.1", 1234))
+        self.tracer.start()
+        protocol.makeConnection(twistedTransport)
+        protocol.dataReceived(b"hello")
+        self.tracer.stop()
+        self.assertIn("corotwine.test_tracing.TracerTests.test_handlerLabel."
+                      "<locals>.echo 10.0.0.1:1234", self.names().values())
+        self.assertEquals([span[0] for span in self.spans("blocked")],
+                          ["read"])
+
+
+    def test_deferredGreenletLabel(self):
+        """
+        A greenlet started by L{deferredGreenlet} is labelled with the
+        function it runs.
+        """
+        d = Deferred()
+        @deferredGreenlet
+        def fetch():
+            return blockOn(d)
+        self.tracer.start()
+        fetch()
+        d.callback(None)
+        self.tracer.stop()
+        self.assertIn("corotwine.test_tracing.TracerTests."
+                      "test_deferredGreenletLabel.<locals>.fetch",
+                      self.names().values())
+
+
+    def test_ringBuffer(self):
+        """
+        Only the last C{size} switches are kept.
+        """
+        tracer = Tracer(size=4)
+        def switcher():
+            for i in range(5):
+                greenlet.getcurrent().parent.switch()
+        g = greenlet(switcher)
+        tracer.start()
+        for i in range(5):
+            g.switch()
+        tracer.stop()
+        self.assertEquals(len(tracer._events), 4)
+        self.assertEquals(tracer.recorded, 10)
+
+
+    def test_labelsBounded(self):
+        """
+        The labels of greenlets which are no longer in the ring buffer are
+        forgotten, so they don't accumulate while tracing runs for a long
+        time.
+        """
+        tracer = Tracer(size=4)
+        def switcher():
+            greenlet.getcurrent().parent.switch()
+        tracer.start()
+        for i in range(100):
+            g = greenlet(switcher)
+            g.switch()
+            g.switch()
+        tracer.stop()
+        self.assertTrue(len(tracer._labels) <= 8, tracer._labels)
+        for when, origin, target, blocked in tracer._events:
+            if origin != tracer._id(greenlet.getcurrent()):
+                self.assertIn(origin, tracer._labels)
+
+
+    def test_duration(self):
+        """
+        Given a duration, L{Tracer.start} stops tracing after that many
+        seconds.
+        """
+        self.tracer.start(duration=5, clock=self.clock)
+        self.assertTrue(self.tracer.tracing)
+        self.clock.advance(5)
+        self.assertFalse(self.tracer.tracing)
+        greenlet(lambda: None).switch()
+        self.assertEquals(self.tracer.recorded, 0)
+
+
+    def test_previousTraceFunction(self):
+        """
+        A trace function installed before tracing starts is still called,
+        and is put back when it stops.
+        """
+        calls = []
+        def previous(event, args):
+            calls.append(event)
+        greenlet.settrace(previous)
+        self.addCleanup(greenlet.settrace, None)
+        self.tracer.start()
+        greenlet(lambda: None).switch()
+        self.tracer.stop()
+        self.assertEquals(calls, ["switch", "switch"])
+        self.assertIdentical(greenlet.settrace(None), previous)
+
+
+    def test_dump(self):
+        """
+        L{Tracer.dump} writes a Chrome trace JSON object.
+        """
+        self.tracer.start()
+        greenlet(lambda: None).switch()
+        self.tracer.stop()
+        output = StringIO()
+        self.tracer.dump(output)
+        trace = json.loads(output.getvalue())
+        self.assertEquals(trace["traceEvents"], self.tracer.events())
+        self.assertEquals(trace["otherData"],
+                          {"recorded": 2, "dropped": 0})
+
+
+
+class SignalTests(TestCase):
+    """
+    Tests for L{installSignalHandler}.
+    """
+
+    def test_signal(self):
+        """
+        When the signal arrives, tracing starts, and after the duration the
+        trace is written to the file.
+        """
+        class Reactor(Clock):
+            def callFromThread(self, f, *args):
+                self.callLater(0, f, *args)
+        reactor = Reactor()
+        reactor.advance(100)
+        path = self.mktemp()
+        self.addCleanup(signal.signal, signal.SIGUSR2,
+                        signal.getsignal(signal.SIGUSR2))
+        tracer = installSignalHandler(path + "-%(time)d", 5,
+                                      reactor=reactor)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        reactor.advance(0)
+        self.assertTrue(tracer.tracing)
+        greenlet(lambda: None).switch()
+        reactor.advance(5)
+        self.assertFalse(tracer.tracing)
+        [name] = [name for name in os.listdir(os.path.dirname(path))
+                  if name.startswith(os.path.basename(path))]
+        with open(os.path.join(os.path.dirname(path), name)) as output:
+            trace = json.load(output)
+        self.assertEquals(trace["otherData"]["recorded"], 2)
@@ -0,0 +1,327 @@
+"""
+TLS support for greenlets on Twisted.
+
+L{gListenSSL} and L{gConnectSSL} are like
+L{corotwine.protocol.gListenTCP} and L{corotwine.protocol.gConnectTCP}, but
+the connection is encrypted with Twisted's TLS memory BIO layer,
+L{twisted.protocols.tls}.  The greenlet function still gets a plain
+L{corotwine.protocol.GreenletTransport}.
+
+Clients check the server's certificate and host name by default, as
+L{twisted.internet.ssl.optionsForClientTLS} does.
+
+pyOpenSSL is required to use this module, and service_identity to check
+host names.
+"""
+
+from zope.interface import implementer
+
+from OpenSSL import SSL
+
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.protocols.tls import TLSMemoryBIOFactory
+
+from corotwine.protocol import (
+    MAIN, GreenletServer, _GreenletFactory, _GreenletClientProtocol,
+    _GreenletClientFactory)
+from corotwine import greenlet
+
+
+__all__ = ["TLSSessionCache", "gListenSSL", "gConnectSSL"]
+
+
+class TLSSessionCache(object):
+    """
+    A cache of client TLS sessions, keyed by the address of the server they
+    were negotiated with.
+
+    A client connection which finds a session here offers it to the server,
+    which may then resume it with an abbreviated handshake instead of doing
+    the expensive public key operations of a full one.  Both session IDs and
+    session tickets are resumed this way.
+
+    OpenSSL only resumes a session on a connection made from the same
+    L{OpenSSL.SSL.Context} as the one it was negotiated on, so each session
+    is remembered along with its context, and only offered to connections
+    from that context.  The cache also keeps the connection creators that
+    L{gConnectSSL} makes connections with, one per client configuration, so
+    that the connections to a server share a context.
+
+    @ivar maxSize: The maximum number of sessions, and of connection
+        creators, to remember.  When a new one is added to a full cache, an
+        arbitrary one is forgotten.
+    @ivar _sessions: A C{dict} mapping server addresses to
+        C{(context, session)}, where C{context} is the
+        L{OpenSSL.SSL.Context} the L{OpenSSL.SSL.Session} was negotiated on,
+        or C{None} if it is not known.
+    @ivar _creators: A C{dict} mapping client configurations to the
+        L{IOpenSSLClientConnectionCreator}s made for them.
+    """
+
+    def __init__(self, maxSize=1024):
+        """
+        @param maxSize: See L{maxSize}.
+        @type maxSize: C{int}
+        """
+        self.maxSize = maxSize
+        self._sessions = {}
+        self._creators = {}
+
+
+    def get(self, key):
+        """
+        Return the session remembered for C{key}, or C{None}.
+        """
+        return self._get(key)[1]
+
+
+    def _get(self, key):
+        """
+        Return C{(context, session)} for C{key}, or C{(None, None)}.
+        """
+        return self._sessions.get(key, (None, None))
+
+
+    def set(self, key, session, context=None):
+        """
+        Remember C{session} for C{key}.
+
+        @param context: The L{OpenSSL.SSL.Context} C{session} was negotiated
+            on, or C{None} to offer it to any connection.  A connection from
+            a different context can't resume it, and does a full handshake.
+        """
+        if key not in self._sessions and len(self._sessions) >= self.maxSize:
+            self._sessions.popitem()
+        self._sessions[key] = (context, session)
+
+
+    def forget(self, key):
+        """
+        Forget the session remembered for C{key}, if any.
+        """
+        self._sessions.pop(key, None)
+
+
+    def _creator(self, key, make):
+        """
+        Return the connection creator remembered for C{key}, calling C{make}
+        to make one if there isn't one.
+        """
+        creator = self._creators.get(key)
+        if creator is None:
+            if len(self._creators) >= self.maxSize:
+                self._creators.popitem()
+            creator = self._creators[key] = make()
+        return creator
+
+
+
+defaultSessionCache = TLSSessionCache()
+
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _OneContext(object):
+    """
+    A connection creator which makes every connection from the one context
+    returned by a L{twisted.internet.ssl.ContextFactory}, where
+    L{TLSMemoryBIOFactory} would ask it for a new context each time, so that
+    sessions can be resumed.
+    """
+
+    def __init__(self, contextFactory):
+        self._context = contextFactory.getContext()
+
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        return SSL.Connection(self._context, None)
+
+
+
+class _TLSClientProtocol(_GreenletClientProtocol):
+    """
+    A L{_GreenletClientProtocol} which runs over a TLS connection and resumes
+    sessions from a L{TLSSessionCache}.
+
+    @ivar _sessionCache: The L{TLSSessionCache} to use.
+    @ivar _sessionKey: The key under which the session is cached.
+    """
+
+    def __init__(self, deferred, greenlet, sessionCache, sessionKey,
+                 socketOptions=None):
+        """
+        @param sessionCache: See L{_sessionCache}.
+        @param sessionKey: See L{_sessionKey}.
+        """
+        _GreenletClientProtocol.__init__(
+            self, deferred, greenlet, socketOptions)
+        self._sessionCache = sessionCache
+        self._sessionKey = sessionKey
+
+
+    def connectionMade(self):
+        """
+        Offer any cached session negotiated on this connection's context to
+        the server, then hand the connection to the waiting greenlet.
+
+        The TLS layer connects us before it starts the handshake, so this is
+        the last point at which the session can be set.
+        """
+        handle = self.transport.getHandle()
+        context, session = self._sessionCache._get(self._sessionKey)
+        if session is not None and (
+                context is None or context is handle.get_context()):
+            try:
+                handle.set_session(session)
+            except ValueError:
+                # It was negotiated on another context after all.
+                pass
+        _GreenletClientProtocol.connectionMade(self)
+
+
+    def connectionLost(self, reason):
+        """
+        Remember the connection's session for the next connection to the same
+        server.
+
+        This is done at the end of the connection rather than after the
+        handshake, since TLS 1.3 servers send their session tickets after the
+        handshake is complete.
+        """
+        handle = self.transport.getHandle()
+        session = handle.get_session()
+        if session is not None:
+            self._sessionCache.set(
+                self._sessionKey, session, handle.get_context())
+        _GreenletClientProtocol.connectionLost(self, reason)
+
+
+
+class _TLSClientFactory(_GreenletClientFactory):
+    """
+    A factory for one L{_TLSClientProtocol}, which reports a failure to
+    connect.
+    """
+
+    def __init__(self, deferred, greenlet, sessionCache, sessionKey,
+                 socketOptions=None):
+        """
+        @param sessionCache: See L{_TLSClientProtocol}.
+        @param sessionKey: See L{_TLSClientProtocol}.
+        """
+        _GreenletClientFactory.__init__(
+            self, deferred, greenlet, socketOptions)
+        self._sessionCache = sessionCache
+        self._sessionKey = sessionKey
+
+
+    def buildProtocol(self, addr):
+        return _TLSClientProtocol(
+            self._deferred, self._greenlet, self._sessionCache,
+            self._sessionKey, self._socketOptions)
+
+
+
+def gListenSSL(port, function, contextFactory, reactor=None,
+               idleTimeout=None, maxConnections=None, readLimit=None,
+               writeLimit=None, acceptLimit=None, socketOptions=None,
+               memoryBudget=None, admissionPolicy=None):
+    """
+    Listen for TLS connections and handle them with the given greenlet
+    function, as per L{corotwine.protocol.gListenTCP}.
+
+    Servers resume sessions from the session cache of the L{SSL.Context}
+    returned by C{contextFactory}, so C{contextFactory} should return the
+    same context every time, as
+    L{twisted.internet.ssl.DefaultOpenSSLContextFactory} does.
+
+    @param port: The port number to listen on.
+    @type port: C{int}
+    @param function: The greenlet function to call for each incoming
+        connection.
+    @type function: Callable of one argument, L{GreenletTransport}
+    @param contextFactory: The server's TLS configuration.
+    @type contextFactory: L{twisted.internet.ssl.ContextFactory}
+    @param idleTimeout: See L{corotwine.protocol.gListenTCP}.
+    @param maxConnections: See L{corotwine.protocol.gListenTCP}.
+    @param readLimit: See L{corotwine.protocol.gListenTCP}.
+    @param writeLimit: See L{corotwine.protocol.gListenTCP}.
+    @param acceptLimit: See L{corotwine.protocol.gListenTCP}.
+    @param socketOptions: See L{corotwine.protocol.gListenTCP}.
+    @param memoryBudget: See L{corotwine.protocol.gListenTCP}.
+    @param admissionPolicy: See L{corotwine.protocol.gListenTCP}.
+
+    @return: A handle on the server, with which it can be shut down.
+    @rtype: L{corotwine.protocol.GreenletServer}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    factory = _GreenletFactory(function, idleTimeout, reactor, maxConnections,
+                               readLimit, writeLimit, acceptLimit,
+                               socketOptions, memoryBudget, admissionPolicy)
+    port = reactor.listenTCP(
+        port, TLSMemoryBIOFactory(contextFactory, False, factory))
+    return GreenletServer(port, factory)
+
+
+
+def gConnectSSL(host, port, contextFactory=None, sessionCache=None,
+                reactor=None, socketOptions=None, resolver=None):
+    """
+    Return a L{GreenletTransport} connected with TLS to the given host and
+    port.
+
+    If a session from an earlier connection to the same host and port is in
+    C{sessionCache}, it will be offered to the server for resumption.
+
+    This function must NOT be called from the reactor's greenlet.
+
+    @param contextFactory: The client's TLS configuration.  Defaults to
+        L{twisted.internet.ssl.optionsForClientTLS} for C{host}, which checks
+        that the server's certificate is trusted by the platform and is for
+        C{host}.
+    @type contextFactory: L{IOpenSSLClientConnectionCreator} or
+        L{twisted.internet.ssl.ContextFactory}
+    @param sessionCache: Where to find and remember sessions.  Defaults to
+        L{defaultSessionCache}.
+    @type sessionCache: L{TLSSessionCache}
+    @param socketOptions: See L{corotwine.protocol.gConnectTCP}.
+    @param resolver: See L{corotwine.protocol.gConnectTCP}.
+
+    @raise DNSLookupError: If C{host} could not be resolved.
+    @raise ConnectError: If the connection could not be made.
+    """
+    from corotwine.defer import blockOn
+    current = greenlet.getcurrent()
+    assert current is not MAIN, \
+        "Don't run gConnectSSL from the reactor greenlet."
+    if reactor is None:
+        from twisted.internet import reactor
+    if resolver is None:
+        from corotwine.resolver import defaultResolver as resolver
+    if sessionCache is None:
+        sessionCache = defaultSessionCache
+    if contextFactory is None:
+        from twisted.internet.ssl import optionsForClientTLS
+        contextFactory = sessionCache._creator(
+            (optionsForClientTLS, host), lambda: optionsForClientTLS(host))
+    elif not IOpenSSLClientConnectionCreator.providedBy(contextFactory):
+        contextFactory = sessionCache._creator(
+            contextFactory, lambda: _OneContext(contextFactory))
+    abandoned = []
+    def connected(transport):
+        if abandoned:
+            transport.close()
+        return transport
+    connecting = resolver.connectTCP(
+        reactor, host, port,
+        lambda d: TLSMemoryBIOFactory(
+            contextFactory, True,
+            _TLSClientFactory(d, current, sessionCache, (host, port),
+                              socketOptions)))
+    connecting.addCallback(connected)
+    try:
+        return blockOn(connecting)
+    except:
+        abandoned.append(True)
+        raise
@@ -0,0 +1,327 @@
+"""
+A timeline of greenlet switches, in the Chrome trace event format.
+
+A L{Tracer} records every greenlet switch into a fixed-size ring buffer,
+along with what the greenlet switching away was blocked on: C{read},
+C{write}, C{blockOn}, C{wait}, and so on.  Dump it as JSON, and load it into
+C{chrome://tracing} or Perfetto (U{https://ui.perfetto.dev}) to see, one row
+per greenlet, when each ran and what it was waiting for in between::
+
+    tracer = Tracer()
+    tracer.start(duration=10)
+    ...
+    tracer.dump(open("trace.json", "w"))
+
+Each greenlet which handles a connection is labelled with its handler
+function and the connection's peer; the reactor's greenlet is labelled
+C{reactor}, and greenlets started by L{corotwine.defer.deferredGreenlet}
+with the function they run.
+
+To trace a running process for a while without restarting it, install a
+signal handler at startup::
+
+    installSignalHandler("/tmp/trace-%(time)d.json", duration=5)
+
+and send the process C{SIGUSR2} when something is slow.
+
+Tracing is off until L{Tracer.start} is called, and costs nothing then.
+While it is on, each switch costs a function call and a few dictionary
+lookups.
+"""
+
+import json, os, time
+from collections import deque
+from weakref import WeakKeyDictionary
+
+from corotwine import greenlet, MAIN
+from corotwine.memory import _handlerName
+
+
+__all__ = ["Tracer", "installSignalHandler"]
+
+
+def _code(function):
+    """
+    Return the code object of a function or method.
+    """
+    return getattr(function, "__func__", function).__code__
+
+
+
+def _blockingCodes():
+    """
+    Return a C{dict} mapping the code objects of the functions in which
+    greenlets block to names for what they are blocked on.
+    """
+    from corotwine.protocol import GreenletTransport
+    from corotwine.defer import blockOn
+    from corotwine.clock import wait
+    from corotwine.queue import Queue
+    from corotwine.ratelimit import TokenBucket
+    from corotwine.select import select
+    return {
+        _code(GreenletTransport._receive): "read",
+        _code(GreenletTransport.write): "write",
+        _code(GreenletTransport.drain): "write",
+        _code(blockOn): "blockOn",
+        _code(wait): "wait",
+        _code(Queue.get): "queue.get",
+        _code(Queue.put): "queue.put",
+        _code(TokenBucket.consume): "rateLimit",
+        _code(select): "select",
+    }
+
+
+
+def _label(g):
+    """
+    Return a label for a greenlet which has started and not finished, from
+    the function at the bottom of its stack.
+    """
+    frame = g.gr_frame
+    bottom = None
+    while frame is not None:
+        bottom, frame = frame, frame.f_back
+    if bottom is None:
+        return "greenlet"
+    code = bottom.f_code
+    local = bottom.f_locals
+    if code.co_name == "_runAndDisconnect" and "self" in local:
+        protocol = local["self"]
+        label = _handlerName(protocol.function)
+        try:
+            peer = protocol.transport.getPeer()
+        except Exception:
+            return label
+        host = getattr(peer, "host", None)
+        if host is None:
+            return "%s %s" % (label, peer)
+        return "%s %s:%s" % (label, host, getattr(peer, "port", ""))
+    if code.co_name == "intermediateGreenletFunction" and "gfunction" in local:
+        return _handlerName(local["gfunction"])
+    return code.co_name
+
+
+
+class Tracer(object):
+    """
+    A recorder of greenlet switches.
+
+    @ivar size: The most switches remembered.  Older ones are forgotten.
+    @ivar seconds: A function returning the current time in seconds.
+    @ivar recorded: The number of switches recorded since the tracer was
+        made, including those which have been forgotten.
+    @ivar tracing: Whether switches are being recorded.
+    @ivar _events: A C{deque} of C{(time, origin, target, blocked)}, where
+        C{origin} and C{target} are the numbers of the greenlets switched
+        from and to, and C{blocked} is what the origin is blocked on, or
+        C{None}.
+    @ivar _ids: A L{WeakKeyDictionary} mapping greenlets to their numbers.
+    @ivar _lastID: The last number given to a greenlet.
+    @ivar _labels: A C{dict} mapping greenlet numbers to labels.  Those of
+        greenlets which no remembered switch involves are forgotten once
+        there are more than twice L{size} of them.
+    @ivar _blocking: See L{_blockingCodes}.
+    @ivar _previous: The greenlet trace function which was installed before
+        L{start}, or C{None}.
+    @ivar _call: The delayed call which will stop tracing, or C{None}.
+    """
+
+    def __init__(self, size=65536, seconds=time.time):
+        self.size = size
+        self.seconds = seconds
+        self.recorded = 0
+        self.tracing = False
+        self._events = deque(maxlen=size)
+        self._ids = WeakKeyDictionary()
+        self._lastID = 0
+        self._labels = {}
+        self._blocking = None
+        self._previous = None
+        self._call = None
+
+
+    def start(self, duration=None, clock=None):
+        """
+        Start recording switches.
+
+        @param duration: The number of seconds after which to stop, or
+            C{None} to record until L{stop} is called.
+        @param clock: The L{twisted.internet.interfaces.IReactorTime}
+            provider to schedule the stop with.  Defaults to the reactor.
+        """
+        if self.tracing:
+            return
+        if self._blocking is None:
+            self._blocking = _blockingCodes()
+        self.tracing = True
+        self._labels[self._id(MAIN)] = "reactor"
+        self._previous = greenlet.settrace(self._trace)
+        if duration is not None:
+            if clock is None:
+                from twisted.internet import reactor as clock
+            self._call = clock.callLater(duration, self.stop)
+
+
+    def stop(self):
+        """
+        Stop recording switches.  What has been recorded is kept.
+        """
+        if not self.tracing:
+            return
+        self.tracing = False
+        greenlet.settrace(self._previous)
+        self._previous = None
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+
+    def clear(self):
+        """
+        Forget the switches recorded.
+        """
+        self._events.clear()
+        self._labels.clear()
+
+
+    def _id(self, g):
+        """
+        Return the number of a greenlet, giving it one if it has none.
+        """
+        number = self._ids.get(g)
+        if number is None:
+            self._lastID += 1
+            number = self._ids[g] = self._lastID
+        return number
+
+
+    def _trace(self, event, args):
+        """
+        Record a switch.  This is the greenlet trace function, called in the
+        target greenlet after it has been switched to.  The reactor's
+        greenlet isn't counted as blocked when it switches to another.
+        """
+        if self._previous is not None:
+            self._previous(event, args)
+        origin, target = args
+        originID = self._id(origin)
+        blocked = None
+        frame = origin.gr_frame
+        if frame is not None and origin is not MAIN:
+            if originID not in self._labels:
+                if len(self._labels) >= 2 * self.size:
+                    self._forgetLabels()
+                self._labels[originID] = _label(origin)
+            blocked = self._blocking.get(frame.f_code)
+            if blocked is None:
+                blocked = frame.f_code.co_name
+        self.recorded += 1
+        self._events.append(
+            (self.seconds(), originID, self._id(target), blocked))
+
+
+    def _forgetLabels(self):
+        """
+        Forget the labels of greenlets which no remembered switch involves,
+        except the reactor's.
+        """
+        keep = set([self._id(MAIN)])
+        for when, origin, target, blocked in self._events:
+            keep.add(origin)
+            keep.add(target)
+        self._labels = dict((number, label)
+                            for (number, label) in self._labels.items()
+                            if number in keep)
+
+
+    def events(self):
+        """
+        Return the recorded switches as Chrome trace events: a complete
+        ("X") event named C{run} for each time a greenlet ran, and one named
+        for what it was blocked on, in the C{blocked} category, for each
+        time it waited; and a C{thread_name} metadata event labelling each
+        greenlet.
+
+        @rtype: C{list} of C{dict}
+        """
+        pid = os.getpid()
+        result = []
+        running = {}
+        blocked = {}
+        def span(name, tid, start, end, category):
+            result.append({
+                "name": name, "cat": category, "ph": "X", "pid": pid,
+                "tid": tid, "ts": start * 1e6, "dur": (end - start) * 1e6,
+                "args": {"greenlet": self._labels.get(tid, str(tid))}})
+        for when, origin, target, reason in self._events:
+            start = running.pop(origin, None)
+            if start is not None:
+                span("run", origin, start, when, "run")
+            if reason is not None:
+                blocked[origin] = (when, reason)
+            waiting = blocked.pop(target, None)
+            if waiting is not None:
+                span(waiting[1], target, waiting[0], when, "blocked")
+            running[target] = when
+        for tid in sorted(set([event["tid"] for event in result])):
+            result.append({
+                "name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": self._labels.get(tid, "greenlet %d" % tid)}})
+        return result
+
+
+    def dump(self, output):
+        """
+        Write the recorded switches, as a Chrome trace JSON object, to a
+        file.
+        """
+        json.dump({"traceEvents": self.events(),
+                   "displayTimeUnit": "ms",
+                   "otherData": {"recorded": self.recorded,
+                                 "dropped": self.recorded - len(
+                                     self._events)}},
+                  output)
+
+
+
+def installSignalHandler(path, duration=10, signum=None, size=65536,
+                         reactor=None):
+    """
+    Trace for C{duration} seconds whenever the process gets a signal, and
+    then dump the trace to a file.
+
+    @param path: The name of the file, which may contain C{%(time)d} and
+        C{%(pid)d} to be replaced with the time the trace started and the
+        process ID.
+    @param signum: The signal.  Defaults to C{SIGUSR2}.
+    @param size: See L{Tracer.size}.
+    @param reactor: The reactor to trace in.  Defaults to the global one.
+
+    @return: The L{Tracer}.
+    """
+    import signal
+    if signum is None:
+        signum = signal.SIGUSR2
+    if reactor is None:
+        from twisted.internet import reactor
+    tracer = Tracer(size)
+
+    def finish():
+        tracer.stop()
+        name = path % {"time": started[0], "pid": os.getpid()}
+        with open(name, "w") as output:
+            tracer.dump(output)
+        tracer.clear()
+
+    started = [0]
+    def begin():
+        if tracer.tracing:
+            return
+        started[0] = int(time.time())
+        tracer.start()
+        reactor.callLater(duration, finish)
+
+    signal.signal(signum, lambda *args: reactor.callFromThread(begin))
+    return tracer
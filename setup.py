@@ -1,18 +1,6 @@
 #!/usr/bin/env python
 
-import os, sys
-
-from distutils.core import setup
-
-
-def find_packages():
-    # implement a simple find_packages so we don't have to depend on
-    # setuptools
-    packages = []
-    for directory, subdirectories, files in os.walk("corotwine"):
-        if '__init__.py' in files:
-            packages.append(directory.replace(os.sep, '.'))
-    return packages
+from setuptools import setup, find_packages
 
 
 setup_args = dict(
@@ -24,11 +12,10 @@ setup_args = dict(
     author_email='radix@twistedmatrix.com',
     url='http://launchpad.net/corotwine/',
     packages=find_packages(),
+    install_requires=["Twisted>=17.1", "greenlet>=0.4.17"],
+    extras_require={"tls": ["pyOpenSSL", "service_identity"]},
     )
 
-if 'setuptools' in sys.modules:
-    setup_args["install_requires"] = "Twisted>=8.1.0"
-
 
 if __name__ == '__main__':
     setup(**setup_args)